@@ -23,6 +23,13 @@ class AlertAnalyzer():
         self.candidate_dict = self.template_generator.getTemplates()
         
 
+    def getStateSize(self):
+        size = {}
+        for attack_name, candidates in self.candidate_dict.iteritems():
+            size["candidate_dict/" + attack_name] = len(candidates)
+        return size
+
+
     def analyze(self, meta_alert):
         #print("")
         #pprint(meta_alert)
@@ -2,6 +2,7 @@ from data_value import DataValue
 from collections import deque
 from anomaly import MeasurementAnomaly
 from inc_mean_std import Analog
+from index_key import data_value_index
 import numpy as np 
 import math
 
@@ -161,12 +162,43 @@ class DataAnalyzer():
     def __init__(self, anomaly_queue):
         self.data_dict = dict() 
         self.anomaly_queue = anomaly_queue
+        # Keys updated since the last checkpoint
+        self.dirty = set()
+
+
+    def getStateSize(self):
+        return {"data_dict": len(self.data_dict)}
+
+
+    def getCheckpoint(self, full):
+        keys = self.data_dict.keys() if full else self.dirty
+        models = dict((key, self.data_dict[key]) for key in keys)
+        self.dirty = set()
+        return ({}, models)
+
+
+    def restoreCheckpoint(self, state, models):
+        self.data_dict.update(models)
 
 
     def analyze(self, data_value):
         #print(data_value)
-        key = data_value.holder_ip + ";" + data_value.protocol + ";" + data_value.uid + ";" + data_value.data_type + ";" + str(data_value.index)
+        key = data_value_index(data_value)
         #print(key)
         if key not in self.data_dict:
             self.data_dict[key] = DataValueModel(key, data_value, self.anomaly_queue);
         self.data_dict[key].update(data_value)
+        self.dirty.add(key)
+
+
+    def analyzeBatch(self, data_values):
+        data_dict = self.data_dict
+        dirty = self.dirty
+        for data_value in data_values:
+            key = data_value_index(data_value)
+            model = data_dict.get(key)
+            if model == None:
+                model = DataValueModel(key, data_value, self.anomaly_queue)
+                data_dict[key] = model
+            model.update(data_value)
+            dirty.add(key)
@@ -1,6 +1,7 @@
 from flow import Flow 
 from anomaly import FlowAnomaly
 from inc_mean_std import ExpMeanSTD
+from index_key import flow_index
 import numpy as np 
 import math
 
@@ -81,12 +82,43 @@ class FlowAnalyzer():
     def __init__(self, anomaly_queue):
         self.flow_dict = dict()
         self.anomaly_queue = anomaly_queue
+        # Keys updated since the last checkpoint
+        self.dirty = set()
+
+
+    def getStateSize(self):
+        return {"flow_dict": len(self.flow_dict)}
+
+
+    def getCheckpoint(self, full):
+        keys = self.flow_dict.keys() if full else self.dirty
+        models = dict((key, self.flow_dict[key]) for key in keys)
+        self.dirty = set()
+        return ({}, models)
+
+
+    def restoreCheckpoint(self, state, models):
+        self.flow_dict.update(models)
 
 
     def analyze(self, flow):
         #print(flow)
-        key = flow.orig + ";" + flow.resp + ";" + flow.protocol_type + ";" + flow.service 
+        key = flow_index(flow)
         #print(key)
         if key not in self.flow_dict:
             self.flow_dict[key] = FlowModel(key, self.anomaly_queue);
         self.flow_dict[key].update(flow)
+        self.dirty.add(key)
+
+
+    def analyzeBatch(self, flows):
+        flow_dict = self.flow_dict
+        dirty = self.dirty
+        for flow in flows:
+            key = flow_index(flow)
+            model = flow_dict.get(key)
+            if model == None:
+                model = FlowModel(key, self.anomaly_queue)
+                flow_dict[key] = model
+            model.update(flow)
+            dirty.add(key)
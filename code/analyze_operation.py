@@ -1,6 +1,7 @@
 from operation import Operation
 from anomaly import OperationAnomaly
 from inc_mean_std import ExpMeanSTD
+from index_key import operation_index, function_index
 import numpy as np 
 import math
 
@@ -94,7 +95,11 @@ class OperationModel:
 
 
     def update(self, operation):
-        index = self.index + ";" + str(operation.fc)
+        function_stats = self.fc_dict.get(operation.fc)
+        if function_stats != None:
+            index = function_stats.index
+        else:
+            index = function_index(self.index, operation.fc)
         if operation.service == "DNP3_TCP":
             if operation.fc < 0 or operation.fc > 255:
                 generate_anomaly(operation.ts,
@@ -132,7 +137,7 @@ class OperationModel:
                                  operation)
                 return
 
-        if operation.fc not in self.fc_dict:
+        if function_stats == None:
             #print("sigmoid: " + str(sigmoid(self.total_seen/COUNT_NORM)))
             confi = sigmoid(self.total_seen/COUNT_NORM) * sigmoid((operation.ts-self.first_seen)/TIME_NORM)
             generate_anomaly(operation.ts,
@@ -143,7 +148,7 @@ class OperationModel:
                              operation)
             self.fc_dict[operation.fc] = FunctionStats(index, operation, self.anomaly_queue)
         else:
-            self.fc_dict[operation.fc].update(operation)
+            function_stats.update(operation)
 
         self.total_seen += 1
 
@@ -158,21 +163,66 @@ class OperationAnalyzer():
         self.last_check = None
         self.operation_dict = dict()
         self.anomaly_queue = anomaly_queue
+        # Keys updated since the last checkpoint. The periodic check only
+        # reads the models.
+        self.dirty = set()
+
+
+    def getStateSize(self):
+        return {"operation_dict": len(self.operation_dict)}
+
+
+    def getCheckpoint(self, full):
+        keys = self.operation_dict.keys() if full else self.dirty
+        models = dict((key, self.operation_dict[key]) for key in keys)
+        self.dirty = set()
+        return ({"last_check": self.last_check}, models)
+
+
+    def restoreCheckpoint(self, state, models):
+        self.last_check = state["last_check"]
+        self.operation_dict.update(models)
 
 
     def analyze(self, operation):
+        self.update(operation)
+        self.tick(operation.ts)
+
+
+    def analyzeBatch(self, operations):
+        operation_dict = self.operation_dict
+        dirty = self.dirty
+        tick = self.tick
+        for operation in operations:
+            key = operation_index(operation)
+            model = operation_dict.get(key)
+            if model == None:
+                model = OperationModel(key, operation, self.anomaly_queue)
+                operation_dict[key] = model
+            model.update(operation)
+            dirty.add(key)
+            tick(operation.ts)
+
+
+    def update(self, operation):
         #print(operation)
-        key = operation.orig_ip + ";" + operation.resp_ip + ";" + operation.service + ";" + operation.uid
+        key = operation_index(operation)
         #print(key)
         if key not in self.operation_dict:
             self.operation_dict[key] = OperationModel(key, operation, self.anomaly_queue);
         self.operation_dict[key].update(operation)
+        self.dirty.add(key)
+
 
+    # Returns True when the periodic check is due at ts
+    def tick(self, ts):
         if self.last_check == None:
-            self.last_check = operation.ts
-        elif operation.ts > self.last_check + PERIODIC_CHECK_TIME:
-            self.check(operation.ts)
+            self.last_check = ts
+        elif ts > self.last_check + PERIODIC_CHECK_TIME:
+            self.check(ts)
             self.last_check += PERIODIC_CHECK_TIME
+            return True
+        return False
 
 
     def check(self, ts):
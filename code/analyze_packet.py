@@ -3,6 +3,10 @@ from flow import Flow
 from anomaly import PacketAnomaly
 from den_stream import DenStream1D 
 from inc_mean_std import IncMeanSTD, ExpMeanSTD
+from index_key import packet_index
+from service_table import ServiceTable, AB, BA, EMPTY_FLOW, update_flow
+from packet_batch import PacketBatch, Interner, PROTOCOLS, group_ranks
+from count_min import NoveltyCounter
 import datetime
 import numpy as np 
 import math
@@ -12,38 +16,78 @@ COUNT_NORM = 100.0
 COUNT_EACH_NORM = 100.0
 CONFI_TH = 0.9
 PERIOD = 60*10 
+# Flow windows are PERIOD long, and the services are spread over phases
+# whose windows end PHASE_LEN apart, so each boundary closes a share of them
+WINDOW_PHASES = 10
+PHASE_LEN = PERIOD / WINDOW_PHASES
+# Connections whose context is kept before the cache is cleared
+MAX_CONNECTIONS = 65536
+# Counters of the novelty tracker
+NOVELTY_COUNTERS = ("orig_dict", "resp_dict", "protocol_dict", "service_dict")
 
 def sigmoid(x):
     return 2 * (1 / (1 + math.exp(-x)) - 0.5)
 
 
-def generate_flow(start, end, orig, resp, protocol, service, service_stats, flow_queue):
-    tcp_flag_most = -1
-    tcp_flag_max = 0
-    for tcp_flag in service_stats.tcp_flag_count:
-        if service_stats.tcp_flag_count[tcp_flag] > tcp_flag_max:
-            tcp_flag_most = tcp_flag
-            tcp_flag_max = service_stats.tcp_flag_count[tcp_flag]
-
-    flow = Flow(
-                start,
-                end,
-                orig,
-                resp,
-                protocol,
-                service,
-                tcp_flag_most,
-                service_stats.bytes_flow_ab.getTotal(),
-                service_stats.bytes_flow_ba.getTotal(), 
-                service_stats.bytes_flow_ab.getMean(),
-                service_stats.bytes_flow_ab.getSTD(),
-                service_stats.bytes_flow_ba.getMean(),
-                service_stats.bytes_flow_ba.getSTD(),
-                service_stats.iat_flow_ab.getMean(),
-                service_stats.iat_flow_ab.getSTD(),
-                service_stats.iat_flow_ba.getMean(),
-                service_stats.iat_flow_ba.getSTD()
-                )
+def period_start(start, ts, period):
+    # start moved on by whole periods to the start of the period of ts, in
+    # one step however long the gap. A period includes its end.
+    if ts > start + period:
+        start += (math.ceil((ts - start) / float(period)) - 1) * period
+        while ts > start + period:
+            start += period
+        while ts <= start:
+            start -= period
+    return start
+
+
+def window_phase(ip_pair, protocol, service):
+    # The same phase in every analyzer, so that shards close the windows of
+    # a service when a single analyzer would
+    return hash((ip_pair, protocol, service)) % WINDOW_PHASES
+
+
+def intern_values(values):
+    # The distinct values, in order of first appearance, and the number of
+    # each value among them
+    interner = Interner()
+    ids = interner.ids
+    value_ids = [ids.setdefault(value, len(ids)) for value in values]
+    return interner.getValues(), np.array(value_ids, np.int64)
+
+
+def expand_events(counts):
+    # For items with counts[i] events each, the item and the number within
+    # the item of every event, in item order
+    items = np.repeat(np.arange(len(counts)), counts)
+    numbers = np.arange(len(items)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return items, numbers
+
+
+def count_novel(counts, values, item_values):
+    # The items seen fewer than COUNT_NORM times before, counting the earlier
+    # items of the batch, where item i has the value values[item_values[i]].
+    # The items are then added to the counts.
+    initial = np.array([counts.setdefault(value, 0) for value in values], np.int64)
+    before = initial[item_values] + group_ranks(item_values)
+    for value, n in zip(values, np.bincount(item_values, minlength=len(values)).tolist()):
+        counts[value] += n
+    return np.flatnonzero(before < COUNT_NORM).tolist()
+
+
+def totals_before(stats, item_stats):
+    # The total of the stats of each item before it, counting the earlier
+    # items of the batch. The items are then added to the totals.
+    initial = np.array([stat.total for stat in stats], np.int64)
+    before = initial[item_stats] + group_ranks(item_stats)
+    for stat, n in zip(stats, np.bincount(item_stats, minlength=len(stats)).tolist()):
+        stat.total += n
+    return before.tolist()
+
+
+def generate_flow(start, end, orig, resp, protocol, service, flow_stats, flow_queue):
+    # flow_stats are the fields of the flow of one row of a ServiceTable
+    flow = Flow(start, end, orig, resp, protocol, service, *flow_stats)
     flow_queue.put_nowait(flow)
 
 
@@ -80,164 +124,232 @@ class ProtocolStats():
         self.total = 0
 
 
-class ServiceStats():
-    def __init__(self, index, anomaly_queue):
+class ConnectionContext():
+    # What analyze() resolves for the packets of one connection: the indexes
+    # of its anomalies, the stats of its IP pair, protocol and services, and
+    # the address whose packets go in the ab direction. It is only used while
+    # the protocol and service list of the packets stay the ones it was
+    # resolved for, as Bro may add a service to a connection later on.
+    def __init__(self,
+                 protocol,
+                 service_list,
+                 novelty_index,
+                 index,
+                 ip_pair,
+                 ip_pair_stats,
+                 protocol_stats,
+                 service_stats):
+        self.protocol = protocol
+        self.service_list = service_list
+        self.novelty_index = novelty_index
         self.index = index
-        self.anomaly_queue = anomaly_queue
+        self.ip_pair = ip_pair
+        self.sender_ab = ip_pair[0]
+        self.ip_pair_stats = ip_pair_stats
+        self.protocol_stats = protocol_stats
+        self.service_stats = service_stats
 
-        self.total_ab = 0
-        self.total_ba = 0
 
-        self.tcp_flag_count = dict()
+class ServiceStats():
+    # The models of one service of an IP pair and protocol. Its counters and
+    # flow accumulators are a row of the ServiceTable of the analyzer.
+    def __init__(self, index, anomaly_queue, table, phase):
+        self.index = index
+        self.anomaly_queue = anomaly_queue
+        self.table = table
+        self.phase = phase
+        self.row = table.addRow(phase)
 
-        self.last_seen_ab = None
         self.iat_ab = DenStream1D(0.5) 
         #self.iat_ab = ExpMeanSTD(COUNT_EACH_NORM, 0.02) 
-        self.iat_flow_ab = IncMeanSTD(COUNT_EACH_NORM) 
-
-        self.last_seen_ba = None
         self.iat_ba = DenStream1D(0.5)
         #self.iat_ba = ExpMeanSTD(COUNT_EACH_NORM, 0.02) 
-        self.iat_flow_ba = IncMeanSTD(COUNT_EACH_NORM) 
-
         self.bytes_ab = DenStream1D(1)
         #self.bytes_ab = ExpMeanSTD(COUNT_EACH_NORM, 0.02) 
-        self.bytes_flow_ab = IncMeanSTD(COUNT_EACH_NORM) 
-
         self.bytes_ba = DenStream1D(1) 
         #self.bytes_ba = ExpMeanSTD(COUNT_EACH_NORM, 0.02) 
-        self.bytes_flow_ba = IncMeanSTD(COUNT_EACH_NORM) 
 
 
-    def clearFlow(self):
-        self.tcp_flag_count = dict()
-        self.iat_flow_ab = IncMeanSTD(COUNT_EACH_NORM) 
-        self.iat_flow_ba = IncMeanSTD(COUNT_EACH_NORM) 
-        self.bytes_flow_ab = IncMeanSTD(COUNT_EACH_NORM) 
-        self.bytes_flow_ba = IncMeanSTD(COUNT_EACH_NORM) 
+    # A checkpoint holds the values of the row rather than the table, and
+    # the analyzer gives the restored models rows of its own table
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["table"]
+        state["row"] = self.table.getRow(self.row)
+        return state
+
+
+    def attach(self, table):
+        # Called on a restored ServiceStats, whose row holds the values
+        self.table = table
+        self.row = table.addRow(self.phase, self.row)
+
+
+    def getTotal(self):
+        return self.table.total.item(self.row, AB) + self.table.total.item(self.row, BA)
 
 
-    def update(self, packet, ip_pair):
-        if packet.tcp_flag not in self.tcp_flag_count:
-            self.tcp_flag_count[packet.tcp_flag] = 1
+    def updateEvents(self, direction, events, anomalies):
+        # The batch form of update, for the packets of one direction in
+        # order. Each event is (key, ts, iat, packet_len), with no iat when
+        # the direction had no packet before. The anomalies are appended with
+        # their key, for the caller to put them in packet order.
+        table = self.table
+        row = self.row
+        norm = table.norm
+        if direction == AB:
+            iat_model = self.iat_ab
+            bytes_model = self.bytes_ab
         else:
-            self.tcp_flag_count[packet.tcp_flag] += 1
-            
-        if packet.sender == ip_pair.split(";")[0]:
-            if self.last_seen_ab != None:
-                iat = packet.ts - self.last_seen_ab
-                rst, ano_score, p_c_list, p_r_list = self.iat_ab.merge(iat, packet.ts)
-                #rst, ano_score, p_c_list, p_r_list = self.iat_ab.update(iat)
-                self.iat_flow_ab.update(iat)
-                #print("iat_ab: " + str(iat))
-                #print(self.iat_ab)
+            iat_model = self.iat_ba
+            bytes_model = self.bytes_ba
+        total = table.total.item(row, direction)
+        iat_n = table.iat_count.item(row, direction)
+        iat_mean = table.iat_mean.item(row, direction)
+        iat_m2 = table.iat_m2.item(row, direction)
+        bytes_n = table.bytes_count.item(row, direction)
+        bytes_mean = table.bytes_mean.item(row, direction)
+        bytes_m2 = table.bytes_m2.item(row, direction)
+
+        for key, ts, iat, packet_len in events:
+            if iat != None:
+                rst, ano_score, p_c_list, p_r_list = iat_model.merge(iat, ts)
+                iat_n, iat_mean, iat_m2 = update_flow(iat_n, iat_mean, iat_m2, iat, norm)
                 if not rst:
-                    desp = "PACKET_IAT"
-                    confi = sigmoid(self.total_ab/COUNT_EACH_NORM) * ano_score
-                    generate_anomaly(packet.ts,
-                                     desp,
-                                     confi,
-                                     self.index,
-                                     self.anomaly_queue,
-                                     packet,
-                                     iat,
-                                     p_c_list,
-                                     p_r_list)
-            self.last_seen_ab = packet.ts
-
-            packet_len = packet.packet_len 
-            rst, ano_score, p_c_list, p_r_list = self.bytes_ab.merge(packet_len, packet.ts)
-            #rst, ano_score, p_c_list, p_r_list = self.bytes_ab.update(packet_len)
-            self.bytes_flow_ab.update(packet_len)
-            #print("bytes_ab: " + str(packet_len))
-            #print(self.bytes_ab)
+                    confi = sigmoid(total/COUNT_EACH_NORM) * ano_score
+                    if confi >= CONFI_TH:
+                        anomalies.append((key + (1,), "PACKET_IAT", confi, self.index, iat, p_c_list, p_r_list))
+
+            rst, ano_score, p_c_list, p_r_list = bytes_model.merge(packet_len, ts)
+            bytes_n, bytes_mean, bytes_m2 = update_flow(bytes_n, bytes_mean, bytes_m2, packet_len, norm)
             if not rst:
-                desp = "PACKET_BYTES"
-                confi = sigmoid(self.total_ab/COUNT_EACH_NORM) * ano_score 
-                generate_anomaly(packet.ts,
-                                 desp,
-                                 confi,
-                                 self.index,
-                                 self.anomaly_queue,
-                                 packet,
-                                 packet_len,
-                                 p_c_list,
-                                 p_r_list)
-            self.total_ab += 1
+                confi = sigmoid(total/COUNT_EACH_NORM) * ano_score
+                if confi >= CONFI_TH:
+                    anomalies.append((key + (2,), "PACKET_BYTES", confi, self.index, packet_len, p_c_list, p_r_list))
+            total += 1
+
+        table.total.itemset(row, direction, total)
+        table.last_seen.itemset(row, direction, events[-1][1])
+        table.iat_count.itemset(row, direction, iat_n)
+        table.iat_mean.itemset(row, direction, iat_mean)
+        table.iat_m2.itemset(row, direction, iat_m2)
+        table.bytes_count.itemset(row, direction, bytes_n)
+        table.bytes_mean.itemset(row, direction, bytes_mean)
+        table.bytes_m2.itemset(row, direction, bytes_m2)
+
+
+    def update(self, packet, is_ab):
+        table = self.table
+        row = self.row
+        table.countFlag(row, packet.tcp_flag)
+
+        if is_ab:
+            direction = AB
+            iat_model = self.iat_ab
+            bytes_model = self.bytes_ab
         else:
-            if self.last_seen_ba != None:
-                iat = packet.ts - self.last_seen_ba
-                rst, ano_score, p_c_list, p_r_list = self.iat_ba.merge(iat, packet.ts)
-                #rst, ano_score, p_c_list, p_r_list = self.iat_ba.update(iat)
-                self.iat_flow_ba.update(iat)
-                #print("iat_ba: " + str(iat))
-                #print(self.iat_ba)
-                if not rst:
-                    desp = "PACKET_IAT"
-                    confi = sigmoid(self.total_ba/COUNT_EACH_NORM) * ano_score
-                    generate_anomaly(packet.ts,
-                                     desp,
-                                     confi,
-                                     self.index,
-                                     self.anomaly_queue,
-                                     packet,
-                                     iat,
-                                     p_c_list,
-                                     p_r_list)
-            self.last_seen_ba = packet.ts
-
-            packet_len = packet.packet_len 
-            rst, ano_score, p_c_list, p_r_list = self.bytes_ba.merge(packet_len, packet.ts)
-            #rst, ano_score, p_c_list, p_r_list = self.bytes_ba.update(packet_len)
-            self.bytes_flow_ba.update(packet_len)
-            #print("bytes_ba: " + str(packet_len))
-            #print(self.bytes_ba)
+            direction = BA
+            iat_model = self.iat_ba
+            bytes_model = self.bytes_ba
+        total = table.total.item(row, direction)
+
+        last_seen = table.last_seen.item(row, direction)
+        if not math.isnan(last_seen):
+            iat = packet.ts - last_seen
+            rst, ano_score, p_c_list, p_r_list = iat_model.merge(iat, packet.ts)
+            table.updateIAT(row, direction, iat)
             if not rst:
-                desp = "PACKET_BYTES"
-                confi = sigmoid(self.total_ba/COUNT_EACH_NORM) * ano_score 
+                desp = "PACKET_IAT"
+                confi = sigmoid(total/COUNT_EACH_NORM) * ano_score
                 generate_anomaly(packet.ts,
                                  desp,
                                  confi,
                                  self.index,
                                  self.anomaly_queue,
                                  packet,
-                                 packet_len,
+                                 iat,
                                  p_c_list,
                                  p_r_list)
-            self.total_ba += 1
+        table.last_seen.itemset(row, direction, packet.ts)
+
+        packet_len = packet.packet_len 
+        rst, ano_score, p_c_list, p_r_list = bytes_model.merge(packet_len, packet.ts)
+        table.updateBytes(row, direction, packet_len)
+        if not rst:
+            desp = "PACKET_BYTES"
+            confi = sigmoid(total/COUNT_EACH_NORM) * ano_score 
+            generate_anomaly(packet.ts,
+                             desp,
+                             confi,
+                             self.index,
+                             self.anomaly_queue,
+                             packet,
+                             packet_len,
+                             p_c_list,
+                             p_r_list)
+        table.total.itemset(row, direction, total + 1)
  
 
-class PacketAnalyzer():
-    def __init__(self, anomaly_queue, flow_queue):
-        self.orig_dict = dict()
-        self.resp_dict = dict()
-        self.protocol_dict = dict()
-        self.service_dict = dict()
-        self.ip_pair_dict = dict()
+class NoveltyTracker():
+    # The counters are dictionaries, or with sketch, the settings of a
+    # NoveltyCounter, counters of a fixed size that a scan or a flood of
+    # spoofed addresses cannot grow
+    def __init__(self, anomaly_queue, sketch=None):
+        self.orig_dict = self.makeCounter(sketch)
+        self.resp_dict = self.makeCounter(sketch)
+        self.protocol_dict = self.makeCounter(sketch)
+        self.service_dict = self.makeCounter(sketch)
         self.total = 0
-        self.start_time = None 
+        self.start_time = None
         self.anomaly_queue = anomaly_queue
-        self.flow_queue = flow_queue
-        self.last_aggregate = -1
+        # Keys of each counter updated since the last checkpoint
+        self.changed = dict((name, set()) for name in NOVELTY_COUNTERS)
 
 
-    def analyze(self, packet):
-        if self.last_aggregate == -1:
-            self.last_aggregate = packet.ts
-            self.start_time = packet.ts
+    def makeCounter(self, sketch):
+        if sketch == None:
+            return dict()
+        return NoveltyCounter(COUNT_NORM, **sketch)
+
 
-        while packet.ts > self.last_aggregate + PERIOD:
-            self.aggregate()
-            self.last_aggregate += PERIOD 
+    def getStateSize(self):
+        return {"orig_dict": len(self.orig_dict),
+                "resp_dict": len(self.resp_dict),
+                "protocol_dict": len(self.protocol_dict),
+                "service_dict": len(self.service_dict)}
+
+
+    def clearChanges(self):
+        for keys in self.changed.values():
+            keys.clear()
+
+
+    # The counts of the keys updated since the last call, for a delta
+    # checkpoint; a full one pickles the whole tracker
+    def getChanges(self):
+        counts = dict((name, dict((key, getattr(self, name)[key]) for key in keys))
+                      for name, keys in self.changed.items())
+        self.clearChanges()
+        return {"total": self.total, "start_time": self.start_time, "counts": counts}
+
+
+    def restoreChanges(self, changes):
+        self.total = changes["total"]
+        self.start_time = changes["start_time"]
+        for name, counts in changes["counts"].iteritems():
+            counter = getattr(self, name)
+            for key, count in counts.iteritems():
+                counter[key] = count
+
+
+    def update(self, packet, index):
+        if self.start_time == None:
+            self.start_time = packet.ts
 
         orig = packet.conn[0]
         resp = packet.conn[2]
         protocol = packet.protocol_type
         service_list = packet.service
-        ip_pair = orig + ";" + resp
-        inverse_ip_pair = resp + ";" + orig
-        cur_ip_pair = ip_pair
-        index = ip_pair + ";" + protocol + ";" + str(service_list)
 
         confi = sigmoid(self.total/COUNT_NORM) * sigmoid(abs(packet.ts-self.start_time)/TIME_NORM)
         if orig not in self.orig_dict:
@@ -280,26 +392,317 @@ class PacketAnalyzer():
                                  self.anomaly_queue,
                                  packet)
             self.service_dict[service] += 1
+            self.changed["service_dict"].add(service)
 
         self.orig_dict[orig] += 1
         self.resp_dict[resp] += 1
         self.protocol_dict[protocol] += 1 
+        self.changed["orig_dict"].add(orig)
+        self.changed["resp_dict"].add(resp)
+        self.changed["protocol_dict"].add(protocol)
         self.total += 1
 
-        if ip_pair not in self.ip_pair_dict and inverse_ip_pair not in self.ip_pair_dict:
-            self.ip_pair_dict[ip_pair] = IPPairStats() 
-        if ip_pair not in self.ip_pair_dict:
-            ip_pair_stats = self.ip_pair_dict[inverse_ip_pair] 
-            index = inverse_ip_pair + ";" + protocol + ";" + str(service_list)
-            cur_ip_pair = inverse_ip_pair
-        else:
-            ip_pair_stats = self.ip_pair_dict[ip_pair] 
-       
+
+    def updateBatch(self, ts, contexts, packets, packet_contexts, anomalies):
+        # The batch form of update. ts are the times of the packets of the
+        # batch, and packet_contexts the number of the ConnectionContext of
+        # each in contexts, first seen with the packet of the same number in
+        # packets. The anomalies are appended with their key, for the caller
+        # to put them in packet order.
+        if self.start_time == None:
+            self.start_time = ts[0]
+        confis = dict()
+        kinds = [("NEW_ORIG", "orig_dict", [packet.conn[0] for packet in packets]),
+                 ("NEW_RESP", "resp_dict", [packet.conn[2] for packet in packets]),
+                 ("NEW_PROTOCOL", "protocol_dict", [packet.protocol_type for packet in packets])]
+        for sub, (desp, name, context_values) in enumerate(kinds):
+            counts = getattr(self, name)
+            values, context_ids = intern_values(context_values)
+            self.changed[name].update(values)
+            for pos in count_novel(counts, values, context_ids[packet_contexts]):
+                self.addAnomaly(pos, (pos, 0, sub), desp, ts, contexts[packet_contexts[pos]], confis, anomalies)
+
+        # One event per service of each packet
+        service_lists = [packet.service for packet in packets]
+        service_counts = np.array([len(service_list) for service_list in service_lists], np.int64)
+        event_pos, event_k = expand_events(service_counts[packet_contexts])
+        values, service_ids = intern_values([service for service_list in service_lists for service in service_list])
+        offsets = np.cumsum(service_counts) - service_counts
+        event_values = service_ids[offsets[packet_contexts[event_pos]] + event_k]
+        event_pos = event_pos.tolist()
+        event_k = event_k.tolist()
+        self.changed["service_dict"].update(values)
+        for event in count_novel(self.service_dict, values, event_values):
+            pos = event_pos[event]
+            self.addAnomaly(pos, (pos, 0, 3 + event_k[event]), "NEW_SERVICE", ts, contexts[packet_contexts[pos]], confis, anomalies)
+        self.total += len(ts)
+
+
+    def addAnomaly(self, pos, key, desp, ts, context, confis, anomalies):
+        confi = confis.get(pos)
+        if confi == None:
+            confi = sigmoid((self.total + pos)/COUNT_NORM) * sigmoid(abs(ts[pos]-self.start_time)/TIME_NORM)
+            confis[pos] = confi
+        if confi >= CONFI_TH:
+            anomalies.append((key, desp, confi, context.novelty_index, None, None, None))
+
+
+class PacketAnalyzer():
+    # The novelty tracker holds the counters shared by every IP pair. It can
+    # be disabled when the caller tracks novelty across several analyzers.
+    def __init__(self, anomaly_queue, flow_queue, track_novelty=True, novelty_sketch=None):
+        self.novelty = None
+        if track_novelty:
+            self.novelty = NoveltyTracker(anomaly_queue, novelty_sketch)
+        self.ip_pair_dict = dict()
+        self.service_table = ServiceTable(COUNT_EACH_NORM, WINDOW_PHASES)
+        # Context of each connection tuple, rebuilt from ip_pair_dict
+        self.connections = dict()
+        # IP pair, protocol and service of each row of the service table
+        self.service_keys = dict()
+        self.anomaly_queue = anomaly_queue
+        self.flow_queue = flow_queue
+        # Last phase boundary, and the phase whose windows end at the next
+        self.last_aggregate = -1
+        self.next_phase = 0
+        # IP pairs updated since the last checkpoint
+        self.dirty = set()
+
+
+    def getStateSize(self):
+        size = {"ip_pair_dict": len(self.ip_pair_dict),
+                "connections": len(self.connections),
+                "service_table": self.service_table.getRowCount()}
+        if self.novelty != None:
+            size.update(self.novelty.getStateSize())
+        return size
+
+
+    def getCheckpoint(self, full):
+        keys = self.ip_pair_dict.keys() if full else self.dirty
+        models = dict((key, self.ip_pair_dict[key]) for key in keys)
+        self.dirty = set()
+        state = {"last_aggregate": self.last_aggregate, "next_phase": self.next_phase}
+        if self.novelty != None:
+            if full:
+                self.novelty.clearChanges()
+                state["novelty"] = self.novelty
+            else:
+                state["novelty_changes"] = self.novelty.getChanges()
+        return (state, models)
+
+
+    def restoreCheckpoint(self, state, models):
+        self.last_aggregate = state["last_aggregate"]
+        self.next_phase = state.get("next_phase", 0)
+        if "novelty" in state:
+            self.novelty = state["novelty"]
+        if "novelty_changes" in state:
+            self.novelty.restoreChanges(state["novelty_changes"])
+        for ip_pair, ip_pair_stats in models.iteritems():
+            if ip_pair in self.ip_pair_dict:
+                for protocol, service, service_stats in self.iterServices(self.ip_pair_dict[ip_pair]):
+                    self.service_table.removeRow(service_stats.row)
+                    del self.service_keys[service_stats.row]
+            for protocol, service, service_stats in self.iterServices(ip_pair_stats):
+                service_stats.attach(self.service_table)
+                self.service_keys[service_stats.row] = (ip_pair, protocol, service)
+        self.ip_pair_dict.update(models)
+        self.connections = dict()
+
+
+    def iterServices(self, ip_pair_stats):
+        for protocol, protocol_stats in ip_pair_stats.protocol_dict.iteritems():
+            for service, service_stats in protocol_stats.service_dict.iteritems():
+                yield protocol, service, service_stats
+
+
+    def start(self, ts):
+        if self.last_aggregate == -1:
+            self.last_aggregate = ts
+
+
+    def advance(self, ts):
+        # Closes the windows of each phase boundary before ts. Past the
+        # first window of every phase, a gap without traffic is skipped at
+        # once by aggregateIdle.
+        if ts > self.last_aggregate + PHASE_LEN:
+            end = period_start(self.last_aggregate, ts, PHASE_LEN)
+            boundaries = int(round((end - self.last_aggregate) / PHASE_LEN))
+            for k in range(1, min(boundaries, WINDOW_PHASES) + 1):
+                self.aggregate((self.next_phase + k - 1) % WINDOW_PHASES,
+                               self.last_aggregate + k * PHASE_LEN)
+            self.aggregateIdle(boundaries)
+            self.last_aggregate = end
+            self.next_phase = (self.next_phase + boundaries) % WINDOW_PHASES
+
+
+    def analyzeBatch(self, packets):
+        if isinstance(packets, PacketBatch):
+            self.analyzePacketBatch(packets)
+            return
+        analyze = self.analyze
+        for packet in packets:
+            analyze(packet)
+
+
+    def analyzePacketBatch(self, batch):
+        # The same analysis as analyze on each packet of a PacketBatch. The
+        # batch is split where a packet passes the next phase boundary, so
+        # that the flows are aggregated before it as analyze would.
+        ts = batch.records["ts"]
+        lo = 0
+        while lo < len(batch):
+            self.start(ts.item(lo))
+            self.advance(ts.item(lo))
+            past = ts[lo:] > self.last_aggregate + PHASE_LEN
+            hi = lo + past.argmax() if past.any() else len(batch)
+            self.analyzeSegment(batch, lo, hi)
+            lo = hi
+
+
+    def analyzeSegment(self, batch, lo, hi):
+        # Counts and totals are taken for the whole segment with numpy, and
+        # only the packets that may be novel and the points of the detectors
+        # of each service and direction are visited one by one. Anomalies are
+        # collected with a key of the packet, the stage of analyze that
+        # reports them and their order within it, and put in the queue in
+        # the order analyze would.
+        records = batch.records[lo:hi]
+        ts = records["ts"]
+        ts_list = ts.tolist()
+        anomalies = []
+
+        # A context for each distinct connection, protocol and service list,
+        # numbered by the first packet with it
+        keys = ((records["conn"].astype(np.int64) * len(PROTOCOLS) + records["protocol"]) *
+                len(batch.services) + records["service"])
+        unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        numbers = np.empty(len(order), np.int64)
+        numbers[order] = np.arange(len(order))
+        packet_contexts = numbers[inverse]
+        contexts = []
+        context_packets = []
+        for i in first[order].tolist():
+            packet = batch.packet(lo + i)
+            context = self.connections.get(packet.conn)
+            if (context == None or
+                context.protocol != packet.protocol_type or
+                context.service_list != packet.service):
+                context = self.resolve(packet)
+            contexts.append(context)
+            context_packets.append(packet)
+
+        if self.novelty != None:
+            self.novelty.updateBatch(ts_list, contexts, context_packets, packet_contexts, anomalies)
+
+        # New protocols of the IP pairs
+        pair_stats, pair_ids = intern_values([context.ip_pair_stats for context in contexts])
+        protocol_stats, protocol_ids = intern_values([context.protocol_stats for context in contexts])
+        pair_before = totals_before(pair_stats, pair_ids[packet_contexts])
+        protocol_before = totals_before(protocol_stats, protocol_ids[packet_contexts])
+        for pos, before in enumerate(protocol_before):
+            if before < COUNT_NORM:
+                confi = sigmoid(pair_before[pos]/COUNT_NORM)
+                if confi >= CONFI_TH:
+                    anomalies.append(((pos, 1, 0), "NEW_PROTOCOL", confi, contexts[packet_contexts[pos]].index, None, None, None))
+        for context in contexts:
+            self.dirty.add(context.ip_pair)
+
+        # One event per service of each packet, with the table row of the
+        # service
+        service_counts = np.array([len(context.service_stats) for context in contexts], np.int64)
+        event_pos, event_k = expand_events(service_counts[packet_contexts])
+        if len(event_pos) == 0:
+            self.putAnomalies(batch, lo, ts_list, anomalies)
+            return
+        row_stats = dict()
+        context_rows = np.zeros((len(contexts), service_counts.max()), np.int64)
+        for i, context in enumerate(contexts):
+            for k, service_stats in enumerate(context.service_stats):
+                context_rows[i, k] = service_stats.row
+                row_stats[service_stats.row] = service_stats
+        event_row = context_rows[packet_contexts[event_pos], event_k]
+
+        # New services
+        table = self.service_table
+        rows, row_ids = np.unique(event_row, return_inverse=True)
+        row_before = table.total[rows].sum(axis=1)[row_ids] + group_ranks(event_row)
+        for event in np.flatnonzero(row_before < COUNT_NORM).tolist():
+            pos = event_pos.item(event)
+            confi = sigmoid(protocol_before[pos]/COUNT_NORM)
+            if confi >= CONFI_TH:
+                anomalies.append(((pos, 2 + event_k.item(event), 0), "NEW_SERVICE", confi, contexts[packet_contexts[pos]].index, None, None, None))
+
+        # Direction of each event, by the sender of its packet
+        host_ids = dict((host, i) for i, host in enumerate(batch.hosts))
+        context_senders = np.array([host_ids.get(context.sender_ab, -1) for context in contexts], np.int64)
+        is_ab = records["sender"] == context_senders[packet_contexts]
+        event_direction = np.where(is_ab[event_pos], AB, BA)
+        table.countFlags(event_row, records["tcp_flag"][event_pos])
+
+        # Events grouped by row and direction, in packet order within each,
+        # with the inter-arrival times from the previous packet of the group
+        groups = event_row * 2 + event_direction
+        order = np.argsort(groups, kind="mergesort")
+        groups = groups[order]
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        ends = np.r_[starts[1:], len(groups)]
+        event_ts = ts[event_pos][order]
+        previous = np.empty(len(event_ts))
+        previous[1:] = event_ts[:-1]
+        previous[starts] = table.last_seen[groups[starts] // 2, groups[starts] % 2]
+        iats = [iat if iat == iat else None for iat in (event_ts - previous).tolist()]
+        packet_lens = [packet_len if packet_len >= 0 else None
+                       for packet_len in records["packet_len"][event_pos][order].tolist()]
+        event_keys = zip(event_pos[order].tolist(), (event_k[order] + 2).tolist())
+        events = zip(event_keys, event_ts.tolist(), iats, packet_lens)
+        for start, end, group in zip(starts.tolist(), ends.tolist(), groups[starts].tolist()):
+            row_stats[group // 2].updateEvents(group % 2, events[start:end], anomalies)
+
+        self.putAnomalies(batch, lo, ts_list, anomalies)
+
+
+    def putAnomalies(self, batch, lo, ts, anomalies):
+        anomalies.sort(key=lambda anomaly: anomaly[0])
+        packets = dict()
+        for key, desp, confi, index, current, mean, std in anomalies:
+            pos = key[0]
+            packet = packets.get(pos)
+            if packet == None:
+                packet = batch.packet(lo + pos)
+                packets[pos] = packet
+            generate_anomaly(ts[pos],
+                             desp,
+                             confi,
+                             index,
+                             self.anomaly_queue,
+                             packet,
+                             current,
+                             mean,
+                             std)
+
+
+    def analyze(self, packet):
+        self.start(packet.ts)
+        self.advance(packet.ts)
+
+        context = self.connections.get(packet.conn)
+        if (context == None or
+            context.protocol != packet.protocol_type or
+            context.service_list != packet.service):
+            context = self.resolve(packet)
+
+        if self.novelty != None:
+            self.novelty.update(packet, context.novelty_index)
+
+        ip_pair_stats = context.ip_pair_stats
+        index = context.index
+        self.dirty.add(context.ip_pair)
  
         confi = sigmoid(ip_pair_stats.total/COUNT_NORM)
-        if protocol not in ip_pair_stats.protocol_dict:
-            ip_pair_stats.protocol_dict[protocol] = ProtocolStats()
-        protocol_stats = ip_pair_stats.protocol_dict[protocol]
+        protocol_stats = context.protocol_stats
         if protocol_stats.total < COUNT_NORM: 
             generate_anomaly(packet.ts,
                              "NEW_PROTOCOL",
@@ -310,37 +713,103 @@ class PacketAnalyzer():
         ip_pair_stats.total += 1
         
         confi = sigmoid(protocol_stats.total/COUNT_NORM)
-        for service in service_list:
-            if service not in protocol_stats.service_dict:
-                protocol_stats.service_dict[service] = ServiceStats(index, self.anomaly_queue)
-            service_stats = protocol_stats.service_dict[service]
-            if service_stats.total_ab + service_stats.total_ba < COUNT_NORM:
+        is_ab = packet.sender == context.sender_ab
+        for service_stats in context.service_stats:
+            if service_stats.getTotal() < COUNT_NORM:
                 generate_anomaly(packet.ts,
                                  "NEW_SERVICE",
                                  confi,
                                  index,
                                  self.anomaly_queue,
                                  packet)
-            service_stats.update(packet, cur_ip_pair)
+            service_stats.update(packet, is_ab)
         protocol_stats.total += 1
 
 
-    def aggregate(self):
-        for ip_pair in self.ip_pair_dict:
-            ip_pair_stats = self.ip_pair_dict[ip_pair]
-            ip_pair_list = ip_pair.split(";")
-            orig = ip_pair_list[0]
-            resp = ip_pair_list[1]
-            for protocol in ip_pair_stats.protocol_dict:
-                protocol_stats = ip_pair_stats.protocol_dict[protocol] 
-                for service in protocol_stats.service_dict:
-                    service_stats = protocol_stats.service_dict[service]
-                    generate_flow(self.last_aggregate,
-                                  self.last_aggregate+PERIOD,
-                                  orig,
-                                  resp,
-                                  protocol,
-                                  service,
-                                  service_stats,
-                                  self.flow_queue)
-                    service_stats.clearFlow()
+    def resolve(self, packet):
+        # Looks up, or creates, the stats a packet of this connection updates
+        # and caches them as its context
+        orig = packet.conn[0]
+        resp = packet.conn[2]
+        protocol = packet.protocol_type
+        service_list = packet.service
+        ip_pair = (orig, resp)
+        inverse_ip_pair = (resp, orig)
+        novelty_index = packet_index(orig, resp, protocol, service_list)
+
+        if ip_pair not in self.ip_pair_dict and inverse_ip_pair not in self.ip_pair_dict:
+            self.ip_pair_dict[ip_pair] = IPPairStats() 
+        if ip_pair not in self.ip_pair_dict:
+            ip_pair_stats = self.ip_pair_dict[inverse_ip_pair] 
+            index = packet_index(resp, orig, protocol, service_list)
+            ip_pair = inverse_ip_pair
+        else:
+            ip_pair_stats = self.ip_pair_dict[ip_pair] 
+            index = novelty_index
+
+        if protocol not in ip_pair_stats.protocol_dict:
+            ip_pair_stats.protocol_dict[protocol] = ProtocolStats()
+        protocol_stats = ip_pair_stats.protocol_dict[protocol]
+
+        service_stats = []
+        for service in service_list:
+            if service not in protocol_stats.service_dict:
+                new_stats = ServiceStats(index,
+                                         self.anomaly_queue,
+                                         self.service_table,
+                                         window_phase(ip_pair, protocol, service))
+                protocol_stats.service_dict[service] = new_stats
+                self.service_keys[new_stats.row] = (ip_pair, protocol, service)
+            service_stats.append(protocol_stats.service_dict[service])
+
+        context = ConnectionContext(protocol,
+                                    list(service_list),
+                                    novelty_index,
+                                    index,
+                                    ip_pair,
+                                    ip_pair_stats,
+                                    protocol_stats,
+                                    service_stats)
+        if len(self.connections) >= MAX_CONNECTIONS:
+            self.connections = dict()
+        self.connections[packet.conn] = context
+        return context
+
+
+    def aggregate(self, phase, end):
+        # Flows of the windows of a phase that end at end: the services
+        # active in the window, and an empty flow for those active in the
+        # window before only; idle services are skipped
+        rows, flows = self.service_table.takeFlows(phase)
+        for row, flow_stats in zip(rows, flows):
+            ip_pair, protocol, service = self.service_keys[row]
+            self.dirty.add(ip_pair)
+            generate_flow(end-PERIOD,
+                          end,
+                          ip_pair[0],
+                          ip_pair[1],
+                          protocol,
+                          service,
+                          flow_stats,
+                          self.flow_queue)
+
+
+    def aggregateIdle(self, boundaries):
+        # When more than WINDOW_PHASES boundaries pass without traffic, the
+        # services of a phase that were active in the window closed last
+        # get one empty flow from its end to the last boundary of the phase
+        # in the gap, instead of one for each window
+        for k in range(WINDOW_PHASES + 1, min(boundaries, 2 * WINDOW_PHASES) + 1):
+            phase = (self.next_phase + k - 1) % WINDOW_PHASES
+            last = k + (boundaries - k) // WINDOW_PHASES * WINDOW_PHASES
+            for row in self.service_table.takeIdle(phase):
+                ip_pair, protocol, service = self.service_keys[row]
+                self.dirty.add(ip_pair)
+                generate_flow(self.last_aggregate + (k - WINDOW_PHASES) * PHASE_LEN,
+                              self.last_aggregate + last * PHASE_LEN,
+                              ip_pair[0],
+                              ip_pair[1],
+                              protocol,
+                              service,
+                              EMPTY_FLOW,
+                              self.flow_queue)
@@ -1,6 +1,17 @@
 import datetime
+from record import Record
+from index_key import SEPARATOR, ANY, split_index
+
+class Anomaly(Record):
+    __slots__ = ("ts",
+                 "desp",
+                 "confi",
+                 "anomaly_type",
+                 "index",
+                 "current",
+                 "mean",
+                 "dev")
 
-class Anomaly:
     def __init__(self,
                 ts=None,  
                 desp=None,
@@ -53,7 +64,7 @@ class Anomaly:
                "desp": self.desp,
                "confi": self.confi,
                "anomaly_type":  self.anomaly_type,
-               "index": self.index,
+               "index": str(self.index),
                "current": self.current,
                "mean": self.mean,
                "dev": self.dev}
@@ -87,6 +98,8 @@ class Anomaly:
 
 
 class PacketAnomaly(Anomaly):
+    __slots__ = ("packet",)
+
     def __init__(self,
                 ts=None,  
                 desp=None,
@@ -105,22 +118,22 @@ class PacketAnomaly(Anomaly):
         return self.packet
 
 
+    # The index of a meta-alert is the string stored in Mongo, while the
+    # anomaly keeps its IndexKey, so the fields are compared as text
     def matchIndex(self, index):
-        index_own = self.index.split(";")
-        index_dest = index.split(";")
+        index_dest = split_index(index)
         for i in range(2):
-            if index_own[i] == index_dest[i]:
+            if self.index.getField(i) == index_dest[i]:
                 return True
         return False 
         
 
     def aggregateIndex(self, index):
-        index_own = self.index.split(";")
-        index_dest = index.split(";")
+        index_dest = split_index(index)
         for i in range(4):
-            if index_own[i] != index_dest[i]:
-                index_dest[i] = "-"
-        return ';'.join(index_dest) 
+            if self.index.getField(i) != index_dest[i]:
+                index_dest[i] = ANY
+        return SEPARATOR.join(index_dest) 
 
 
     def getDict(self):
@@ -136,6 +149,8 @@ class PacketAnomaly(Anomaly):
 
 
 class FlowAnomaly(Anomaly):
+    __slots__ = ("flow",)
+
     def __init__(self,
                 ts=None,  
                 desp=None,
@@ -167,6 +182,8 @@ class FlowAnomaly(Anomaly):
 
 
 class OperationAnomaly(Anomaly):
+    __slots__ = ("operation",)
+
     def __init__(self,
                 ts=None,  
                 desp=None,
@@ -199,6 +216,10 @@ class OperationAnomaly(Anomaly):
 
 
 class MeasurementAnomaly(Anomaly):
+    __slots__ = ("measurement",
+                 "measurement_type",
+                 "type_confi")
+
     def __init__(self,
                 ts=None,  
                 desp=None,
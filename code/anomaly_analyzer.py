@@ -1,86 +1,93 @@
 import gevent
 import pickle
-import socket
+import signal
 import sys
-import threading
 import timeit
-import numpy
-from gevent import select
+from gevent.event import Event
 from gevent.queue import Queue, Empty
+from gevent.server import StreamServer
 from pprint import pprint
 from analyze_alert import AlertAnalyzer
+from latency_histogram import get_histogram, report
+from serve_metrics import MetricsServer
 
 meta_alert_queue = Queue()
 EDMAND_NUM = 1
 TIMEOUT = 120 
+# Local port of the metrics endpoint
+METRICS_PORT = 9996
+
+metrics = MetricsServer(METRICS_PORT)
+metrics.addSource("queues", lambda: {"meta_alert_queue": {"depth": meta_alert_queue.qsize()}})
 
 
 def alert_receiver(n):
     bind_ip = "127.0.0.1"
     bind_port = 9998
+    connections = []
+    accepted = Event()
 
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((bind_ip, bind_port))
-    server.listen(5)
-    print("Listening on {}:{}".format(bind_ip, bind_port))
-
-    
+    # Each EDMAND connection is served by its own greenlet. A meta-alert may
+    # arrive in several segments, so it is read from the stream until the
+    # pickle is complete.
     def handle_client_connection(client_socket, address):
         print("Accepted connection from {}:{}".format(address[0], address[1]))
-        data = client_socket.recv(655350)
-        while len(data) > 0:
-            meta_alert = pickle.loads(data)
+        connections.append(address)
+        if len(connections) == EDMAND_NUM:
+            accepted.set()
+        stream = client_socket.makefile("rb")
+        while True:
+            try:
+                meta_alert = pickle.load(stream)
+            except EOFError:
+                break
             meta_alert_queue.put_nowait(meta_alert)
-            client_socket.send("ACK")
-            data = client_socket.recv(655350)
-            gevent.sleep(0)
+            client_socket.sendall("ACK")
+        stream.close()
         print("Connection from {}:{} closed".format(address[0], address[1]))
 
 
-    count = EDMAND_NUM
-    while count > 0:
-        client_sock, address = server.accept()
-        client_handler = threading.Thread(
-            target = handle_client_connection,
-            args = (client_sock, address,)
-        )
-        client_handler.start()
-        count -= 1
-        gevent.sleep(0.01)
+    server = StreamServer((bind_ip, bind_port), handle_client_connection, backlog=5)
+    server.start()
+    print("Listening on {}:{}".format(bind_ip, bind_port))
+    accepted.wait()
+    server.close()
 
 
 def alert_analyzer(n):
     countdown = TIMEOUT/0.01 
-    aa = AlertAnalyzer()
-    reasoning_time = [] 
-    count = 0
+    # The causal reasoning and its Mongo writes run in the hub's thread pool
+    # so that the receiver keeps reading alerts meanwhile
+    threadpool = gevent.get_hub().threadpool
+    aa = threadpool.apply(AlertAnalyzer)
+    metrics.addSource("alert_analyzer", aa.getStateSize)
+    histogram = get_histogram("Alert analyzer")
     while countdown > 0:
         try:
            while True:
                 meta_alert = meta_alert_queue.get_nowait()
                 start = timeit.default_timer()
-                aa.analyze(meta_alert)
-                reasoning_time.append(timeit.default_timer() - start)
+                threadpool.apply(aa.analyze, (meta_alert,))
+                histogram.record(timeit.default_timer() - start)
                 countdown = TIMEOUT/0.01 
-                gevent.sleep(0)
         except Empty:
             countdown -= 1 
             gevent.sleep(0.01)
     aa.print_alerts()
     aa.print_candidates()
     print("Alert analyzer {} quit!".format(n))
-    if len(reasoning_time) > 0:
-        reasoning_array = numpy.array([reasoning_time])
-        print("Alert analyzer time: " + str(numpy.mean(reasoning_array, axis=1)))
-        print("Alert analyzer num: " + str(len(reasoning_time)))
-        print("Alert analyzer std: " + str(numpy.std(reasoning_array, axis=1)))
+    if histogram.count != 0:
+        print(histogram)
     
 
 def main():
+    gevent.signal_handler(signal.SIGUSR1, report)
+    metrics.start()
     gevent.joinall([
         gevent.spawn(alert_receiver, 1),
         gevent.spawn(alert_analyzer, 1),
     ])
+    metrics.stop()
 
 
 if __name__ == '__main__': main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Bytes per record with slots, against the same attributes kept in a per
+# instance __dict__ as before. Only the record itself is counted; the
+# attribute values are shared either way.
+#   python bench_memory.py
+
+import sys
+from packet import Packet
+from flow import Flow
+from operation import Operation
+from data_value import DataValue
+from anomaly import PacketAnomaly, FlowAnomaly, OperationAnomaly, MeasurementAnomaly
+
+
+class Unslotted:
+    # A record as the old classes stored it
+    pass
+
+
+def unslotted(record):
+    copy = Unslotted()
+    copy.__dict__.update(record.__getstate__())
+    return copy
+
+
+def record_size(record):
+    size = sys.getsizeof(record)
+    if hasattr(record, "__dict__"):
+        size += sys.getsizeof(record.__dict__)
+    return size
+
+
+def sample_records():
+    conn = ("10.0.0.1", "45000/tcp", "10.0.0.2", "20000/tcp")
+    packet = Packet(1500000000.0, "10.0.0.1", "10.0.0.2", "TCP", 24, ["DNP3_TCP"], 79, conn)
+    flow = Flow(1500000000.0, 1500000600.0, "10.0.0.1", "10.0.0.2", "TCP", ["DNP3_TCP"], 24,
+                100, 100, 79.0, 0.0, 120.0, 3.0, 2.0, 0.1, 2.0, 0.1)
+    operation = Operation(1500000000.0, "10.0.0.1", "10.0.0.2", "DNP3_TCP", "85:80", 1, "READ", True)
+    data_value = DataValue(1500000000.0, "10.0.0.2", "DNP3_TCP", "85:80", "Analog", 3, 60.0, False)
+    return [
+        ("Packet", packet),
+        ("Flow", flow),
+        ("Operation", operation),
+        ("DataValue", data_value),
+        ("PacketAnomaly", PacketAnomaly(1500000000.0, "packet", 0.9, "index", packet, 79, 60, 2)),
+        ("FlowAnomaly", FlowAnomaly(1500000000.0, "flow", 0.9, "index", flow, 100, 80, 5)),
+        ("OperationAnomaly", OperationAnomaly(1500000000.0, "operation", 0.9, "index", operation, 2.0, 1.0, 0.1)),
+        ("MeasurementAnomaly", MeasurementAnomaly(1500000000.0, "measurement", 0.9, "index", data_value,
+                                                  "Analog", 0.8, 60.0, 59.9, 0.1)),
+    ]
+
+
+def main():
+    print("{:<20}{:>10}{:>10}{:>10}".format("record", "dict", "slots", "saved"))
+    for name, record in sample_records():
+        before = record_size(unslotted(record))
+        after = record_size(record)
+        print("{:<20}{:>10}{:>10}{:>9.0f}%".format(name, before, after, 100.0 * (before - after) / before))
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,156 @@
+import cPickle
+import cStringIO
+import gevent
+import math
+import os
+import struct
+
+# Traffic seconds between two checkpoints
+CHECKPOINT_PERIOD = 60*10
+# Number of delta checkpoints written after a full snapshot before the next one
+DELTAS_PER_SNAPSHOT = 12
+
+# Each delta record is its length followed by the pickled record
+RECORD_HEADER = struct.Struct("<I")
+
+
+class Checkpointer():
+    # Checkpoints one analyzer in <directory>/<name>. The analyzer provides
+    # getCheckpoint(full), returning its small state and the models that
+    # changed since the last call (all of them when full), and
+    # restoreCheckpoint(state, models).
+    #
+    # A full snapshot replaces the previous one with an atomic rename and
+    # starts a new delta log, to which the following checkpoints append only
+    # the changed models. A restore loads the snapshot and replays its log.
+    # The queues the models hold are stored by name and reattached on load.
+    def __init__(self, directory, name, queues, period=CHECKPOINT_PERIOD, deltas_per_snapshot=DELTAS_PER_SNAPSHOT):
+        self.path = os.path.join(directory, name)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.queues = queues
+        self.queue_names = dict((id(queue), queue_name) for queue_name, queue in queues.items())
+        self.period = period
+        self.deltas_per_snapshot = deltas_per_snapshot
+        self.generation = 0
+        self.deltas = None
+        self.next_boundary = None
+        self.threadpool = gevent.get_hub().threadpool
+
+
+    def persistentID(self, obj):
+        return self.queue_names.get(id(obj))
+
+
+    def dumps(self, record):
+        output = cStringIO.StringIO()
+        pickler = cPickle.Pickler(output, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self.persistentID
+        pickler.dump(record)
+        return output.getvalue()
+
+
+    def loads(self, data):
+        unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+        unpickler.persistent_load = self.queues.__getitem__
+        return unpickler.load()
+
+
+    def snapshotPath(self):
+        return os.path.join(self.path, "snapshot")
+
+
+    def deltaPath(self, generation):
+        return os.path.join(self.path, "deltas." + str(generation))
+
+
+    # True once traffic time reaches the next multiple of the period
+    def isDue(self, ts):
+        if self.next_boundary == None:
+            self.next_boundary = (math.floor(ts / self.period) + 1) * self.period
+            return False
+        return ts >= self.next_boundary
+
+
+    # Checkpoint the analyzer before traffic time ts. It must not be in the
+    # middle of an update, which holds between two batches of a stage.
+    def save(self, anl, ts):
+        self.next_boundary = (math.floor(ts / self.period) + 1) * self.period
+        full = self.deltas == None or self.deltas >= self.deltas_per_snapshot
+        state, models = anl.getCheckpoint(full)
+        if full:
+            self.generation += 1
+            data = self.dumps((self.generation, ts, state, models))
+            # Pickling has to happen at the cut; the disk writes do not
+            # hold up the other stages
+            self.threadpool.apply(self.writeSnapshot, (data, self.generation))
+            self.deltas = 0
+        else:
+            data = self.dumps((ts, state, models))
+            self.threadpool.apply(self.appendDelta, (data, self.generation))
+            self.deltas += 1
+
+
+    def writeSnapshot(self, data, generation):
+        # A run that did not restore counts generations from 1 again, so a
+        # log of this generation may be left by an earlier run; it is
+        # removed before the snapshot it would be replayed over is in place
+        delta_path = self.deltaPath(generation)
+        if os.path.exists(delta_path):
+            os.remove(delta_path)
+
+        temp_path = self.snapshotPath() + ".tmp"
+        with open(temp_path, "wb") as snapshot:
+            snapshot.write(data)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(temp_path, self.snapshotPath())
+        directory = os.open(self.path, os.O_RDONLY)
+        os.fsync(directory)
+        os.close(directory)
+
+        # The deltas of older snapshots are no longer needed
+        current = os.path.basename(delta_path)
+        for file_name in os.listdir(self.path):
+            if file_name.startswith("deltas.") and file_name != current:
+                os.remove(os.path.join(self.path, file_name))
+
+
+    def appendDelta(self, data, generation):
+        with open(self.deltaPath(generation), "ab") as deltas:
+            deltas.write(RECORD_HEADER.pack(len(data)) + data)
+            deltas.flush()
+            os.fsync(deltas.fileno())
+
+
+    # Load the last checkpoint into the analyzer. Returns the traffic time it
+    # was cut at, or None when there is no checkpoint.
+    def restore(self, anl):
+        if not os.path.exists(self.snapshotPath()):
+            return None
+        with open(self.snapshotPath(), "rb") as snapshot:
+            generation, ts, state, models = self.loads(snapshot.read())
+        anl.restoreCheckpoint(state, models)
+        self.generation = generation
+        self.deltas = 0
+
+        delta_path = self.deltaPath(generation)
+        if os.path.exists(delta_path):
+            with open(delta_path, "r+b") as deltas:
+                data = deltas.read()
+                offset = 0
+                while offset + RECORD_HEADER.size <= len(data):
+                    length, = RECORD_HEADER.unpack_from(data, offset)
+                    end = offset + RECORD_HEADER.size + length
+                    if end > len(data):
+                        break
+                    ts, state, models = self.loads(data[offset + RECORD_HEADER.size:end])
+                    anl.restoreCheckpoint(state, models)
+                    self.deltas += 1
+                    offset = end
+                # Drop a record torn by a crash so that new ones follow the
+                # last complete record
+                deltas.truncate(offset)
+
+        self.next_boundary = (math.floor(ts / self.period) + 1) * self.period
+        return ts
@@ -1,5 +1,9 @@
 import numpy as np
 import math
+from ip_address import ip_address, common_octets
+
+# Parsed indexes kept before the cache is cleared
+INDEX_CACHE_SIZE = 10000
 
 
 class AlertCorrelator():
@@ -45,6 +49,9 @@ class AlertCorrelator():
                 time_accuracy=10,
                 ):
         self.time_accuracy = time_accuracy
+        # IP addresses and protocols of each alert index, so that an index is
+        # split and its addresses parsed once rather than on every comparison
+        self.index_cache = dict()
         self.cor_pi = [] 
         anomaly_num = len(self.anomaly_index)
         for i in range(anomaly_num):
@@ -79,38 +86,48 @@ class AlertCorrelator():
             return -1 
 
 
+    def indexFields(self, alert):
+        key = (alert['anomaly_type'], alert['index'])
+        fields = self.index_cache.get(key)
+        if fields != None:
+            return fields
+
+        index = alert['index'].split(';')
+        if alert['anomaly_type'] == 'measurement':
+            ip_pair = [index[0]]
+        else:
+            ip_pair = index[0:2]
+        ip_pair = [ip_address(ip) for ip in ip_pair if ip != "-"]
+
+        if alert['anomaly_type'] == 'packet':
+            tmp = index[3].strip('[]').split(',')
+            protocols = [proto.strip('\' ') for proto in tmp] 
+        elif alert['anomaly_type'] == 'flow':
+            protocols = [index[3]]
+        elif alert['anomaly_type'] == 'operation':
+            protocols = [index[2]]
+        else:
+            protocols = [index[1]]
+
+        fields = (ip_pair, protocols)
+        if len(self.index_cache) >= INDEX_CACHE_SIZE:
+            self.index_cache.clear()
+        self.index_cache[key] = fields
+        return fields
+
+
     def ipSimilarity(self, ip1, ip2):
-        ip1 = ip1.split('.')
-        ip2 = ip2.split('.')
-        assert(len(ip1) == 4)
-        assert(len(ip2) == 4)
-        similarity = 0
-        for i in range(4):
-            if ip1[i] != ip2[i]:
-                break
-            similarity += 1
-        return similarity
+        return common_octets(ip_address(ip1), ip_address(ip2))
 
 
     def ipPairSimilarity(self, alert1, alert2): 
-        if alert1['anomaly_type'] == 'measurement':
-            ip_pair1 = [alert1['index'].split(';')[0]]
-        else:
-            ip_pair1 = alert1['index'].split(';')[0:2]
-
-        if alert2['anomaly_type'] == 'measurement':
-            ip_pair2 = [alert2['index'].split(';')[0]]
-        else:
-            ip_pair2 = alert2['index'].split(';')[0:2]
+        ip_pair1 = self.indexFields(alert1)[0]
+        ip_pair2 = self.indexFields(alert2)[0]
 
         max_similarity = 0
         for ip1 in ip_pair1:
-            if ip1 == "-":
-                continue
             for ip2 in ip_pair2:
-                if ip2 == "-":
-                    continue
-                max_similarity = max(max_similarity, self.ipSimilarity(ip1, ip2))
+                max_similarity = max(max_similarity, common_octets(ip1, ip2))
 
         if max_similarity == 4:
             return np.array([1, 0, 0, 0])
@@ -123,25 +140,8 @@ class AlertCorrelator():
 
 
     def sameProtocol(self, alert1, alert2): 
-        if alert1['anomaly_type'] == 'packet':
-            tmp = alert1['index'].split(';')[3].strip('[]').split(',')
-            protocol1 = [proto.strip('\' ') for proto in tmp] 
-        elif alert1['anomaly_type'] == 'flow':
-            protocol1 = [alert1['index'].split(';')[3]]
-        elif alert1['anomaly_type'] == 'operation':
-            protocol1 = [alert1['index'].split(';')[2]]
-        else:
-            protocol1 = [alert1['index'].split(';')[1]]
-
-        if alert2['anomaly_type'] == 'packet':
-            tmp = alert2['index'].split(';')[3].strip('[]').split(',')
-            protocol2 = [proto.strip('\' ') for proto in tmp] 
-        elif alert2['anomaly_type'] == 'flow':
-            protocol2 = [alert2['index'].split(';')[3]]
-        elif alert2['anomaly_type'] == 'operation':
-            protocol2 = [alert2['index'].split(';')[2]]
-        else:
-            protocol2 = [alert2['index'].split(';')[1]]
+        protocol1 = self.indexFields(alert1)[1]
+        protocol2 = self.indexFields(alert2)[1]
 
         for p1 in protocol1:
             for p2 in protocol2:
@@ -0,0 +1,88 @@
+import math
+import random
+import numpy as np
+
+# Default size of a counter: SKETCH_DEPTH rows of SKETCH_WIDTH saturating
+# counts, and the keys of its exact tier
+SKETCH_WIDTH = 1 << 14
+SKETCH_DEPTH = 4
+MAX_HOT_KEYS = 4096
+
+# Prime modulus of the row hashes
+MERSENNE_61 = (1 << 61) - 1
+U64_MASK = (1 << 64) - 1
+
+
+class NoveltyCounter():
+    # Counts of keys up to limit in a fixed amount of memory, for the "seen
+    # fewer than limit times" test of the novelty tracker. It is read and
+    # written like the dictionary it replaces: counter[key] is the count of
+    # a key and counter[key] = n raises it to n.
+    #
+    # Keys below the limit are counted in a Count-Min sketch with
+    # conservative update, whose counts saturate at the limit. A count is
+    # never under-estimated, so a key seen limit times is never new again,
+    # and a new key is only missed when all of its counts were filled up by
+    # other keys. Keys that reached the limit are kept in an exact tier of at
+    # most hot_keys keys, which answers for the busy keys with one lookup.
+    def __init__(self, limit, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, hot_keys=MAX_HOT_KEYS, seed=0):
+        self.limit = int(math.ceil(limit))
+        self.width = width
+        self.hot_keys = hot_keys
+        self.hot = set()
+        dtype = np.uint8 if self.limit <= 255 else np.uint32
+        self.counts = np.zeros((depth, width), dtype)
+        generator = random.Random(seed)
+        self.hashes = [(generator.randrange(1, MERSENNE_61), generator.randrange(MERSENNE_61))
+                       for row in range(depth)]
+        # An increment reads and then writes the same key
+        self.last_key = None
+        self.last_cells = None
+
+
+    def getMemorySize(self):
+        return self.counts.nbytes
+
+
+    def cells(self, key):
+        if key == self.last_key and self.last_cells != None:
+            return self.last_cells
+        h = hash(key) & U64_MASK
+        width = self.width
+        cells = [(a * h + b) % MERSENNE_61 % width for a, b in self.hashes]
+        self.last_key = key
+        self.last_cells = cells
+        return cells
+
+
+    def __getitem__(self, key):
+        if key in self.hot:
+            return self.limit
+        counts = self.counts
+        return min(counts.item(row, cell) for row, cell in enumerate(self.cells(key)))
+
+
+    def __setitem__(self, key, count):
+        if key in self.hot:
+            return
+        count = min(count, self.limit)
+        counts = self.counts
+        for row, cell in enumerate(self.cells(key)):
+            if counts.item(row, cell) < count:
+                counts.itemset(row, cell, count)
+        if count == self.limit and len(self.hot) < self.hot_keys:
+            self.hot.add(key)
+
+
+    def __contains__(self, key):
+        return self[key] > 0
+
+
+    def setdefault(self, key, default):
+        if default > 0:
+            self[key] = max(self[key], default)
+        return self[key]
+
+
+    def __len__(self):
+        return len(self.hot)
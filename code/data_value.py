@@ -1,6 +1,17 @@
 import datetime
+from record import Record
+from ip_address import ip_text
+
+class DataValue(Record):
+    __slots__ = ("ts",
+                 "holder_ip",
+                 "protocol",
+                 "uid",
+                 "data_type",
+                 "index",
+                 "value",
+                 "is_event")
 
-class DataValue:
     def __init__(self,
                 ts=None,  
                 holder_ip=None,
@@ -23,7 +34,7 @@ class DataValue:
 
     def getDict(self):
         rst = {"ts": self.ts,
-               "holder_ip": self.holder_ip,
+               "holder_ip": ip_text(self.holder_ip),
                "service": self.protocol,
                "uid": self.uid,
                "data_type": self.data_type,
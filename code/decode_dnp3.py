@@ -0,0 +1,275 @@
+import struct
+from operation import Operation
+from data_value import DataValue
+
+PROTOCOL = "DNP3_TCP"
+
+# DNP3::function_codes of Bro
+FUNCTION_CODES = {
+    0x00: "CONFIRM",
+    0x01: "READ",
+    0x02: "WRITE",
+    0x03: "SELECT",
+    0x04: "OPERATE",
+    0x05: "DIRECT_OPERATE",
+    0x06: "DIRECT_OPERATE_NR",
+    0x07: "IMMED_FREEZE",
+    0x08: "IMMED_FREEZE_NR",
+    0x09: "FREEZE_CLEAR",
+    0x0a: "FREEZE_CLEAR_NR",
+    0x0b: "FREEZE_AT_TIME",
+    0x0c: "FREEZE_AT_TIME_NR",
+    0x0d: "COLD_RESTART",
+    0x0e: "WARM_RESTART",
+    0x0f: "INITIALIZE_DATA",
+    0x10: "INITIALIZE_APPL",
+    0x11: "START_APPL",
+    0x12: "STOP_APPL",
+    0x13: "SAVE_CONFIG",
+    0x14: "ENABLE_UNSOLICITED",
+    0x15: "DISABLE_UNSOLICITED",
+    0x16: "ASSIGN_CLASS",
+    0x17: "DELAY_MEASURE",
+    0x18: "RECORD_CURRENT_TIME",
+    0x19: "OPEN_FILE",
+    0x1a: "CLOSE_FILE",
+    0x1b: "DELETE_FILE",
+    0x1c: "GET_FILE_INFO",
+    0x1d: "AUTHENTICATE_FILE",
+    0x1e: "ABORT_FILE",
+    0x1f: "ACTIVATE_CONFIG",
+    0x20: "AUTHENTICATE_REQ",
+    0x21: "AUTHENTICATE_ERR",
+    0x81: "RESPONSE",
+    0x82: "UNSOLICITED_RESPONSE",
+    0x83: "AUTHENTICATE_RESP",
+}
+
+# Link layer: start bytes, length, control, destination and source address
+# and a CRC; the user data follows in blocks of 16 bytes, each with a CRC
+LINK_START = b"\x05\x64"
+LINK_HEADER = struct.Struct("<2sBBHH2x")
+LINK_BLOCK = 16
+CRC_SIZE = 2
+
+# Transport header bits
+TRANSPORT_FIN = 0x80
+TRANSPORT_FIR = 0x40
+
+# Bytes of the range fields of each range specifier code: start and stop
+# indexes for 0-2, an object count for 7-9
+RANGE_SIZES = {0: 1, 1: 2, 2: 4, 7: 1, 8: 2, 9: 4}
+RANGE_FORMATS = {1: "<B", 2: "<H", 4: "<I"}
+RANGE_ALL = 6
+# Bytes of the index prefixed to each object for prefix codes 0-3
+PREFIX_SIZES = {0: 0, 1: 1, 2: 2, 3: 4}
+
+# Points with their state in one bit each: (group, variation) -> data type,
+# or None to skip them
+PACKED_OBJECTS = {
+    (1, 1): "Binary",
+    (10, 1): None,
+    (80, 1): None,
+}
+
+# Response objects with a value, as the events data_level_dnp3.bro handles:
+# (group, variation) -> (layout, data type, is event). A layout with a
+# leading byte carries the flag of the point. Binary points take their state
+# from bit 7 of the flag and become 1.0 or -1.0.
+DATA_OBJECTS = {
+    (1, 2): (struct.Struct("<B"), "Binary", False),
+    (2, 1): (struct.Struct("<B"), "Binary", True),
+    (2, 2): (struct.Struct("<B6x"), "Binary", True),
+    (2, 3): (struct.Struct("<B2x"), "Binary", True),
+    (20, 1): (struct.Struct("<xi"), "Counter", False),
+    (20, 2): (struct.Struct("<xh"), "Counter", False),
+    (20, 5): (struct.Struct("<i"), "Counter", False),
+    (20, 6): (struct.Struct("<h"), "Counter", False),
+    (30, 1): (struct.Struct("<xi"), "Analog", False),
+    (30, 2): (struct.Struct("<xh"), "Analog", False),
+    (30, 3): (struct.Struct("<i"), "Analog", False),
+    (30, 4): (struct.Struct("<h"), "Analog", False),
+    (30, 5): (struct.Struct("<xf"), "Analog", False),
+    (30, 6): (struct.Struct("<xd"), "Analog", False),
+    (32, 1): (struct.Struct("<xi"), "Analog", True),
+    (32, 2): (struct.Struct("<xh"), "Analog", True),
+    (32, 3): (struct.Struct("<xi6x"), "Analog", True),
+    (32, 4): (struct.Struct("<xh6x"), "Analog", True),
+    (32, 5): (struct.Struct("<xf"), "Analog", True),
+    (32, 6): (struct.Struct("<xd"), "Analog", True),
+    (32, 7): (struct.Struct("<xf6x"), "Analog", True),
+    (32, 8): (struct.Struct("<xd6x"), "Analog", True),
+}
+
+# Bytes of other fixed size objects, skipped to reach the objects after them
+OBJECT_SIZES = {
+    (10, 2): 1,
+    (11, 1): 1, (11, 2): 7,
+    (12, 1): 11,
+    (21, 1): 5, (21, 2): 3, (21, 5): 9, (21, 6): 7, (21, 9): 4, (21, 10): 2,
+    (22, 1): 5, (22, 2): 3, (22, 5): 9, (22, 6): 7,
+    (23, 1): 5, (23, 2): 3, (23, 5): 9, (23, 6): 7,
+    (40, 1): 5, (40, 2): 3, (40, 3): 5, (40, 4): 9,
+    (41, 1): 5, (41, 2): 3, (41, 3): 5, (41, 4): 9,
+    (50, 1): 6,
+    (51, 1): 6, (51, 2): 6,
+    (52, 1): 2, (52, 2): 2,
+}
+
+
+def strip_crcs(frame, user_len):
+    # User data of a link frame without the CRC after each block
+    blocks = []
+    offset = LINK_HEADER.size
+    while user_len > 0:
+        size = min(LINK_BLOCK, user_len)
+        blocks.append(frame[offset:offset + size])
+        offset += size + CRC_SIZE
+        user_len -= size
+    return b"".join(blocks)
+
+
+def decode_objects(fragment, offset, ts, holder_ip, uid, data_values):
+    # Append the values of the objects of a response fragment. Decoding stops
+    # at the first object it does not know the size of.
+    end = len(fragment)
+    while offset + 3 <= end:
+        group, variation, qualifier = struct.unpack_from("<BBB", fragment, offset)
+        offset += 3
+        prefix_code = (qualifier >> 4) & 0x07
+        range_code = qualifier & 0x0f
+        if range_code == RANGE_ALL:
+            continue
+        range_size = RANGE_SIZES.get(range_code)
+        prefix_size = PREFIX_SIZES.get(prefix_code)
+        if range_size == None or prefix_size == None:
+            return
+        range_format = RANGE_FORMATS[range_size]
+        if range_code <= 2:
+            if offset + 2 * range_size > end:
+                return
+            start = struct.unpack_from(range_format, fragment, offset)[0]
+            stop = struct.unpack_from(range_format, fragment, offset + range_size)[0]
+            offset += 2 * range_size
+            quantity = stop - start + 1
+        else:
+            if offset + range_size > end:
+                return
+            start = 0
+            quantity = struct.unpack_from(range_format, fragment, offset)[0]
+            offset += range_size
+        if quantity <= 0:
+            continue
+
+        key = (group, variation)
+        if key in PACKED_OBJECTS:
+            if prefix_size != 0:
+                return
+            size = (quantity + 7) // 8
+            if offset + size > end:
+                return
+            data_type = PACKED_OBJECTS[key]
+            if data_type != None:
+                bits = bytearray(fragment[offset:offset + size])
+                for i in range(quantity):
+                    value = 1.0 if bits[i >> 3] & (1 << (i & 7)) else -1.0
+                    data_values.append(DataValue(ts, holder_ip, PROTOCOL, uid, data_type, start + i, value, False))
+            offset += size
+            continue
+
+        data_object = DATA_OBJECTS.get(key)
+        if data_object != None:
+            layout, data_type, is_event = data_object
+            size = layout.size
+        else:
+            size = OBJECT_SIZES.get(key)
+            if size == None:
+                return
+        if prefix_size != 0:
+            prefix_format = RANGE_FORMATS[prefix_size]
+        for i in range(quantity):
+            if offset + prefix_size + size > end:
+                return
+            if prefix_size != 0:
+                index = struct.unpack_from(prefix_format, fragment, offset)[0]
+                offset += prefix_size
+            else:
+                index = start + i
+            if data_object != None:
+                value = layout.unpack_from(fragment, offset)[0]
+                if data_type == "Binary":
+                    value = 1.0 if value & 0x80 else -1.0
+                data_values.append(DataValue(ts, holder_ip, PROTOCOL, uid, data_type, index, float(value), is_event))
+            offset += size
+
+
+class Dnp3Decoder():
+    # Decodes the link, transport and application layers of both directions
+    # of a DNP3 connection into Operations and DataValues, the records
+    # protocol_level_dnp3.bro and data_level_dnp3.bro send. Requests come
+    # from the originator and responses from the responder, as in Bro.
+    def __init__(self, connection, operations, data_values):
+        self.orig_ip = connection.conn[0]
+        self.resp_ip = connection.conn[2]
+        self.operations = operations
+        self.data_values = data_values
+        self.buffers = {True: b"", False: b""}
+        self.fragments = {True: None, False: None}
+
+
+    def decode(self, ts, is_orig, data):
+        buf = self.buffers[is_orig] + data
+        offset = 0
+        while True:
+            start = buf.find(LINK_START, offset)
+            if start < 0:
+                # Keep a trailing start byte that may begin the next frame
+                offset = len(buf) - 1 if buf.endswith(LINK_START[:1]) else len(buf)
+                break
+            if start + LINK_HEADER.size > len(buf):
+                offset = start
+                break
+            magic, length, control, destination, source = LINK_HEADER.unpack_from(buf, start)
+            if length < 5:
+                offset = start + len(LINK_START)
+                continue
+            user_len = length - 5
+            frame_len = LINK_HEADER.size + user_len + CRC_SIZE * ((user_len + LINK_BLOCK - 1) // LINK_BLOCK)
+            if start + frame_len > len(buf):
+                offset = start
+                break
+            if user_len > 0:
+                user_data = strip_crcs(buf[start:start + frame_len], user_len)
+                self.decodeTransport(ts, is_orig, "{}:{}".format(source, destination), user_data)
+            offset = start + frame_len
+        self.buffers[is_orig] = buf[offset:]
+
+
+    def decodeTransport(self, ts, is_orig, uid, segment):
+        transport = ord(segment[0])
+        if transport & TRANSPORT_FIR:
+            fragment = segment[1:]
+        elif self.fragments[is_orig] != None:
+            fragment = self.fragments[is_orig] + segment[1:]
+        else:
+            return
+        if transport & TRANSPORT_FIN:
+            self.fragments[is_orig] = None
+            self.decodeApplication(ts, is_orig, uid, fragment)
+        else:
+            self.fragments[is_orig] = fragment
+
+
+    def decodeApplication(self, ts, is_orig, uid, fragment):
+        if is_orig:
+            if len(fragment) < 2:
+                return
+        elif len(fragment) < 4:
+            return
+        fc = ord(fragment[1])
+        fn = FUNCTION_CODES.get(fc)
+        if fn == None:
+            fn = "unknown-{}".format(fc)
+        self.operations.append(Operation(ts, self.orig_ip, self.resp_ip, PROTOCOL, uid, fc, fn, is_orig))
+        if not is_orig:
+            decode_objects(fragment, 4, ts, self.resp_ip, uid, self.data_values)
@@ -0,0 +1,146 @@
+import collections
+import struct
+from operation import Operation
+from data_value import DataValue
+
+PROTOCOL = "Modbus"
+
+# Modbus::function_codes of Bro
+FUNCTION_CODES = {
+    0x01: "READ_COILS",
+    0x02: "READ_DISCRETE_INPUTS",
+    0x03: "READ_HOLDING_REGISTERS",
+    0x04: "READ_INPUT_REGISTERS",
+    0x05: "WRITE_SINGLE_COIL",
+    0x06: "WRITE_SINGLE_REGISTER",
+    0x07: "READ_EXCEPTION_STATUS",
+    0x08: "DIAGNOSTICS",
+    0x0b: "GET_COMM_EVENT_COUNTER",
+    0x0c: "GET_COMM_EVENT_LOG",
+    0x0f: "WRITE_MULTIPLE_COILS",
+    0x10: "WRITE_MULTIPLE_REGISTERS",
+    0x11: "REPORT_SLAVE_ID",
+    0x14: "READ_FILE_RECORD",
+    0x15: "WRITE_FILE_RECORD",
+    0x16: "MASK_WRITE_REGISTER",
+    0x17: "READ_WRITE_MULTIPLE_REGISTERS",
+    0x18: "READ_FIFO_QUEUE",
+    0x2b: "ENCAP_INTERFACE_TRANSPORT",
+    0x09: "PROGRAM_484",
+    0x0a: "POLL_484",
+    0x0d: "PROGRAM_584_984",
+    0x0e: "POLL_584_984",
+    0x12: "PROGRAM_884_U84",
+    0x13: "RESET_COMM_LINK_884_U84",
+    0x28: "PROGRAM_CONCEPT",
+    0x7d: "FIRMWARE_REPLACEMENT",
+    0x7e: "PROGRAM_584_984_2",
+    0x7f: "REPORT_LOCAL_ADDRESS",
+    0x81: "READ_COILS_EXCEPTION",
+    0x82: "READ_DISCRETE_INPUTS_EXCEPTION",
+    0x83: "READ_HOLDING_REGISTERS_EXCEPTION",
+    0x84: "READ_INPUT_REGISTERS_EXCEPTION",
+    0x85: "WRITE_SINGLE_COIL_EXCEPTION",
+    0x86: "WRITE_SINGLE_REGISTER_EXCEPTION",
+    0x87: "READ_EXCEPTION_STATUS_EXCEPTION",
+    0x8f: "WRITE_MULTIPLE_COILS_EXCEPTION",
+    0x90: "WRITE_MULTIPLE_REGISTERS_EXCEPTION",
+    0x94: "READ_FILE_RECORD_EXCEPTION",
+    0x95: "WRITE_FILE_RECORD_EXCEPTION",
+    0x96: "MASK_WRITE_REGISTER_EXCEPTION",
+    0x97: "READ_WRITE_MULTIPLE_REGISTERS_EXCEPTION",
+    0x98: "READ_FIFO_QUEUE_EXCEPTION",
+}
+
+# MBAP header: transaction id, protocol id, length of the rest of the ADU,
+# unit id
+MBAP_HEADER = struct.Struct(">HHHB")
+MAX_ADU_LENGTH = 260
+
+# Data type of the points each read function returns, as data_level_modbus.bro
+# names them, and whether they are bits
+READ_FUNCTIONS = {
+    0x01: ("Coil", True),
+    0x02: ("DiscreteInput", True),
+    0x03: ("HoldingRegister", False),
+    0x04: ("InputRegister", False),
+    0x17: ("HoldingRegister", False),
+}
+READ_REQUEST = struct.Struct(">HH")
+
+# Requests waiting for their response before the oldest one is forgotten
+MAX_PENDING_REQUESTS = 4096
+
+
+class ModbusDecoder():
+    # Decodes both directions of a Modbus/TCP connection into Operations and
+    # DataValues, the records protocol_level_modbus.bro and
+    # data_level_modbus.bro send. The range of each read request is kept by
+    # transaction and unit id, and the points of its response are expanded
+    # into one DataValue each.
+    def __init__(self, connection, operations, data_values):
+        self.orig_ip = connection.conn[0]
+        self.resp_ip = connection.conn[2]
+        self.operations = operations
+        self.data_values = data_values
+        self.buffers = {True: b"", False: b""}
+        self.requests = collections.OrderedDict()
+
+
+    def decode(self, ts, is_orig, data):
+        buf = self.buffers[is_orig] + data
+        offset = 0
+        while offset + MBAP_HEADER.size + 1 <= len(buf):
+            tid, pid, length, unit = MBAP_HEADER.unpack_from(buf, offset)
+            if length < 2 or length > MAX_ADU_LENGTH:
+                # Not a Modbus header, so the rest of the stream can not be
+                # framed any more
+                offset = len(buf)
+                break
+            end = offset + 6 + length
+            if end > len(buf):
+                break
+            pdu = buf[offset + MBAP_HEADER.size:end]
+            self.decodePdu(ts, is_orig, tid, str(unit), pdu)
+            offset = end
+        self.buffers[is_orig] = buf[offset:]
+
+
+    def decodePdu(self, ts, is_orig, tid, uid, pdu):
+        fc = ord(pdu[0])
+        fn = FUNCTION_CODES.get(fc)
+        if fn == None:
+            fn = "unknown-{}".format(fc)
+        self.operations.append(Operation(ts, self.orig_ip, self.resp_ip, PROTOCOL, uid, fc, fn, is_orig))
+        if fc & 0x80 and not is_orig:
+            # An exception response answers its request without any points
+            self.requests.pop((tid, uid), None)
+            return
+        if fc not in READ_FUNCTIONS:
+            return
+        if is_orig:
+            if len(pdu) < 1 + READ_REQUEST.size:
+                return
+            # A reused transaction id becomes the newest request
+            self.requests.pop((tid, uid), None)
+            if len(self.requests) >= MAX_PENDING_REQUESTS:
+                self.requests.popitem(last=False)
+            self.requests[(tid, uid)] = (fc,) + READ_REQUEST.unpack_from(pdu, 1)
+            return
+
+        request = self.requests.pop((tid, uid), None)
+        if request == None or request[0] != fc or len(pdu) < 2:
+            return
+        request_fc, start, quantity = request
+        data_type, is_bits = READ_FUNCTIONS[fc]
+        values = pdu[2:2 + ord(pdu[1])]
+        if is_bits:
+            bits = bytearray(values)
+            quantity = min(quantity, len(bits) * 8)
+            points = [1.0 if bits[i >> 3] & (1 << (i & 7)) else -1.0 for i in range(quantity)]
+        else:
+            quantity = min(quantity, len(values) // 2)
+            points = [float(value) for value in struct.unpack_from(">{}H".format(quantity), values)]
+        holder_ip = self.resp_ip
+        self.data_values.extend([DataValue(ts, holder_ip, PROTOCOL, uid, data_type, start + i, point, False)
+                                 for i, point in enumerate(points)])
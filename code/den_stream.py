@@ -214,3 +214,9 @@ class DenStream1D():
         else:
             rst += "O_list: Empty\n"
         return rst
+
+
+# Pickle looks classes up by name in their module, so the micro-cluster
+# classes are also exposed here for the checkpoints of the analyzer state
+OMicroCluster = DenStream1D.OMicroCluster
+PMicroCluster = DenStream1D.PMicroCluster
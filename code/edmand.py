@@ -5,17 +5,16 @@ from __future__ import unicode_literals
 import sys
 sys.path.append('/usr/local/bro/lib/broctl')
 import broker
+import copy
 import gevent
+import json
+import os
 import pickle
-import socket
+import signal
 import timeit
-import numpy
-from gevent import select
-from gevent.queue import Queue, Empty
+from gevent import select, socket
+from gevent.lock import Semaphore
 from pprint import pprint
-from parse_packet import parse_packet
-from parse_operation import parse_operation
-from parse_data_value import parse_data_value
 from packet import Packet
 from flow import Flow
 from operation import Operation
@@ -26,312 +25,734 @@ from analyze_operation import OperationAnalyzer
 from analyze_data import DataAnalyzer 
 from manage_anomaly import AnomalyManager
 from generate_traffic import TrafficGenerator
+from shard_analyzer import ShardPool
+from stage_queue import StageQueue, QueueGroup, BLOCK, PRIORITY, DISCARD, STOP
+from record_event import EventRecorder, read_events
+from latency_histogram import get_histogram, report
+from serve_metrics import MetricsServer
+from checkpoint import Checkpointer, CHECKPOINT_PERIOD, DELTAS_PER_SNAPSHOT
+from count_min import SKETCH_WIDTH, SKETCH_DEPTH, MAX_HOT_KEYS
+from parse_worker import ParseProcess, PARSERS, LEVEL_TOPICS, DONE_TOPIC
+from read_pcap import PcapReader
+from decode_dnp3 import Dnp3Decoder
+from decode_modbus import ModbusDecoder
             
-raw_packet_queue = Queue()
-raw_operation_queue = Queue()
-raw_data_value_queue = Queue()
-packet_queue = Queue()
-operation_queue = Queue()
-data_value_queue = Queue()
-flow_queue = Queue()
-anomaly_queue = Queue()
-meta_alert_queue = Queue()
-TIMEOUT = 120 
-COUNT_INIT = TIMEOUT / 0.01
-
-
-def listener():
+# Capacity, backpressure policy and shedding priority of each queue. The
+# Broker listener cannot be paused, so the raw queues shed load instead of
+# blocking; raw packets are dropped before protocol and content events.
+QUEUE_CONFIG = {
+    "raw_packet_queue": (100000, PRIORITY, 0),
+    "raw_operation_queue": (100000, PRIORITY, 1),
+    "raw_data_value_queue": (100000, PRIORITY, 1),
+    "packet_queue": (10000, BLOCK, 0),
+    "operation_queue": (10000, BLOCK, 1),
+    "data_value_queue": (10000, BLOCK, 1),
+    "flow_queue": (10000, BLOCK, 2),
+    "anomaly_queue": (10000, BLOCK, 3),
+    "meta_alert_queue": (10000, BLOCK, 3),
+}
+# Total number of items the PRIORITY queues may hold together
+RAW_QUEUE_CAPACITY = 200000
+
+raw_queue_group = QueueGroup(RAW_QUEUE_CAPACITY)
+
+
+def make_queue(name):
+    maxsize, policy, priority = QUEUE_CONFIG[name]
+    return StageQueue(name, maxsize, policy, priority, raw_queue_group)
+
+
+raw_packet_queue = make_queue("raw_packet_queue")
+raw_operation_queue = make_queue("raw_operation_queue")
+raw_data_value_queue = make_queue("raw_data_value_queue")
+packet_queue = make_queue("packet_queue")
+operation_queue = make_queue("operation_queue")
+data_value_queue = make_queue("data_value_queue")
+flow_queue = make_queue("flow_queue")
+anomaly_queue = make_queue("anomaly_queue")
+meta_alert_queue = make_queue("meta_alert_queue")
+stage_queues = [
+    raw_packet_queue,
+    raw_operation_queue,
+    raw_data_value_queue,
+    packet_queue,
+    operation_queue,
+    data_value_queue,
+    flow_queue,
+    anomaly_queue,
+    meta_alert_queue,
+]
+
+# Levels with a Broker topic: raw queue, batch parser, parsed queue and the
+# name of the parser histogram. Packets are parsed into a columnar
+# PacketBatch, which gives the packets when iterated.
+LEVELS = ["packet", "operation", "data_value"]
+PARSE_STAGES = {
+    "packet": (raw_packet_queue, PARSERS["packet"], packet_queue, "Packet parser"),
+    "operation": (raw_operation_queue, PARSERS["operation"], operation_queue, "Operation parser"),
+    "data_value": (raw_data_value_queue, PARSERS["data_value"], data_value_queue, "Content parser"),
+}
+
+# Raw queue of each Broker topic with events to parse
+TOPIC_QUEUES = dict((LEVEL_TOPICS[level], PARSE_STAGES[level][0]) for level in LEVELS)
+
+# Decoder of each service whose operations and data values are read from
+# traces
+PCAP_DECODERS = {
+    "DNP3_TCP": Dnp3Decoder,
+    "MODBUS": ModbusDecoder,
+}
+
+# Default pipeline topology; topology.json overrides any of its settings.
+#   <level>.enabled  run the parsers and analyzer of the level
+#   <level>.parsers  parser greenlets sharing the raw queue of the level
+#   <level>.fused    parse and analyze in one stage, skipping the parsed queue
+#   <level>.process  parse in a worker process that takes the events from
+#                    Broker or the replayed log itself
+#   flow.enabled     analyze the flows aggregated by the packet analyzer
+#   shards           analyzer worker processes, 0 analyzes in this process
+#   max_batch        largest number of queued items a stage takes per wakeup
+#   queues           [capacity, policy, priority] of any queue
+#   checkpoint       directory (null disables checkpoints), period in traffic
+#                    seconds, deltas_per_snapshot, and whether to restore the
+#                    last checkpoint on start
+#   novelty          sketch to count the addresses, protocols and services of
+#                    the NEW_* anomalies in fixed-size Count-Min sketches of
+#                    width by depth counts, with hot_keys exact keys, instead
+#                    of dictionaries
+DEFAULT_TOPOLOGY = {
+    "packet": {"enabled": True, "parsers": 1, "fused": False, "process": False},
+    "operation": {"enabled": True, "parsers": 1, "fused": False, "process": False},
+    "data_value": {"enabled": True, "parsers": 1, "fused": False, "process": False},
+    "flow": {"enabled": True},
+    "shards": 0,
+    "max_batch": 256,
+    "raw_queue_capacity": RAW_QUEUE_CAPACITY,
+    "queues": {},
+    "checkpoint": {
+        "directory": None,
+        "period": CHECKPOINT_PERIOD,
+        "deltas_per_snapshot": DELTAS_PER_SNAPSHOT,
+        "restore": True,
+    },
+    "novelty": {
+        "sketch": False,
+        "width": SKETCH_WIDTH,
+        "depth": SKETCH_DEPTH,
+        "hot_keys": MAX_HOT_KEYS,
+    },
+}
+TOPOLOGY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "topology.json")
+
+topology = copy.deepcopy(DEFAULT_TOPOLOGY)
+
+# Local port of the metrics endpoint
+METRICS_PORT = 9997
+
+metrics = MetricsServer(METRICS_PORT)
+metrics.addSource("queues", lambda: dict((queue.name, queue.getStats()) for queue in stage_queues))
+
+
+def load_topology(path):
+    result = copy.deepcopy(DEFAULT_TOPOLOGY)
+    if os.path.exists(path):
+        with open(path) as topology_file:
+            settings = json.load(topology_file)
+        for key, value in settings.items():
+            if key not in result:
+                raise ValueError("Unknown topology setting: " + key)
+            if isinstance(result[key], dict):
+                result[key].update(value)
+            else:
+                result[key] = value
+    for level in LEVELS:
+        if result[level]["parsers"] < 1:
+            raise ValueError("The {} level needs at least one parser".format(level))
+        if result[level]["fused"] and result[level]["parsers"] > 1:
+            raise ValueError("A fused {} stage runs a single parser".format(level))
+        if result[level]["process"] and (result[level]["fused"] or result[level]["parsers"] > 1):
+            raise ValueError("The {} level is parsed by a single worker process".format(level))
+    if not any(result[level]["enabled"] for level in LEVELS):
+        raise ValueError("No level is enabled")
+    return result
+
+
+def novelty_sketch():
+    # Settings of the novelty counters, or None for dictionaries
+    settings = dict(topology["novelty"])
+    if not settings.pop("sketch"):
+        return None
+    return settings
+
+
+def configure_queues():
+    raw_queue_group.capacity = topology["raw_queue_capacity"]
+    for queue in stage_queues:
+        maxsize, policy, priority = topology["queues"].get(queue.name, QUEUE_CONFIG[queue.name])
+        queue.configure(maxsize, policy, priority, raw_queue_group)
+
+    # Nothing reads the queues of a disabled stage
+    disabled = []
+    if not topology["packet"]["enabled"]:
+        disabled += [raw_packet_queue, packet_queue, flow_queue]
+    if not topology["flow"]["enabled"]:
+        disabled += [flow_queue]
+    if not topology["operation"]["enabled"]:
+        disabled += [raw_operation_queue, operation_queue]
+    if not topology["data_value"]["enabled"]:
+        disabled += [raw_data_value_queue, data_value_queue]
+    # nor the raw queue of a level parsed in a worker process
+    for level in process_levels():
+        disabled.append(PARSE_STAGES[level][0])
+    for queue in disabled:
+        queue.configure(policy=DISCARD)
+
+
+def process_levels():
+    return [level for level in LEVELS if topology[level]["enabled"] and topology[level]["process"]]
+
+
+def local_topics():
+    # Topics of the events parsed in this process
+    return [LEVEL_TOPICS[level] for level in LEVELS if level not in process_levels()]
+
+
+# Every stage forwards the end-of-stream sentinel STOP downstream. A producer
+# sends one STOP to each consumer of its queue and a consumer stops once it
+# has received one from each of its producers.
+def drain(queue, producers=1):
+    # Block on the queue and yield items until every producer has sent STOP
+    while producers > 0:
+        item = queue.get()
+        if item is STOP:
+            producers -= 1
+        else:
+            yield item
+
+
+def drain_batch(queue, producers=1):
+    # Block for one item, then take whatever else is already queued. The
+    # batch size follows the queue depth, up to max_batch, and the stage
+    # yields to the other greenlets once per batch.
+    max_batch = topology["max_batch"]
+    while producers > 0:
+        batch = []
+        item = queue.get()
+        size = min(queue.qsize(), max_batch - 1)
+        while True:
+            if item is STOP:
+                producers -= 1
+                if producers == 0:
+                    break
+            else:
+                batch.append(item)
+            if size == 0:
+                break
+            item = queue.get_nowait()
+            size -= 1
+        if batch:
+            yield batch
+            gevent.sleep(0)
+
+
+def make_checkpointer(name, anl):
+    settings = topology["checkpoint"]
+    if settings["directory"] == None:
+        return None
+    checkpointer = Checkpointer(settings["directory"],
+                                name,
+                                {"anomaly_queue": anomaly_queue, "flow_queue": flow_queue},
+                                settings["period"],
+                                settings["deltas_per_snapshot"])
+    if settings["restore"]:
+        start = timeit.default_timer()
+        ts = checkpointer.restore(anl)
+        if ts != None:
+            print("Restored {} at traffic time {} in {:.2f}s".format(name, ts, timeit.default_timer() - start))
+    return checkpointer
+
+
+def checkpointed(batches, anl, checkpointer, get_ts):
+    # Split the batches where traffic time crosses a checkpoint boundary and
+    # checkpoint the analyzer there, after the items before the boundary. A
+    # last checkpoint is taken at the end of the stream.
+    if checkpointer == None:
+        for batch in batches:
+            yield batch
+        return
+    ts = None
+    for batch in batches:
+        while checkpointer.isDue(get_ts(batch[-1])):
+            i = 0
+            while not checkpointer.isDue(get_ts(batch[i])):
+                i += 1
+            if i > 0:
+                yield batch[:i]
+            checkpointer.save(anl, get_ts(batch[i]))
+            batch = batch[i:]
+        ts = get_ts(batch[-1])
+        yield batch
+    if ts != None:
+        checkpointer.save(anl, ts)
+
+
+def stop_raw_queues():
+    for level in LEVELS:
+        raw_queue = PARSE_STAGES[level][0]
+        for i in range(topology[level]["parsers"]):
+            raw_queue.put(STOP)
+
+
+def listener(record_path=None):
+    recorder = None
+    if record_path != None:
+        recorder = EventRecorder(record_path)
+        if process_levels():
+            print("Events parsed in worker processes are not recorded")
+    # The endpoint forwards the other topics to the parse workers peering
+    # with it
+    topics = local_topics()
     ep = broker.Endpoint()
-    sub = ep.make_subscriber("edmand")
+    sub = ep.make_subscriber(topics + [DONE_TOPIC])
     ep.listen("127.0.0.1", 9999)
 
-    total_time = 0
-    count = 0
-    while True:
-        (t, msg)= sub.get()
+    # Bro publishes one event per packet, so every wakeup takes all the
+    # messages that are ready and hands them to each raw queue in one put
+    histogram = get_histogram("Listener")
+    batches = dict((t, []) for t in topics)
+    done = False
+    while not done:
+        select.select([sub.fd()], [], [])
+        messages = sub.poll()
         start = timeit.default_timer()
-        t = str(t) 
-        ev = broker.bro.Event(msg)
-        if t == "edmand/packet_get":
-            raw_packet_queue.put_nowait(ev.args())
-        if t == "edmand/protocol_get":
-            raw_operation_queue.put_nowait(ev.args())
-        if t == "edmand/data_get":
-            raw_data_value_queue.put_nowait(ev.args())
-        if t == "edmand/bro_done":
-            ep.shutdown()
-            #print("Listener quit!")
-            if count != 0:
-                print("Listener time: " + str(total_time/count))
-                return;
-        #print("got message")
-        total_time += timeit.default_timer() - start
-        count += 1
+        for t, msg in messages:
+            batch = batches.get(t)
+            if batch != None:
+                args = broker.bro.Event(msg).args()
+                if recorder != None:
+                    recorder.record(t, args)
+                batch.append(args)
+            elif t == DONE_TOPIC:
+                done = True
+                break
+        for t, batch in batches.items():
+            if batch:
+                TOPIC_QUEUES[t].putMany(batch)
+                batches[t] = []
+        if messages:
+            histogram.record((timeit.default_timer() - start) / len(messages), len(messages))
         gevent.sleep(0)
 
+    ep.shutdown()
+    if recorder != None:
+        recorder.close()
+        print("Recorded events: " + str(recorder.count))
+    stop_raw_queues()
+    #print("Listener quit!")
+    if histogram.count != 0:
+        print(histogram)
 
-def packet_parser(n):
-    countdown = COUNT_INIT
-    total_time = 0
-    count = 0
-    while countdown > 0:
-        try:
-            while True:
-                #print(count)
-                raw_packet = raw_packet_queue.get_nowait()
-                start = timeit.default_timer()
-                packet = parse_packet(raw_packet)
-                packet_queue.put_nowait(packet)
-                total_time += timeit.default_timer() - start
-                count += 1
-                countdown = COUNT_INIT
-                gevent.sleep(0)
-        except Empty:
-            countdown -= 1
-            gevent.sleep(0.01)
-    #print('Packet parser %s quit!' % (n))
-    if count != 0:
-        print("Packet parser time: " + str(total_time/count))
-
-
-def operation_parser(n):
-    countdown = COUNT_INIT
-    total_time = 0
-    count = 0
-    while countdown > 0:
-        try:
-            while True:
-                #print(count)
-                raw_operation = raw_operation_queue.get_nowait()
-                start = timeit.default_timer()
-                operation = parse_operation(raw_operation)
-                operation_queue.put_nowait(operation)
-                total_time += timeit.default_timer() - start
-                count += 1
-                countdown = COUNT_INIT
-                gevent.sleep(0)
-        except Empty:
-            countdown -= 1
-            gevent.sleep(0.01)
-    #print('Operation parser %s quit!' % (n))
-    if count != 0:
-        print("Operation parser time: " + str(total_time/count))
-
-
-def data_value_parser(n):
-    countdown = COUNT_INIT
-    total_time = 0
+
+def replayer(path):
+    # Feed a recorded event log through the raw queues as fast as the parsers
+    # take it. The raw queues shed load when full, so the replayer waits for
+    # room instead to keep the run identical to the recording.
+    max_batch = topology["max_batch"]
     count = 0
-    while countdown > 0:
-        try:
-            while True:
-                #print(count)
-                raw_data_value = raw_data_value_queue.get_nowait()
-                start = timeit.default_timer()
-                data_value = parse_data_value(raw_data_value)
-                data_value_queue.put_nowait(data_value)
-                total_time += timeit.default_timer() - start
-                count += 1
-                countdown = COUNT_INIT
-                gevent.sleep(0)
-        except Empty:
-            countdown -= 1
-            gevent.sleep(0.01)
-    #print('Data value parser %s quit!' % (n))
-    if count != 0:
-        print("Content parser time: " + str(total_time/count))
+    for t, args in read_events(path, local_topics()):
+        queue = TOPIC_QUEUES[t]
+        queue.waitForRoom()
+        queue.put_nowait(args)
+        count += 1
+        if count % max_batch == 0:
+            gevent.sleep(0)
+    stop_raw_queues()
+    print("Replayed events: " + str(count))
+
+
+def parsed_batches(level, name):
+    # Parse the raw events of a level one batch at a time. A fused packet
+    # stage hands each PacketBatch to the analyzer as it is.
+    raw_queue, parse, parsed_queue, label = PARSE_STAGES[level]
+    histogram = get_histogram(name)
+    for raw_items in drain_batch(raw_queue):
+        start = timeit.default_timer()
+        items = parse(raw_items)
+        histogram.record((timeit.default_timer() - start) / len(raw_items), len(raw_items))
+        yield items
+    if histogram.count != 0:
+        print(histogram)
+
+
+# Parser workers of a level hand their batches over in the order they took
+# them from the raw queue
+emit_locks = dict((level, Semaphore()) for level in LEVELS)
+
+
+def parser(n, level):
+    raw_queue, parse, parsed_queue, label = PARSE_STAGES[level]
+    name = label
+    if topology[level]["parsers"] > 1:
+        name = "{} {}".format(label, n)
+    emit_lock = emit_locks[level]
+    for items in parsed_batches(level, name):
+        with emit_lock:
+            parsed_queue.putMany(list(items))
+    parsed_queue.put(STOP)
+    #print('%s %s quit!' % (label, n))
 
 
 def traffic_generator(n):
     generator = TrafficGenerator(packet_queue, operation_queue, data_value_queue)
     generator.generate()
+    packet_queue.put(STOP)
+    operation_queue.put(STOP)
+    data_value_queue.put(STOP)
     print('Traffic generator %s quit!' % (n))
 
 
-def packet_analyzer(n):
-    countdown = COUNT_INIT
-    anl = PacketAnalyzer(anomaly_queue, flow_queue)
-    packet_time = [] 
+def put_decoded(packets, reader):
+    operations, data_values = reader.takeDecoded()
+    for queue, items in [(packet_queue, packets), (operation_queue, operations), (data_value_queue, data_values)]:
+        if items:
+            queue.putMany(items)
+    return len(operations) + len(data_values)
+
+
+def pcap_reader(path):
+    # Read packets straight from a trace, without Bro, into the packet queue,
+    # and the operations and data values of the services with a decoder into
+    # theirs
+    reader = PcapReader(path, PCAP_DECODERS)
+    max_batch = topology["max_batch"]
     count = 0
-    while countdown > 0:
-        try:
-            while True:
-                packet = packet_queue.get_nowait()
-                #print(packet)
-                start = timeit.default_timer()
-                anl.analyze(packet)
-                packet_time.append(timeit.default_timer() - start)
-                count += 1
-                countdown = COUNT_INIT
-                gevent.sleep(0)
-        except Empty:
-            countdown -= 1
-            gevent.sleep(0.01)
+    decoded = 0
+    batch = []
+    for packet in reader.packets():
+        batch.append(packet)
+        if len(batch) == max_batch:
+            count += len(batch)
+            decoded += put_decoded(batch, reader)
+            batch = []
+            gevent.sleep(0)
+    count += len(batch)
+    decoded += put_decoded(batch, reader)
+    reader.close()
+    packet_queue.put(STOP)
+    operation_queue.put(STOP)
+    data_value_queue.put(STOP)
+    print("Read packets: " + str(count))
+    print("Decoded operations and data values: " + str(decoded))
+
+
+def packet_analyzer(n, batches):
+    anl = PacketAnalyzer(anomaly_queue, flow_queue, novelty_sketch=novelty_sketch())
+    checkpointer = make_checkpointer("packet_analyzer", anl)
+    metrics.addSource("packet_analyzer", anl.getStateSize)
+    histogram = get_histogram("Packet analyzer")
+    for packets in checkpointed(batches, anl, checkpointer, lambda packet: packet.ts):
+        start = timeit.default_timer()
+        anl.analyzeBatch(packets)
+        histogram.record((timeit.default_timer() - start) / len(packets), len(packets))
+    flow_queue.put(STOP)
+    anomaly_queue.put(STOP)
     #print('Packet analyzer %s quit!' % (n))
-    if count != 0:
-        packet_array = numpy.array([packet_time])
-        print("Packet analyzer time: " + str(numpy.mean(packet_array, axis=1)))
-        print("Packet analyzer num: " + str(len(packet_time)))
-        print("Packet analyzer std: " + str(numpy.std(packet_array, axis=1)))
+    if histogram.count != 0:
+        print(histogram)
 
 
-def flow_analyzer(n):
-    countdown = COUNT_INIT
+def flow_analyzer(n, batches):
     anl = FlowAnalyzer(anomaly_queue)
-    flow_time = [] 
-    count = 0
-    while countdown > 0:
-        try:
-            while True:
-                flow = flow_queue.get_nowait()
-                #print(flow)
-                start = timeit.default_timer()
-                anl.analyze(flow)
-                flow_time.append(timeit.default_timer() - start)
-                count += 1
-                countdown = COUNT_INIT
-                gevent.sleep(0)
-        except Empty:
-            countdown -= 1
-            gevent.sleep(0.01)
+    checkpointer = make_checkpointer("flow_analyzer", anl)
+    metrics.addSource("flow_analyzer", anl.getStateSize)
+    histogram = get_histogram("Flow analyzer")
+    for flows in checkpointed(batches, anl, checkpointer, lambda flow: flow.end):
+        start = timeit.default_timer()
+        anl.analyzeBatch(flows)
+        histogram.record((timeit.default_timer() - start) / len(flows), len(flows))
+    anomaly_queue.put(STOP)
     #print('Flow analyzer %s quit!' % (n))
-    if count != 0:
-        flow_array = numpy.array([flow_time])
-        print("Flow analyzer time: " + str(numpy.mean(flow_array, axis=1)))
-        print("Flow analyzer num: " + str(len(flow_time)))
-        print("Flow analyzer std: " + str(numpy.std(flow_array, axis=1)))
+    if histogram.count != 0:
+        print(histogram)
 
 
-def operation_analyzer(n):
-    countdown = COUNT_INIT
+def operation_analyzer(n, batches):
     anl = OperationAnalyzer(anomaly_queue)
-    operation_time = [] 
-    count = 0
-    while countdown > 0:
-        try:
-            while True:
-                operation = operation_queue.get_nowait()
-                #print(operation)
-                start = timeit.default_timer()
-                anl.analyze(operation)
-                operation_time.append(timeit.default_timer() - start)
-                count += 1
-                countdown = COUNT_INIT
-                gevent.sleep(0)
-        except Empty:
-            countdown -= 1
-            gevent.sleep(0.01)
+    checkpointer = make_checkpointer("operation_analyzer", anl)
+    metrics.addSource("operation_analyzer", anl.getStateSize)
+    histogram = get_histogram("Operation analyzer")
+    for operations in checkpointed(batches, anl, checkpointer, lambda operation: operation.ts):
+        start = timeit.default_timer()
+        anl.analyzeBatch(operations)
+        histogram.record((timeit.default_timer() - start) / len(operations), len(operations))
+    anomaly_queue.put(STOP)
     #print('Operation analyzer %s quit!' % (n))
-    if count != 0:
-        operation_array = numpy.array([operation_time])
-        print("Operation analyzer time: " + str(numpy.mean(operation_array, axis=1)))
-        print("Operation analyzer num: " + str(len(operation_time)))
-        print("Operation analyzer std: " + str(numpy.std(operation_array, axis=1)))
+    if histogram.count != 0:
+        print(histogram)
 
 
-def data_value_analyzer(n):
-    countdown = COUNT_INIT
+def data_value_analyzer(n, batches):
     anl = DataAnalyzer(anomaly_queue)
-    content_time = []
-    count = 0
-    while countdown > 0:
-        try:
-            while True:
-                data_value = data_value_queue.get_nowait()
-                #print(data_value)
-                start = timeit.default_timer()
-                anl.analyze(data_value)
-                content_time.append(timeit.default_timer() - start)
-                count += 1
-                countdown = COUNT_INIT
-                gevent.sleep(0)
-        except Empty:
-            countdown -= 1
-            gevent.sleep(0.01)
+    checkpointer = make_checkpointer("data_value_analyzer", anl)
+    metrics.addSource("data_value_analyzer", anl.getStateSize)
+    histogram = get_histogram("Content analyzer")
+    for data_values in checkpointed(batches, anl, checkpointer, lambda data_value: data_value.ts):
+        start = timeit.default_timer()
+        anl.analyzeBatch(data_values)
+        histogram.record((timeit.default_timer() - start) / len(data_values), len(data_values))
+    anomaly_queue.put(STOP)
     #print('Data value analyzer %s quit!' % (n))
-    if count != 0:
-        content_array = numpy.array([content_time])
-        print("Content analyzer time: " + str(numpy.mean(content_array, axis=1)))
-        print("Content analyzer num: " + str(len(content_time)))
-        print("Content analyzer std: " + str(numpy.std(content_array, axis=1)))
+    if histogram.count != 0:
+        print(histogram)
 
 
-def anomaly_manager(n):
-    countdown = COUNT_INIT
-    mng = AnomalyManager(meta_alert_queue)
-    manager_time = [] 
+# The routers send their batches to the shards once the queue they read from
+# runs empty
+def packet_router(n, pool, batches, queue):
+    histogram = get_histogram("Packet router")
+    for packets in batches:
+        start = timeit.default_timer()
+        for packet in packets:
+            pool.routePacket(packet)
+        if queue.empty():
+            pool.flush()
+        histogram.record((timeit.default_timer() - start) / len(packets), len(packets))
+    pool.close()
+    anomaly_queue.put(STOP)
+    if histogram.count != 0:
+        print(histogram)
+
+
+def operation_router(n, pool, batches, queue):
+    histogram = get_histogram("Operation router")
+    for operations in batches:
+        start = timeit.default_timer()
+        for operation in operations:
+            pool.routeOperation(operation)
+        if queue.empty():
+            pool.flush()
+        histogram.record((timeit.default_timer() - start) / len(operations), len(operations))
+    pool.close()
+    if histogram.count != 0:
+        print(histogram)
+
+
+def data_value_router(n, pool, batches, queue):
+    histogram = get_histogram("Content router")
+    for data_values in batches:
+        start = timeit.default_timer()
+        for data_value in data_values:
+            pool.routeDataValue(data_value)
+        if queue.empty():
+            pool.flush()
+        histogram.record((timeit.default_timer() - start) / len(data_values), len(data_values))
+    pool.close()
+    if histogram.count != 0:
+        print(histogram)
+
+
+def shard_collector(n, pool):
+    # The worker queue is read from the hub's thread pool so that waiting
+    # for the shards does not block the other greenlets
+    threadpool = gevent.get_hub().threadpool
+    remaining = pool.num_shards
     count = 0
-    while countdown > 0:
-        try:
-            while True:
-                anomaly = anomaly_queue.get_nowait()
-                start = timeit.default_timer()
-                mng.manage(anomaly)
-                manager_time.append(timeit.default_timer() - start)
-                count += 1
-                countdown = COUNT_INIT
-                gevent.sleep(0)
-        except Empty:
-            countdown -= 1
-            gevent.sleep(0.01)
+    while remaining > 0:
+        anomalies = threadpool.apply(pool.out_queue.get)
+        if anomalies is None:
+            remaining -= 1
+            continue
+        for anomaly in anomalies:
+            anomaly_queue.put_nowait(anomaly)
+        count += len(anomalies)
+    pool.join()
+    anomaly_queue.put(STOP)
+    print("Shard collector num: " + str(count))
+
+
+def anomaly_manager(n, producers):
+    mng = AnomalyManager(meta_alert_queue)
+    histogram = get_histogram("Anomaly Manager")
+    for anomalies in drain_batch(anomaly_queue, producers):
+        start = timeit.default_timer()
+        mng.manageBatch(anomalies)
+        histogram.record((timeit.default_timer() - start) / len(anomalies), len(anomalies))
     #mng.print_alerts()
     mng.stop()
+    mng.flush()
+    meta_alert_queue.put(STOP)
     #print('Anomaly Manager %s quit!' % (n))
-    if count != 0:
-        manager_array = numpy.array([manager_time])
-        print("Anomaly Manager time: " + str(numpy.mean(manager_array, axis=1)))
-        print("Anomaly Manager num: " + str(len(manager_time)))
-        print("Anomaly Manager std: " + str(numpy.std(manager_array, axis=1)))
+    if histogram.count != 0:
+        print(histogram)
 
 
 def alert_sender(n):
-    countdown = COUNT_INIT
     client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client.connect(("127.0.0.1", 9998))
-    while countdown > 0:
-        try:
-            while True:
-                meta_alert = meta_alert_queue.get_nowait()
-                #pprint(meta_alert)
-                data = pickle.dumps(meta_alert)
-                client.send(data)
-                ack = client.recv(512)
-                assert(ack == "ACK")
-                countdown = COUNT_INIT
-                gevent.sleep(0)
-        except Empty:
-            countdown -= 1
-            gevent.sleep(0.01)
+    for meta_alert in drain(meta_alert_queue):
+        #pprint(meta_alert)
+        data = pickle.dumps(meta_alert)
+        client.sendall(data)
+        ack = client.recv(512)
+        assert(ack == "ACK")
     print('Alert sender %s quit!' % (n))
     client.close()
 
 
+def start_parse_processes(log_path=None):
+    # Fork the parse workers while this process has no Broker endpoint,
+    # listening socket or threadpool thread yet, none of which a forked
+    # child may inherit; each worker makes its own endpoint
+    processes = dict()
+    for level in process_levels():
+        label = PARSE_STAGES[level][3]
+        process = ParseProcess(level, label, topology["max_batch"], log_path)
+        process.start()
+        processes[level] = process
+    return processes
+
+
+def parse_process(level, process):
+    # Hand the batches of a parse worker over to the parsed queue
+    raw_queue, parse, parsed_queue, label = PARSE_STAGES[level]
+    for items in process.batches():
+        parsed_queue.putMany(list(items))
+    parsed_queue.put(STOP)
+
+
+def parsers(processes):
+    greenlets = []
+    for level in LEVELS:
+        settings = topology[level]
+        if not settings["enabled"] or settings["fused"]:
+            continue
+        if settings["process"]:
+            greenlets.append(gevent.spawn(parse_process, level, processes[level]))
+        else:
+            for n in range(1, settings["parsers"] + 1):
+                greenlets.append(gevent.spawn(parser, n, level))
+    return greenlets
+
+
+def source(level, simulated):
+    # Batches of parsed items for the analyzer or router of a level, and the
+    # queue they are taken from. The traffic generator fills the parsed
+    # queues directly, so only Broker events can be parsed in a fused stage.
+    raw_queue, parse, parsed_queue, label = PARSE_STAGES[level]
+    if simulated:
+        return drain_batch(parsed_queue), parsed_queue
+    if topology[level]["fused"]:
+        return parsed_batches(level, label), raw_queue
+    return drain_batch(parsed_queue, topology[level]["parsers"]), parsed_queue
+
+
+def start_shard_pool():
+    # The analyzer processes of sharded mode, forked before the metrics
+    # server binds its socket for the same reason as the parse workers
+    if topology["shards"] == 0:
+        return None
+    enabled = [level for level in LEVELS if topology[level]["enabled"]]
+    analyze_flows = "packet" in enabled and topology["flow"]["enabled"]
+    return ShardPool(topology["shards"], anomaly_queue, len(enabled), analyze_flows, novelty_sketch())
+
+
+def analyzers(simulated, pool=None):
+    # Either one greenlet per analyzer, or routers feeding the pool of
+    # analyzer processes whose anomaly streams are merged by a collector
+    enabled = [level for level in LEVELS if topology[level]["enabled"]]
+    analyze_flows = "packet" in enabled and topology["flow"]["enabled"]
+    greenlets = []
+    if pool == None:
+        stages = {
+            "packet": packet_analyzer,
+            "operation": operation_analyzer,
+            "data_value": data_value_analyzer,
+        }
+        for level in enabled:
+            batches, queue = source(level, simulated)
+            greenlets.append(gevent.spawn(stages[level], 1, batches))
+        if analyze_flows:
+            greenlets.append(gevent.spawn(flow_analyzer, 1, drain_batch(flow_queue)))
+        producers = len(enabled) + int(analyze_flows)
+    else:
+        print("Sharded analyzers: " + str(pool.num_shards))
+        if topology["checkpoint"]["directory"] != None:
+            print("Checkpoints are not taken in sharded mode")
+        metrics.addSource("shard_pool", pool.getStateSize)
+        stages = {
+            "packet": packet_router,
+            "operation": operation_router,
+            "data_value": data_value_router,
+        }
+        for level in enabled:
+            batches, queue = source(level, simulated)
+            greenlets.append(gevent.spawn(stages[level], 1, pool, batches, queue))
+        greenlets.append(gevent.spawn(shard_collector, 1, pool))
+        # The packet router reports novelty anomalies itself
+        producers = 1 + int("packet" in enabled)
+    greenlets.append(gevent.spawn(anomaly_manager, 1, producers))
+    return greenlets
+
+
+# Usage:
+#   python edmand.py real [num_shards] [record_log]
+#   python edmand.py replay <record_log> [num_shards]
+#   python edmand.py pcap <trace> [num_shards]
+#   python edmand.py simulate [num_shards]
+# The rest of the pipeline is set up by topology.json.
 def main():
-    if sys.argv[1] == "real":
+    mode = sys.argv[1]
+    args = sys.argv[2:]
+    log_path = None
+    if mode == "replay" or mode == "pcap":
+        log_path = args.pop(0)
+    topology.update(load_topology(TOPOLOGY_FILE))
+    if len(args) > 0:
+        topology["shards"] = int(args[0])
+    if mode == "real" and len(args) > 1:
+        log_path = args[1]
+    configure_queues()
+    processes = dict()
+    if mode == "real":
+        processes = start_parse_processes()
+    elif mode == "replay":
+        processes = start_parse_processes(log_path)
+    pool = start_shard_pool()
+    gevent.signal_handler(signal.SIGUSR1, report)
+    metrics.start()
+
+    if mode == "real":
         print("Real Traffic")
         gevent.joinall([
-            gevent.spawn(listener),
-            gevent.spawn(packet_parser, 1),
-            gevent.spawn(operation_parser, 1),
-            gevent.spawn(data_value_parser, 1),
-            gevent.spawn(packet_analyzer, 1),
-            gevent.spawn(flow_analyzer, 1),
-            gevent.spawn(operation_analyzer, 1),
-            gevent.spawn(data_value_analyzer, 1),
-            gevent.spawn(anomaly_manager, 1),
+            gevent.spawn(listener, log_path),
+        ] + parsers(processes) + analyzers(False, pool) + [
+            gevent.spawn(alert_sender, 1),
+        ])
+    elif mode == "replay":
+        print("Replayed Traffic")
+        gevent.joinall([
+            gevent.spawn(replayer, log_path),
+        ] + parsers(processes) + analyzers(False, pool) + [
+            gevent.spawn(alert_sender, 1),
+        ])
+    elif mode == "pcap":
+        print("Trace Traffic")
+        gevent.joinall([
+            gevent.spawn(pcap_reader, log_path),
+        ] + analyzers(True, pool) + [
             gevent.spawn(alert_sender, 1),
         ])
     else:
         print("Simulated Traffic")
         gevent.joinall([
             gevent.spawn(traffic_generator, 1),
-            gevent.spawn(packet_analyzer, 1),
-            gevent.spawn(flow_analyzer, 1),
-            gevent.spawn(operation_analyzer, 1),
-            gevent.spawn(data_value_analyzer, 1),
-            gevent.spawn(anomaly_manager, 1),
+        ] + analyzers(True, pool) + [
             gevent.spawn(alert_sender, 1),
         ])
+
+    for queue in stage_queues:
+        print(queue)
+    metrics.stop()
  
 
 if __name__ == '__main__': main()
@@ -1,6 +1,26 @@
 import datetime
+from record import Record
+from ip_address import ip_text
+
+class Flow(Record):
+    __slots__ = ("start",
+                 "end",
+                 "orig",
+                 "resp",
+                 "protocol_type",
+                 "service",
+                 "tcp_flag_most",
+                 "count_pkt_ab",
+                 "count_pkt_ba",
+                 "mean_bytes_ab",
+                 "std_bytes_ab",
+                 "mean_bytes_ba",
+                 "std_bytes_ba",
+                 "mean_iat_ab",
+                 "std_iat_ab",
+                 "mean_iat_ba",
+                 "std_iat_ba")
 
-class Flow:
     def __init__(self,
                 start=None,
                 end=None,
@@ -42,8 +62,8 @@ class Flow:
     def getDict(self):
         rst = {"start": self.start,
                "end": self.end,
-               "orig": self.orig,
-               "resp": self.resp,
+               "orig": ip_text(self.orig),
+               "resp": ip_text(self.resp),
                "protocol_type": self.protocol_type,
                "serivce": self.service,
                "tcp_flag_most": self.tcp_flag_most,
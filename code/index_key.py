@@ -0,0 +1,57 @@
+# Separator of the fields in the string form of an index
+SEPARATOR = ";"
+# Field of an aggregated index that differs between the merged anomalies
+ANY = "-"
+
+
+def format_field(field):
+    # A tuple field is the service list of a packet, shown as Bro's list
+    if type(field) is tuple:
+        return str(list(field))
+    return str(field)
+
+
+class IndexKey(tuple):
+    # Index of an analyzer model and of the anomalies it reports: the fields
+    # that identify the model, in a tuple that hashes and compares without
+    # building a string. Each model keeps the first key built for it, so the
+    # anomalies of a model share one key. The ';'-joined string stored in
+    # Mongo and read by CAPTAR is only made by str().
+    __slots__ = ()
+
+
+    def __str__(self):
+        return SEPARATOR.join(format_field(field) for field in self)
+
+
+    def __repr__(self):
+        return "IndexKey(" + tuple.__repr__(self) + ")"
+
+
+    def getField(self, i):
+        return format_field(self[i])
+
+
+def packet_index(orig, resp, protocol, service_list):
+    return IndexKey((orig, resp, protocol, tuple(service_list)))
+
+
+def flow_index(flow):
+    return IndexKey((flow.orig, flow.resp, flow.protocol_type, flow.service))
+
+
+def operation_index(operation):
+    return IndexKey((operation.orig_ip, operation.resp_ip, operation.service, operation.uid))
+
+
+def function_index(index, fc):
+    return IndexKey(index + (fc,))
+
+
+def data_value_index(data_value):
+    return IndexKey((data_value.holder_ip, data_value.protocol, data_value.uid, data_value.data_type, data_value.index))
+
+
+def split_index(index):
+    # Fields of the string form of an index, as stored in Mongo
+    return index.split(SEPARATOR)
@@ -0,0 +1,155 @@
+import socket
+import struct
+
+# IPv4 addresses are kept as IPv4-mapped IPv6 addresses, ::ffff:a.b.c.d, so
+# that both families share one integer space
+IPV4_MAPPED = 0xffff << 32
+IPV4_MASK = 0xffffffff
+U64_MASK = (1 << 64) - 1
+
+# Addresses parsed before the intern table is cleared
+MAX_ADDRESSES = 65536
+ADDRESSES = dict()
+
+
+class IPAddress(long):
+    # An IP address as an integer, interned by ip_address() so that the
+    # records of a host share one object. It hashes and compares as a number,
+    # and str() gives the dotted or colon form that Mongo and CAPTAR store.
+    __slots__ = ()
+
+
+    def isIPv4(self):
+        return self >> 32 == 0xffff
+
+
+    def __str__(self):
+        if self >> 32 == 0xffff:
+            return socket.inet_ntop(socket.AF_INET, struct.pack(">I", self & IPV4_MASK))
+        return socket.inet_ntop(socket.AF_INET6, struct.pack(">QQ", self >> 64, self & U64_MASK))
+
+
+    def __repr__(self):
+        return "IPAddress('" + str(self) + "')"
+
+
+    def __reduce__(self):
+        return (ip_address, (str(self),))
+
+
+def ip_from_bytes(raw):
+    # Address from the 4 or 16 bytes of an IP header
+    if len(raw) == 4:
+        return IPAddress(IPV4_MAPPED | struct.unpack(">I", raw)[0])
+    high, low = struct.unpack(">QQ", raw)
+    return IPAddress(high << 64 | low)
+
+
+def ip_address(text):
+    address = ADDRESSES.get(text)
+    if address == None:
+        try:
+            if ":" in text:
+                address = ip_from_bytes(socket.inet_pton(socket.AF_INET6, text))
+            else:
+                address = ip_from_bytes(socket.inet_pton(socket.AF_INET, text))
+        except socket.error:
+            raise ValueError("Invalid IP address: {}".format(text))
+        if len(ADDRESSES) >= MAX_ADDRESSES:
+            ADDRESSES.clear()
+        ADDRESSES[text] = address
+    return address
+
+
+def ip_text(address):
+    # Form of an address in a dictionary sent to Mongo; sources that build
+    # records from strings pass them through unchanged
+    if address == None:
+        return None
+    return str(address)
+
+
+def conn_text(conn):
+    # Connection tuple of a packet with its addresses in string form
+    if conn == None:
+        return None
+    return (ip_text(conn[0]), conn[1], ip_text(conn[2]), conn[3])
+
+
+def common_octets(ip1, ip2):
+    # Number of leading octets two IPv4 addresses share, 0 to 4. IPv6
+    # addresses are compared by 32-bit words so that the result keeps the
+    # same scale, and addresses of different families share none.
+    diff = ip1 ^ ip2
+    if diff >> 32 == 0 and ip1 >> 32 == 0xffff:
+        return (32 - diff.bit_length()) >> 3
+    return (128 - diff.bit_length()) >> 5
+
+
+class NetworkTrie():
+    # Set of networks in CIDR notation, "10.0.0.0/16", or single addresses.
+    # Each family has its own trie with one level per octet, so an IPv4
+    # lookup is at most four dictionary gets. A prefix that ends inside an
+    # octet is expanded into every value of that octet it covers, and a
+    # child that is True covers everything below it.
+    def __init__(self, networks=()):
+        self.roots = {4: dict(), 6: dict()}
+        for network in networks:
+            self.add(network)
+
+
+    def add(self, network):
+        if "/" in network:
+            text, length = network.split("/")
+            length = int(length)
+        else:
+            text, length = network, None
+        address = ip_address(text)
+        if address.isIPv4():
+            family, width, value = 4, 32, address & IPV4_MASK
+        else:
+            family, width, value = 6, 128, long(address)
+        if length == None:
+            length = width
+        if length < 0 or length > width:
+            raise ValueError("Invalid prefix length: {}".format(network))
+        if length == 0:
+            self.roots[family] = True
+            return
+
+        node = self.roots[family]
+        shift = width - 8
+        while length > 8:
+            if node is True:
+                return
+            node = node.setdefault((value >> shift) & 0xff, dict())
+            length -= 8
+            shift -= 8
+        if node is True:
+            return
+        first = (value >> shift) & (0xff << (8 - length)) & 0xff
+        for octet in range(first, first + (1 << (8 - length))):
+            node[octet] = True
+
+
+    def __contains__(self, address):
+        if address == None:
+            return False
+        if not isinstance(address, IPAddress):
+            address = ip_address(address)
+        if address >> 32 == 0xffff:
+            node = self.roots[4]
+            shift = 24
+            value = address & IPV4_MASK
+        else:
+            node = self.roots[6]
+            shift = 120
+            value = address
+        while node is not True:
+            if shift < 0:
+                return False
+            node = node.get((value >> shift) & 0xff)
+            if node == None:
+                return False
+            shift -= 8
+        return True
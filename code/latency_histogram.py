@@ -0,0 +1,124 @@
+import collections
+import timeit
+
+# Latencies are recorded as integer nanoseconds in log-scaled buckets. Each
+# power of two is split into SUB_BUCKET_COUNT/2 linear sub-buckets, so every
+# recorded value is kept with a relative error below 2/SUB_BUCKET_COUNT.
+SUB_BUCKET_BITS = 7
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+# Longest latency that is told apart from the others (about 18 minutes)
+MAX_VALUE_BITS = 40
+MAX_VALUE = (1 << MAX_VALUE_BITS) - 1
+SLOT_COUNT = (MAX_VALUE_BITS - SUB_BUCKET_BITS + 2) * SUB_BUCKET_HALF
+NS = 1e9
+
+PERCENTILES = [("p50", 50.0), ("p99", 99.0), ("p999", 99.9)]
+
+
+def slot_index(value):
+    bucket = max(value.bit_length() - SUB_BUCKET_BITS, 0)
+    return bucket * SUB_BUCKET_HALF + (value >> bucket)
+
+
+def slot_value(index):
+    # Middle of the range of values that fall into the slot
+    if index < SUB_BUCKET_COUNT:
+        return index
+    bucket = index // SUB_BUCKET_HALF - 1
+    low = (index - bucket * SUB_BUCKET_HALF) << bucket
+    return low + ((1 << bucket) - 1) / 2.0
+
+
+class LatencyHistogram():
+    # Fixed-size latency histogram with throughput counters. It can be read
+    # at any time while the stage that feeds it is running.
+    def __init__(self, name):
+        self.name = name
+        self.counts = [0] * SLOT_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.first_time = None
+        self.last_time = None
+
+
+    # Record count items that each took seconds; a stage that handles a
+    # batch records the average latency of the batch once for all items
+    def record(self, seconds, count=1):
+        value = min(int(seconds * NS), MAX_VALUE)
+        if value < 0:
+            value = 0
+        self.counts[slot_index(value)] += count
+        self.count += count
+        self.total += seconds * count
+        if seconds > self.max:
+            self.max = seconds
+
+        now = timeit.default_timer()
+        if self.first_time == None:
+            self.first_time = now - seconds
+        self.last_time = now
+
+
+    def percentile(self, percent):
+        if self.count == 0:
+            return 0.0
+        rank = max(int(round(self.count * percent / 100.0)), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(slot_value(index) / NS, self.max)
+        return self.max
+
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+
+    def throughput(self):
+        # Items per second over the wall time since the first record
+        if self.count == 0 or self.last_time == self.first_time:
+            return 0.0
+        return self.count / (self.last_time - self.first_time)
+
+
+    def getStats(self):
+        stats = collections.OrderedDict()
+        stats["count"] = self.count
+        stats["mean"] = self.mean()
+        for name, percent in PERCENTILES:
+            stats[name] = self.percentile(percent)
+        stats["max"] = self.max
+        stats["throughput"] = self.throughput()
+        return stats
+
+
+    def __str__(self):
+        stats = self.getStats()
+        return "{0}: num {1}, mean {2:.3g}, p50 {3:.3g}, p99 {4:.3g}, p999 {5:.3g}, max {6:.3g}, rate {7:.1f}/s".format(
+            self.name, stats["count"], stats["mean"], stats["p50"], stats["p99"], stats["p999"], stats["max"], stats["throughput"])
+
+
+# Histograms of the process by name, in the order they were created
+histograms = collections.OrderedDict()
+
+
+def get_histogram(name):
+    if name not in histograms:
+        histograms[name] = LatencyHistogram(name)
+    return histograms[name]
+
+
+def get_all_stats():
+    return collections.OrderedDict((name, histogram.getStats()) for name, histogram in histograms.items())
+
+
+# Print every histogram; hooked to SIGUSR1 so a long run can be inspected
+# without stopping it
+def report():
+    for histogram in histograms.values():
+        print(histogram)
@@ -1,9 +1,11 @@
 import datetime
+import gevent
 import numpy as np
-import threading
 import time
 import math
+from gevent.lock import Semaphore
 from anomaly import Anomaly 
+from ip_address import NetworkTrie
 from pymongo import MongoClient
 from pprint import pprint
 
@@ -59,7 +61,8 @@ class AnomalyManager():
            "ANALOG_TOO_SMALL": 1}
 
 
-    # Critical Node List
+    # Critical Node List, addresses or whole subnets in CIDR notation such as
+    # "100.0.0.0/24"
     CNL = ["100.0.0.3"]
 
     pi = np.array([0.6, 0.4])
@@ -78,56 +81,77 @@ class AnomalyManager():
     
     def __init__(self, meta_alert_queue):
         self.meta_alert_queue = meta_alert_queue
+        self.critical_nodes = NetworkTrie(self.CNL)
+        # pymongo blocks the whole thread, so the database work runs in the
+        # hub's thread pool and only the calling greenlet waits for it. The
+        # lock keeps an alert from being rescheduled while the timers send
+        # and clear the same collection, and the meta-alerts to send are put
+        # in the queue back in the hub's thread.
+        self.threadpool = gevent.get_hub().threadpool
+        self.lock = Semaphore()
+        self.pending = []
         self.client = MongoClient()
         self.client.drop_database("alert_database")
         self.alert_db = self.client.alert_database 
         
-        self.fast_timer = threading.Timer(self.small_period, self.sendHighPriorityAlert)
-        self.fast_timer.start()
-        self.slow_timer = threading.Timer(self.large_period, self.sendLowPriorityAlert)
-        self.slow_timer.start()
+        # Timers run as greenlets so that they share the hub with the
+        # pipeline stages and can wake a blocked alert sender
+        self.fast_timer = gevent.spawn_later(self.small_period, self.sendHighPriorityAlert)
+        self.slow_timer = gevent.spawn_later(self.large_period, self.sendLowPriorityAlert)
         self.do_run = True
         
         self.current_confi_th = self.confi_high_th
         self.update_amount = (self.confi_high_th - self.confi_low_th) / 300
-        self.th_timer = threading.Timer(self.th_period, self.updateThreshold)
-        self.th_timer.start()
+        self.th_timer = gevent.spawn_later(self.th_period, self.updateThreshold)
         
 
     def stop(self):
         self.do_run = False
+        # A timer must not be killed while its database work is still running
+        # in the thread pool
+        with self.lock:
+            gevent.killall([self.fast_timer, self.slow_timer, self.th_timer])
 
-    def sendHighPriorityAlert(self):
-        #print("High")
-        if self.do_run:
-            send_list = self.alert_db.high_priority.find()
+
+    def flush(self):
+        self.sendAlerts(self.alert_db.high_priority)
+        self.sendAlerts(self.alert_db.low_priority)
+
+
+    def sendAlerts(self, collection):
+        with self.lock:
+            send_list = self.threadpool.apply(self.takeAlerts, (collection,))
             for alert_to_send in send_list:
                 self.meta_alert_queue.put_nowait(alert_to_send)
-            self.alert_db.high_priority.remove({})
 
-            self.fast_timer = threading.Timer(self.small_period, self.sendHighPriorityAlert)
-            self.fast_timer.start()
+
+    def takeAlerts(self, collection):
+        send_list = list(collection.find())
+        collection.remove({})
+        return send_list
+
+
+    def sendHighPriorityAlert(self):
+        #print("High")
+        if self.do_run:
+            self.sendAlerts(self.alert_db.high_priority)
+            self.fast_timer = gevent.spawn_later(self.small_period, self.sendHighPriorityAlert)
 
 
     def sendLowPriorityAlert(self):
         #print("Low")
         if self.do_run:
-            send_list = self.alert_db.low_priority.find()
-            for alert_to_send in send_list:
-                self.meta_alert_queue.put_nowait(alert_to_send)
-            self.alert_db.low_priority.remove({})
- 
-            self.slow_timer = threading.Timer(self.large_period, self.sendLowPriorityAlert)
-            self.slow_timer.start()
+            self.sendAlerts(self.alert_db.low_priority)
+            self.slow_timer = gevent.spawn_later(self.large_period, self.sendLowPriorityAlert)
 
 
     def updateThreshold(self):
         if self.do_run:
-            self.current_confi_th = min(self.confi_high_th, self.current_confi_th + self.update_amount) 
+            with self.lock:
+                self.current_confi_th = min(self.confi_high_th, self.current_confi_th + self.update_amount) 
             #print("Current Confidence Threshold: " + str(self.current_confi_th))
         
-            self.th_timer = threading.Timer(self.th_period, self.updateThreshold)
-            self.th_timer.start()
+            self.th_timer = gevent.spawn_later(self.th_period, self.updateThreshold)
  
 
     def insertAlert(self, anomaly):
@@ -186,7 +210,7 @@ class AnomalyManager():
                     break
         else:
             candidates = meta_alerts.find({"desp": anomaly.getDesp(),
-                                           "index": anomaly.getIndex()})
+                                           "index": str(anomaly.getIndex())})
             for candidate in candidates:
                 if (anomaly.getTS() > candidate["ts"][0] - self.max_time_gap or
                     anomaly.getTS() < candidate["ts"][1] + self.max_time_gap):
@@ -232,19 +256,19 @@ class AnomalyManager():
         yes = np.array([1, 0])
         no = np.array([0, 1])
         if (meta_alert["anomaly_type"] == "packet" and 
-            (meta_alert["packet"]["sender"] in self.CNL or
-            meta_alert["packet"]["receiver"] in self.CNL)):
+            (meta_alert["packet"]["sender"] in self.critical_nodes or
+            meta_alert["packet"]["receiver"] in self.critical_nodes)):
             return yes
         if (meta_alert["anomaly_type"] == "flow" and 
-            (meta_alert["flow"]["orig"] in self.CNL or
-            meta_alert["flow"]["resp"] in self.CNL)):
+            (meta_alert["flow"]["orig"] in self.critical_nodes or
+            meta_alert["flow"]["resp"] in self.critical_nodes)):
             return yes
         if (meta_alert["anomaly_type"] == "operation" and 
-            (meta_alert["operation"]["orig_ip"] in self.CNL or
-            meta_alert["operation"]["resp_ip"] in self.CNL)):
+            (meta_alert["operation"]["orig_ip"] in self.critical_nodes or
+            meta_alert["operation"]["resp_ip"] in self.critical_nodes)):
             return yes
         if (meta_alert["anomaly_type"] == "measurement" and 
-            meta_alert["measurement"]["holder_ip"] in self.CNL):
+            meta_alert["measurement"]["holder_ip"] in self.critical_nodes):
             return yes
         return no
 
@@ -308,7 +332,7 @@ class AnomalyManager():
             meta_alerts.replace_one({"_id": meta_alert["_id"]}, meta_alert)
             if priority_score > self.priority_th:
                 if pre_priority_score <= self.priority_th:
-                    self.meta_alert_queue.put_nowait(meta_alert)
+                    self.pending.append(meta_alert)
                 else:
                     self.alert_db.high_priority.replace_one({"_id": meta_alert["_id"]},
                                                             meta_alert,
@@ -322,7 +346,7 @@ class AnomalyManager():
             new_id = meta_alerts.insert_one(meta_alert).inserted_id
             meta_alert["_id"] = new_id 
             if priority_score > self.priority_th:
-                self.meta_alert_queue.put_nowait(meta_alert)
+                self.pending.append(meta_alert)
             else:
                 self.alert_db.low_priority.insert_one(meta_alert)
  
@@ -331,6 +355,27 @@ class AnomalyManager():
 
 
     def manage(self, anomaly):
+        self.manageBatch([anomaly])
+
+
+    # Manage a batch of anomalies in the thread pool. One round trip per
+    # batch keeps the greenlet from waiting on the hub for every anomaly.
+    # scheduleAlert leaves high priority meta-alerts in pending, and they are
+    # queued here once the batch is done.
+    def manageBatch(self, anomalies):
+        with self.lock:
+            self.threadpool.apply(self._manageAll, (anomalies,))
+            for meta_alert in self.pending:
+                self.meta_alert_queue.put_nowait(meta_alert)
+            self.pending = []
+
+
+    def _manageAll(self, anomalies):
+        for anomaly in anomalies:
+            self._manageOne(anomaly)
+
+
+    def _manageOne(self, anomaly):
         if anomaly.getConfi() > self.current_confi_th:
             self.current_confi_th = self.confi_low_th + (
                 (self.current_confi_th - self.confi_low_th) * math.exp(-self.th_exp_para)
@@ -1,6 +1,17 @@
 import datetime
+from record import Record
+from ip_address import ip_text
+
+class Operation(Record):
+    __slots__ = ("ts",
+                 "orig_ip",
+                 "resp_ip",
+                 "service",
+                 "uid",
+                 "fc",
+                 "fn",
+                 "is_orig")
 
-class Operation:
     def __init__(self,
                 ts=None,  
                 orig_ip=None,
@@ -23,8 +34,8 @@ class Operation:
 
     def getDict(self):
         rst = {"ts": self.ts,
-               "orig_ip": self.orig_ip,
-               "resp_ip": self.resp_ip,
+               "orig_ip": ip_text(self.orig_ip),
+               "resp_ip": ip_text(self.resp_ip),
                "service": self.service,
                "uid": self.uid,
                "fc": self.fc,
@@ -1,6 +1,17 @@
 import datetime
+from record import Record
+from ip_address import ip_text, conn_text
+
+class Packet(Record):
+    __slots__ = ("ts",
+                 "sender",
+                 "receiver",
+                 "protocol_type",
+                 "tcp_flag",
+                 "service",
+                 "packet_len",
+                 "conn")
 
-class Packet:
     def __init__(self,
                 ts=None,  
                 sender=None,
@@ -23,13 +34,13 @@ class Packet:
 
     def getDict(self):
         rst = {"ts": self.ts,
-               "sender": self.sender,
-               "receiver": self.receiver,
+               "sender": ip_text(self.sender),
+               "receiver": ip_text(self.receiver),
                "protocol_type": self.protocol_type,
                "tcp_flag": self.tcp_flag,
                "service": self.service,
                "packet_len": self.packet_len,
-               "conn": self.conn}
+               "conn": conn_text(self.conn)}
         return rst
 
 
@@ -0,0 +1,128 @@
+import numpy as np
+from packet import Packet
+
+# Protocol ids of the protocol column; 0 is a packet without a known
+# transport header
+PROTOCOLS = [None, "TCP", "UDP", "ICMP"]
+PROTOCOL_IDS = dict((protocol, index) for index, protocol in enumerate(PROTOCOLS))
+
+# One row per packet. Hosts, services and connections are ids into the
+# tables of the batch, and a missing packet length is -1.
+RECORD_TYPE = np.dtype([("ts", np.float64),
+                        ("packet_len", np.int64),
+                        ("tcp_flag", np.int32),
+                        ("protocol", np.uint8),
+                        ("sender", np.int32),
+                        ("receiver", np.int32),
+                        ("service", np.int32),
+                        ("conn", np.int32)])
+
+
+class Interner():
+    # Maps each distinct value to the next id, so that a column stores small
+    # integers and each value is kept once per batch. Ids are handed out with
+    # ids.setdefault(value, len(ids)).
+    def __init__(self):
+        self.ids = dict()
+
+
+    def getValues(self):
+        values = [None] * len(self.ids)
+        for value, index in self.ids.iteritems():
+            values[index] = value
+        return values
+
+
+class PacketBatch():
+    # Columnar form of a batch of packets. The batch carries its own value
+    # tables and can be pickled or copied as a whole. Iterating it gives the
+    # packets as Packet objects, built on demand.
+    def __init__(self, records, hosts, services, conns):
+        self.records = records
+        self.hosts = hosts
+        self.services = services
+        self.conns = conns
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def packets(self):
+        records = self.records
+        hosts = self.hosts
+        services = self.services
+        conns = self.conns
+        packets = []
+        for ts, packet_len, tcp_flag, protocol, sender, receiver, service, conn in zip(
+                records["ts"].tolist(),
+                records["packet_len"].tolist(),
+                records["tcp_flag"].tolist(),
+                records["protocol"].tolist(),
+                records["sender"].tolist(),
+                records["receiver"].tolist(),
+                records["service"].tolist(),
+                records["conn"].tolist()):
+            packets.append(Packet(ts,
+                                  hosts[sender],
+                                  hosts[receiver],
+                                  PROTOCOLS[protocol],
+                                  tcp_flag,
+                                  list(services[service]),
+                                  packet_len if packet_len >= 0 else None,
+                                  conns[conn]))
+        return packets
+
+
+    def __iter__(self):
+        return iter(self.packets())
+
+
+    def __getitem__(self, key):
+        # A slice is a batch sharing the value tables, an index a Packet
+        if isinstance(key, slice):
+            return PacketBatch(self.records[key], self.hosts, self.services, self.conns)
+        return self.packet(key)
+
+
+    def packet(self, i):
+        ts, packet_len, tcp_flag, protocol, sender, receiver, service, conn = self.records[i].tolist()
+        return Packet(ts,
+                      self.hosts[sender],
+                      self.hosts[receiver],
+                      PROTOCOLS[protocol],
+                      tcp_flag,
+                      list(self.services[service]),
+                      packet_len if packet_len >= 0 else None,
+                      self.conns[conn])
+
+
+def from_packets(packets):
+    # PacketBatch of a list of packets, such as those read from a trace
+    hosts = Interner()
+    services = Interner()
+    conns = Interner()
+    host_ids = hosts.ids
+    service_ids = services.ids
+    conn_ids = conns.ids
+    records = np.empty(len(packets), RECORD_TYPE)
+    records["ts"] = [packet.ts for packet in packets]
+    records["packet_len"] = [packet.packet_len if packet.packet_len != None else -1 for packet in packets]
+    records["tcp_flag"] = [packet.tcp_flag for packet in packets]
+    records["protocol"] = [PROTOCOL_IDS[packet.protocol_type] for packet in packets]
+    records["sender"] = [host_ids.setdefault(packet.sender, len(host_ids)) for packet in packets]
+    records["receiver"] = [host_ids.setdefault(packet.receiver, len(host_ids)) for packet in packets]
+    records["service"] = [service_ids.setdefault(tuple(packet.service), len(service_ids)) for packet in packets]
+    records["conn"] = [conn_ids.setdefault(packet.conn, len(conn_ids)) for packet in packets]
+    return PacketBatch(records, hosts.getValues(), services.getValues(), conns.getValues())
+
+
+def group_ranks(keys):
+    # For each key, the number of earlier keys equal to it
+    order = np.argsort(keys, kind="mergesort")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    sizes = np.diff(np.r_[starts, len(keys)])
+    ranks = np.empty(len(keys), np.int64)
+    ranks[order] = np.arange(len(keys)) - np.repeat(starts, sizes)
+    return ranks
@@ -1,5 +1,6 @@
 from data_value import DataValue 
 import datetime
+from ip_address import ip_address
 
 def parse_data_value(args):
     data_info = args[0]
@@ -10,7 +11,7 @@ def parse_data_value(args):
     #print(data_value.ts)
 
     # Connection
-    data_value.holder_ip = str(data_info[1][0][2])
+    data_value.holder_ip = ip_address(str(data_info[1][0][2]))
 
     # Control Protocol 
     data_value.protocol = str(data_info[2])
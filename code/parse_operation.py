@@ -1,5 +1,6 @@
 from operation import Operation 
 import datetime
+from ip_address import ip_address
 
 def parse_operation(args):
     protocol_info = args[0]
@@ -9,8 +10,8 @@ def parse_operation(args):
     operation.ts = (protocol_info[0] - datetime.datetime(1970, 1, 1)).total_seconds()
 
     # Connection
-    operation.orig_ip = str(protocol_info[1][0][0])
-    operation.resp_ip = str(protocol_info[1][0][2])
+    operation.orig_ip = ip_address(str(protocol_info[1][0][0]))
+    operation.resp_ip = ip_address(str(protocol_info[1][0][2]))
 
     # Control Protocol (service) 
     operation.service = str(protocol_info[2])
@@ -1,12 +1,17 @@
 from packet import Packet 
+from packet_batch import PacketBatch, Interner, RECORD_TYPE, PROTOCOL_IDS
+from ip_address import ip_address
 import datetime
+import numpy as np
+
+EPOCH = datetime.datetime(1970, 1, 1)
 
 def parse_conn(conn, packet):
     # Connection tuple 
     conn_tuple = conn[0]
-    orig_h = str(conn_tuple[0])
+    orig_h = ip_address(str(conn_tuple[0]))
     orig_p = str(conn_tuple[1])
-    resp_h = str(conn_tuple[2])
+    resp_h = ip_address(str(conn_tuple[2]))
     resp_p = str(conn_tuple[3])
     packet.conn = (orig_h, orig_p, resp_h, resp_p)
     #print(packet.conn)
@@ -25,16 +30,16 @@ def parse_hdr(hdr, packet):
     if hdr[0] is not None:
         #print("ip4")
         packet.packet_len = hdr[0][2].value
-        packet.sender = str(hdr[0][6])
-        packet.receiver = str(hdr[0][7])
+        packet.sender = ip_address(str(hdr[0][6]))
+        packet.receiver = ip_address(str(hdr[0][7]))
         #print("packet_len: {}, src: {}, dst: {}".format(packet.packet_len, packet.sender, packet.receiver))
 
     # IPv6
     elif hdr[1] is not None: 
         #print("ip6")
-        packet.packet_len = hdr[0][2].value
-        packet.sender = str(hdr[0][5])
-        packet.receiver = str(hdr[0][6])
+        packet.packet_len = hdr[1][2].value
+        packet.sender = ip_address(str(hdr[1][5]))
+        packet.receiver = ip_address(str(hdr[1][6]))
         #print("packet_len: {}, src: {}, dst: {}".format(packet.packet_len, packet.sender, packet.receiver))
 
     # TCP
@@ -60,7 +65,7 @@ def parse_packet(args):
     packet = Packet()
 
     # Timestamp
-    packet.ts = (packet_info[0] - datetime.datetime(1970, 1, 1)).total_seconds()
+    packet.ts = (packet_info[0] - EPOCH).total_seconds()
     #print(packet.ts)
 
     # Connection
@@ -71,3 +76,78 @@ def parse_packet(args):
 
     #print(packet)
     return packet
+
+
+def parse_packet_batch(raw_packets):
+    # Parse a list of packet events into one PacketBatch. Each field is
+    # gathered into a column, which is copied into the record array at once,
+    # and hosts, services and connections are interned per batch.
+    hosts = Interner()
+    services = Interner()
+    conns = Interner()
+    host_ids = hosts.ids
+    service_ids = services.ids
+    conn_ids = conns.ids
+    times = []
+    packet_lens = []
+    tcp_flags = []
+    protocols = []
+    senders = []
+    receivers = []
+    service_column = []
+    conn_column = []
+    tcp = PROTOCOL_IDS["TCP"]
+    udp = PROTOCOL_IDS["UDP"]
+    icmp = PROTOCOL_IDS["ICMP"]
+    unknown = PROTOCOL_IDS[None]
+    for args in raw_packets:
+        packet_info = args[0]
+        times.append((packet_info[0] - EPOCH).total_seconds())
+
+        conn = packet_info[1]
+        conn_tuple = conn[0]
+        conn_key = (ip_address(str(conn_tuple[0])), str(conn_tuple[1]), ip_address(str(conn_tuple[2])), str(conn_tuple[3]))
+        conn_column.append(conn_ids.setdefault(conn_key, len(conn_ids)))
+        service_key = tuple(map(str, conn[5]))
+        service_column.append(service_ids.setdefault(service_key, len(service_ids)))
+
+        hdr = packet_info[2]
+        if hdr[0] is not None:
+            ip_hdr = hdr[0]
+            packet_lens.append(ip_hdr[2].value)
+            sender = ip_address(str(ip_hdr[6]))
+            receiver = ip_address(str(ip_hdr[7]))
+        elif hdr[1] is not None:
+            ip_hdr = hdr[1]
+            packet_lens.append(ip_hdr[2].value)
+            sender = ip_address(str(ip_hdr[5]))
+            receiver = ip_address(str(ip_hdr[6]))
+        else:
+            packet_lens.append(-1)
+            sender = None
+            receiver = None
+        senders.append(host_ids.setdefault(sender, len(host_ids)))
+        receivers.append(host_ids.setdefault(receiver, len(host_ids)))
+
+        if hdr[2] is not None:
+            protocols.append(tcp)
+            tcp_flags.append(hdr[2][6].value)
+        else:
+            if hdr[3] is not None:
+                protocols.append(udp)
+            elif hdr[4] is not None:
+                protocols.append(icmp)
+            else:
+                protocols.append(unknown)
+            tcp_flags.append(-1)
+
+    records = np.empty(len(raw_packets), RECORD_TYPE)
+    records["ts"] = times
+    records["packet_len"] = packet_lens
+    records["tcp_flag"] = tcp_flags
+    records["protocol"] = protocols
+    records["sender"] = senders
+    records["receiver"] = receivers
+    records["service"] = service_column
+    records["conn"] = conn_column
+    return PacketBatch(records, hosts.getValues(), services.getValues(), conns.getValues())
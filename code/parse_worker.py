@@ -0,0 +1,212 @@
+import cPickle
+import fcntl
+import mmap
+import multiprocessing
+import os
+import select
+import struct
+import timeit
+import gevent
+from gevent import select as gevent_select
+from parse_packet import parse_packet_batch
+from parse_operation import parse_operation
+from parse_data_value import parse_data_value
+from record_event import read_events
+from latency_histogram import get_histogram
+
+# Broker topic and batch parser of each level that can be parsed in a worker
+# process
+LEVEL_TOPICS = {
+    "packet": "edmand/packet_get",
+    "operation": "edmand/protocol_get",
+    "data_value": "edmand/data_get",
+}
+DONE_TOPIC = "edmand/bro_done"
+PARSERS = {
+    "packet": parse_packet_batch,
+    "operation": lambda raw_items: [parse_operation(raw_item) for raw_item in raw_items],
+    "data_value": lambda raw_items: [parse_data_value(raw_item) for raw_item in raw_items],
+}
+
+# Bytes of parsed batches a worker may have written ahead of the reader
+RING_CAPACITY = 32*1024*1024
+
+# The ring starts with the total bytes written and read so far, each updated
+# by one side only. Each record is its length followed by a pickled batch.
+POSITIONS = struct.Struct("<QQ")
+RECORD_HEADER = struct.Struct("<I")
+# Record lengths with a special meaning: the rest of the ring is skipped, or
+# the worker is done
+WRAP = 0xffffffff
+END = 0xfffffffe
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def notify(fd):
+    # A pending token is as good as a new one, so a full pipe is fine
+    try:
+        os.write(fd, b"x")
+    except OSError:
+        pass
+
+
+class SharedRing():
+    # Single producer, single consumer ring in shared memory between a worker
+    # process and the main process. Records never wrap around the end of the
+    # ring. Each side sends a token over a pipe after it moves its position,
+    # so the other side can wait for data or room without polling; the main
+    # process waits through gevent.
+    def __init__(self, capacity=RING_CAPACITY):
+        self.capacity = capacity
+        self.memory = mmap.mmap(-1, POSITIONS.size + capacity)
+        self.data_read, self.data_write = os.pipe()
+        self.room_read, self.room_write = os.pipe()
+        set_nonblocking(self.data_write)
+        set_nonblocking(self.room_write)
+        self.write_pos = 0
+        self.read_pos = 0
+
+
+    def getPositions(self):
+        return POSITIONS.unpack_from(self.memory, 0)
+
+
+    def put(self, payload):
+        self.write(len(payload), payload)
+
+
+    def close(self):
+        self.write(END, b"")
+
+
+    def write(self, length, payload):
+        # Worker side; blocks while the ring is full
+        size = RECORD_HEADER.size + len(payload)
+        if size > self.capacity:
+            raise ValueError("Parsed batch of {} bytes does not fit in the ring".format(size))
+        offset = self.write_pos % self.capacity
+        skip = 0
+        if offset + size > self.capacity:
+            skip = self.capacity - offset
+        while self.capacity - (self.write_pos - self.getPositions()[1]) < skip + size:
+            select.select([self.room_read], [], [])
+            os.read(self.room_read, 4096)
+
+        if skip > 0:
+            if skip >= RECORD_HEADER.size:
+                RECORD_HEADER.pack_into(self.memory, POSITIONS.size + offset, WRAP)
+            self.write_pos += skip
+            offset = 0
+        start = POSITIONS.size + offset
+        RECORD_HEADER.pack_into(self.memory, start, length)
+        self.memory[start + RECORD_HEADER.size:start + size] = payload
+        self.write_pos += size
+        struct.pack_into("<Q", self.memory, 0, self.write_pos)
+        notify(self.data_write)
+
+
+    def get(self):
+        # Main process side; returns the next payload, or None once the worker
+        # is done
+        while True:
+            if self.read_pos == self.getPositions()[0]:
+                gevent_select.select([self.data_read], [], [])
+                os.read(self.data_read, 4096)
+                continue
+            offset = self.read_pos % self.capacity
+            if self.capacity - offset < RECORD_HEADER.size:
+                self.read_pos += self.capacity - offset
+                continue
+            start = POSITIONS.size + offset
+            length, = RECORD_HEADER.unpack_from(self.memory, start)
+            if length == WRAP:
+                self.read_pos += self.capacity - offset
+                continue
+            if length == END:
+                return None
+            start += RECORD_HEADER.size
+            payload = self.memory[start:start + length]
+            self.read_pos += RECORD_HEADER.size + length
+            struct.pack_into("<Q", self.memory, 8, self.read_pos)
+            notify(self.room_write)
+            return payload
+
+
+def broker_events(level, max_batch):
+    # Take the events of the level from the EDMAND endpoint, which forwards
+    # them from Bro, so that they are never converted in the main process
+    import broker
+    ep = broker.Endpoint()
+    sub = ep.make_subscriber([LEVEL_TOPICS[level], DONE_TOPIC])
+    ep.peer("127.0.0.1", 9999, 1)
+    while True:
+        select.select([sub.fd()], [], [])
+        batch = []
+        for t, msg in sub.poll():
+            if t == DONE_TOPIC:
+                if batch:
+                    yield batch
+                ep.shutdown()
+                return
+            batch.append(broker.bro.Event(msg).args())
+            if len(batch) == max_batch:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def logged_events(level, max_batch, path):
+    batch = []
+    for t, args in read_events(path, [LEVEL_TOPICS[level]]):
+        batch.append(args)
+        if len(batch) == max_batch:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_worker(level, label, ring, max_batch, log_path):
+    parse = PARSERS[level]
+    if log_path == None:
+        batches = broker_events(level, max_batch)
+    else:
+        batches = logged_events(level, max_batch, log_path)
+    histogram = get_histogram(label)
+    for raw_items in batches:
+        start = timeit.default_timer()
+        items = parse(raw_items)
+        histogram.record((timeit.default_timer() - start) / len(raw_items), len(raw_items))
+        ring.put(cPickle.dumps(items, cPickle.HIGHEST_PROTOCOL))
+    ring.close()
+    if histogram.count != 0:
+        print(histogram)
+
+
+class ParseProcess():
+    # Parses the events of one level in a worker process, from Broker or
+    # from a recorded log, and hands the parsed batches to the main process
+    # through a shared ring
+    def __init__(self, level, label, max_batch, log_path=None):
+        self.ring = SharedRing()
+        self.worker = multiprocessing.Process(target=parse_worker,
+                                              args=(level, label, self.ring, max_batch, log_path))
+        self.worker.daemon = True
+
+
+    def start(self):
+        self.worker.start()
+
+
+    def batches(self):
+        while True:
+            payload = self.ring.get()
+            if payload == None:
+                break
+            yield cPickle.loads(payload)
+        gevent.get_hub().threadpool.apply(self.worker.join)
@@ -0,0 +1,386 @@
+import mmap
+import struct
+from packet import Packet
+from ip_address import ip_from_bytes
+
+# Link types
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = [12, 14, 101]
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = [0x8100, 0x88a8, 0x9100]
+
+# IPv6 extension headers that are skipped to reach the transport header
+IPV6_EXTENSIONS = [0, 43, 60]
+IPV6_FRAGMENT = 44
+IPV6_AUTH = 51
+
+PROTOCOLS = {6: "TCP", 17: "UDP", 1: "ICMP", 58: "ICMP"}
+PORT_SUFFIXES = {"TCP": "/tcp", "UDP": "/udp", "ICMP": "/icmp"}
+
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+
+# Services Bro confirms on these ports, added to a connection with its first
+# payload
+SERVICE_PORTS = {
+    ("TCP", 20000): "DNP3_TCP",
+    ("UDP", 20000): "DNP3_UDP",
+    ("TCP", 502): "MODBUS",
+}
+SERVER_PORTS = set(port for protocol, port in SERVICE_PORTS)
+
+# Seconds without a packet after which a connection is forgotten, as Bro's
+# inactivity timeouts
+CONNECTION_TIMEOUT = {"TCP": 5*60, "UDP": 60, "ICMP": 60}
+SWEEP_PERIOD = 60
+
+SEQ_SPACE = 1 << 32
+# Out of order segments a TCP stream holds before it gives up on the gap
+MAX_PENDING_SEGMENTS = 1024
+
+PCAP_HEADER = struct.Struct("4sHHiIII")
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1000000),
+    b"\xa1\xb2\xc3\xd4": (">", 1000000),
+    b"\x4d\x3c\xb2\xa1": ("<", 1000000000),
+    b"\xa1\xb2\x3c\x4d": (">", 1000000000),
+}
+PCAPNG_SECTION = b"\x0a\x0d\x0d\x0a"
+PCAPNG_INTERFACE = 1
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_TSRESOL = 9
+
+
+def read_pcap_frames(memory):
+    # (microseconds, link type, frame offset, captured length) of each frame
+    # of a pcap file
+    endian, ticks_per_second = PCAP_MAGIC[memory[:4]]
+    header = struct.Struct(endian + "IIII")
+    linktype = struct.unpack_from(endian + "I", memory, 20)[0] & 0xffff
+    offset = PCAP_HEADER.size
+    end = len(memory)
+    while offset + header.size <= end:
+        seconds, ticks, caplen, origlen = header.unpack_from(memory, offset)
+        offset += header.size
+        if offset + caplen > end:
+            return
+        yield (seconds * 1000000 + ticks * 1000000 // ticks_per_second, linktype, offset, caplen)
+        offset += caplen
+
+
+def read_pcapng_frames(memory):
+    # The same for a pcapng file; only enhanced packet blocks have frames
+    endian = "<"
+    interfaces = []
+    offset = 0
+    end = len(memory)
+    while offset + 12 <= end:
+        if memory[offset:offset + 4] == PCAPNG_SECTION:
+            if memory[offset + 8:offset + 12] == b"\x4d\x3c\x2b\x1a":
+                endian = "<"
+            else:
+                endian = ">"
+            interfaces = []
+        block_type, block_len = struct.unpack_from(endian + "II", memory, offset)
+        if block_len < 12 or offset + block_len > end:
+            return
+        if block_type == PCAPNG_INTERFACE:
+            linktype = struct.unpack_from(endian + "H", memory, offset + 8)[0]
+            ticks_per_second = 1000000
+            option = offset + 16
+            while option + 4 <= offset + block_len - 4:
+                code, length = struct.unpack_from(endian + "HH", memory, option)
+                if code == 0:
+                    break
+                if code == PCAPNG_TSRESOL:
+                    resolution = ord(memory[option + 4])
+                    if resolution & 0x80:
+                        ticks_per_second = 2 ** (resolution & 0x7f)
+                    else:
+                        ticks_per_second = 10 ** resolution
+                option += 4 + (length + 3) // 4 * 4
+            interfaces.append((linktype, ticks_per_second))
+        elif block_type == PCAPNG_ENHANCED_PACKET:
+            interface, high, low, caplen = struct.unpack_from(endian + "IIII", memory, offset + 8)
+            linktype, ticks_per_second = interfaces[interface]
+            ticks = (high << 32) | low
+            yield (ticks * 1000000 // ticks_per_second, linktype, offset + 28, caplen)
+        offset += block_len
+
+
+class TcpStream():
+    # Puts the payload of one direction of a TCP connection back in order.
+    # Retransmitted bytes are dropped, and segments after a gap wait until
+    # it is filled or too many of them are held.
+    def __init__(self):
+        self.next_seq = None
+        self.pending = dict()
+
+
+    def add(self, seq, payload):
+        # Returns the bytes that are now in order
+        if self.next_seq == None:
+            self.next_seq = seq
+        offset = (seq - self.next_seq) % SEQ_SPACE
+        if offset != 0 and offset < SEQ_SPACE // 2:
+            if len(payload) > len(self.pending.get(seq, b"")):
+                self.pending[seq] = payload
+            if len(self.pending) <= MAX_PENDING_SEGMENTS:
+                return b""
+            self.next_seq = min(self.pending, key=lambda seq: (seq - self.next_seq) % SEQ_SPACE)
+            data = []
+        else:
+            data = [self.append(offset, payload)]
+        while self.pending:
+            ready = [seq for seq in self.pending
+                     if (seq - self.next_seq) % SEQ_SPACE == 0
+                     or (seq - self.next_seq) % SEQ_SPACE >= SEQ_SPACE // 2]
+            if not ready:
+                break
+            for seq in ready:
+                data.append(self.append((seq - self.next_seq) % SEQ_SPACE, self.pending.pop(seq)))
+        return b"".join(data)
+
+
+    def append(self, offset, payload):
+        # Cut what was already delivered from a segment at or before the
+        # next sequence number
+        overlap = (SEQ_SPACE - offset) % SEQ_SPACE
+        payload = payload[overlap:]
+        self.next_seq = (self.next_seq + len(payload)) % SEQ_SPACE
+        return payload
+
+
+class Connection():
+    # The fields of Bro's connection record that end up in a Packet, and the
+    # decoder of its service
+    def __init__(self, protocol, orig, orig_port, resp, resp_port):
+        suffix = PORT_SUFFIXES[protocol]
+        self.conn = (orig, str(orig_port) + suffix, resp, str(resp_port) + suffix)
+        self.protocol = protocol
+        self.orig = orig
+        self.orig_port = orig_port
+        self.service = []
+        self.service_name = SERVICE_PORTS.get((protocol, resp_port))
+        self.timeout = CONNECTION_TIMEOUT[protocol]
+        self.last_seen = None
+        self.decoder = None
+        self.streams = None
+
+
+class PcapReader():
+    # Streams the packets of a pcap or pcapng trace as Packet objects, the
+    # way Bro's new_packet event reports them. Only IP packets carrying TCP,
+    # UDP or ICMP are reported, and fragments after the first are skipped.
+    # decoders maps a service to the class that decodes the payload of its
+    # connections into the operations and data_values lists, which the
+    # caller takes with takeDecoded.
+    def __init__(self, path, decoders=None):
+        self.trace = open(path, "rb")
+        self.memory = mmap.mmap(self.trace.fileno(), 0, access=mmap.ACCESS_READ)
+        self.decoders = decoders if decoders != None else dict()
+        self.connections = dict()
+        self.addresses = dict()
+        self.next_sweep = None
+        self.operations = []
+        self.data_values = []
+
+
+    def close(self):
+        self.memory.close()
+        self.trace.close()
+
+
+    def takeDecoded(self):
+        # The decoders keep appending to the same lists
+        operations = self.operations[:]
+        data_values = self.data_values[:]
+        del self.operations[:]
+        del self.data_values[:]
+        return operations, data_values
+
+
+    def frames(self):
+        if self.memory[:4] == PCAPNG_SECTION:
+            return read_pcapng_frames(self.memory)
+        if self.memory[:4] in PCAP_MAGIC:
+            return read_pcap_frames(self.memory)
+        raise ValueError("Not a pcap or pcapng trace")
+
+
+    def address(self, raw):
+        address = self.addresses.get(raw)
+        if address == None:
+            address = ip_from_bytes(raw)
+            self.addresses[raw] = address
+        return address
+
+
+    def decode(self, linktype, offset, caplen):
+        # Returns (sender, receiver, protocol, source port, destination port,
+        # IP length, TCP flags, sequence number, payload), or None
+        memory = self.memory
+        end = offset + caplen
+        if linktype == LINKTYPE_ETHERNET:
+            if caplen < 14:
+                return None
+            ethertype, = struct.unpack_from("!H", memory, offset + 12)
+            offset += 14
+            while ethertype in ETHERTYPE_VLAN and offset + 4 <= end:
+                ethertype, = struct.unpack_from("!H", memory, offset + 2)
+                offset += 4
+        elif linktype == LINKTYPE_LINUX_SLL:
+            if caplen < 16:
+                return None
+            ethertype, = struct.unpack_from("!H", memory, offset + 14)
+            offset += 16
+        elif linktype == LINKTYPE_LINUX_SLL2:
+            if caplen < 20:
+                return None
+            ethertype, = struct.unpack_from("!H", memory, offset)
+            offset += 20
+        elif linktype in LINKTYPE_RAW or linktype == LINKTYPE_NULL:
+            if linktype == LINKTYPE_NULL:
+                offset += 4
+            if offset >= end:
+                return None
+            version = ord(memory[offset]) >> 4
+            ethertype = ETHERTYPE_IPV4 if version == 4 else ETHERTYPE_IPV6
+        else:
+            return None
+
+        if ethertype == ETHERTYPE_IPV4:
+            if offset + 20 > end:
+                return None
+            version_ihl, total_len, fragment, ip_protocol = struct.unpack_from("!BxHxxHxB", memory, offset)
+            if fragment & 0x1fff:
+                return None
+            ip_len = total_len
+            ip_end = min(end, offset + total_len)
+            sender = self.address(memory[offset + 12:offset + 16])
+            receiver = self.address(memory[offset + 16:offset + 20])
+            offset += (version_ihl & 0x0f) * 4
+        elif ethertype == ETHERTYPE_IPV6:
+            if offset + 40 > end:
+                return None
+            payload_len, ip_protocol = struct.unpack_from("!HB", memory, offset + 4)
+            ip_len = payload_len
+            ip_end = min(end, offset + 40 + payload_len)
+            sender = self.address(memory[offset + 8:offset + 24])
+            receiver = self.address(memory[offset + 24:offset + 40])
+            offset += 40
+            while offset + 8 <= ip_end:
+                if ip_protocol in IPV6_EXTENSIONS:
+                    next_protocol, length = struct.unpack_from("!BB", memory, offset)
+                    offset += (length + 1) * 8
+                elif ip_protocol == IPV6_AUTH:
+                    next_protocol, length = struct.unpack_from("!BB", memory, offset)
+                    offset += (length + 2) * 4
+                elif ip_protocol == IPV6_FRAGMENT:
+                    next_protocol, fragment = struct.unpack_from("!BxH", memory, offset)
+                    if fragment & 0xfff8:
+                        return None
+                    offset += 8
+                else:
+                    break
+                ip_protocol = next_protocol
+        else:
+            return None
+
+        protocol = PROTOCOLS.get(ip_protocol)
+        if protocol == None:
+            return None
+        tcp_flag = -1
+        seq = None
+        if protocol == "TCP":
+            if offset + 20 > ip_end:
+                return None
+            source_port, destination_port, seq, data_offset, tcp_flag = struct.unpack_from("!HHIxxxxBB", memory, offset)
+            offset += (data_offset >> 4) * 4
+        elif protocol == "UDP":
+            if offset + 8 > ip_end:
+                return None
+            source_port, destination_port = struct.unpack_from("!HH", memory, offset)
+            offset += 8
+        else:
+            if offset + 2 > ip_end:
+                return None
+            source_port, destination_port = struct.unpack_from("!BB", memory, offset)
+            offset = ip_end
+        payload = memory[offset:ip_end] if offset < ip_end else b""
+        return (sender, receiver, protocol, source_port, destination_port, ip_len, tcp_flag, seq, payload)
+
+
+    def connection(self, ts, sender, receiver, protocol, source_port, destination_port, tcp_flag):
+        if sender < receiver or (sender == receiver and source_port < destination_port):
+            key = (protocol, sender, source_port, receiver, destination_port)
+        else:
+            key = (protocol, receiver, destination_port, sender, source_port)
+        connection = self.connections.get(key)
+        if connection == None or ts > connection.last_seen + connection.timeout:
+            # Bro takes the sender of the first packet as the originator,
+            # unless it answers a handshake or talks from a server port
+            flip = False
+            if protocol == "TCP" and tcp_flag & (TCP_SYN | TCP_ACK) == TCP_SYN | TCP_ACK:
+                flip = True
+            elif source_port in SERVER_PORTS and destination_port not in SERVER_PORTS:
+                flip = True
+            if flip:
+                connection = Connection(protocol, receiver, destination_port, sender, source_port)
+            else:
+                connection = Connection(protocol, sender, source_port, receiver, destination_port)
+            self.connections[key] = connection
+        connection.last_seen = ts
+        return connection
+
+
+    def sweep(self, ts):
+        for key, connection in self.connections.items():
+            if ts > connection.last_seen + connection.timeout:
+                del self.connections[key]
+
+
+    def startService(self, connection):
+        connection.service = [connection.service_name]
+        decoder = self.decoders.get(connection.service_name)
+        if decoder != None:
+            connection.decoder = decoder(connection, self.operations, self.data_values)
+            if connection.protocol == "TCP":
+                connection.streams = {True: TcpStream(), False: TcpStream()}
+
+
+    def packets(self):
+        for microseconds, linktype, offset, caplen in self.frames():
+            decoded = self.decode(linktype, offset, caplen)
+            if decoded == None:
+                continue
+            sender, receiver, protocol, source_port, destination_port, ip_len, tcp_flag, seq, payload = decoded
+            ts = microseconds / 1e6
+            if self.next_sweep == None:
+                self.next_sweep = ts + SWEEP_PERIOD
+            elif ts > self.next_sweep:
+                self.sweep(ts)
+                self.next_sweep = ts + SWEEP_PERIOD
+
+            connection = self.connection(ts, sender, receiver, protocol, source_port, destination_port, tcp_flag)
+            if payload and connection.service_name != None and not connection.service:
+                self.startService(connection)
+            if payload and connection.decoder != None:
+                is_orig = sender == connection.orig and source_port == connection.orig_port
+                if connection.streams != None:
+                    payload = connection.streams[is_orig].add(seq, payload)
+                if payload:
+                    connection.decoder.decode(ts, is_orig, payload)
+            yield Packet(ts,
+                         sender,
+                         receiver,
+                         protocol,
+                         tcp_flag,
+                         connection.service,
+                         ip_len,
+                         connection.conn)
@@ -0,0 +1,30 @@
+# Slot names of each record class, including those of its bases
+FIELDS = dict()
+
+
+def get_fields(cls):
+    fields = FIELDS.get(cls)
+    if fields == None:
+        fields = []
+        for klass in reversed(cls.__mro__):
+            fields.extend(klass.__dict__.get("__slots__", ()))
+        FIELDS[cls] = fields
+    return fields
+
+
+class Record(object):
+    # Base of the packets, flows, operations, data values and anomalies. The
+    # records declare their attributes in __slots__, so that the many of them
+    # held in the queues and analyzers carry no __dict__ each. Slotted
+    # objects only pickle with protocol 2 on their own, and the alert sender
+    # pickles with protocol 0, so the state is given explicitly.
+    __slots__ = ()
+
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in get_fields(type(self)))
+
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
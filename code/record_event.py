@@ -0,0 +1,107 @@
+import datetime
+import marshal
+import struct
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Topics that are recorded, in the order of their code in the log
+TOPICS = ["edmand/packet_get", "edmand/protocol_get", "edmand/data_get"]
+TOPIC_CODES = dict((topic, code) for code, topic in enumerate(TOPICS))
+
+# Each record is a topic code and a payload length followed by the marshaled
+# event arguments
+HEADER = struct.Struct("<BI")
+
+# Tags of the values that marshal cannot store directly. Sequences are stored
+# as lists, so a tuple in the payload is always a tagged value.
+TIME = 0
+INTERVAL = 1
+SET = 2
+TABLE = 3
+VALUE = 4
+
+
+class Value(object):
+    # Stands in for the Broker count, integer and real wrappers, which the
+    # parsers read through their value attribute
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+    def __str__(self):
+        return str(self.value)
+
+
+def to_microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def encode(data):
+    if data is None or isinstance(data, (bool, int, long, float, str, unicode)):
+        return data
+    if isinstance(data, datetime.datetime):
+        return (TIME, to_microseconds(data - EPOCH))
+    if isinstance(data, datetime.timedelta):
+        return (INTERVAL, to_microseconds(data))
+    if isinstance(data, (list, tuple)):
+        return [encode(item) for item in data]
+    if isinstance(data, (set, frozenset)):
+        return (SET, [encode(item) for item in data])
+    if isinstance(data, dict):
+        return (TABLE, [(encode(key), encode(val)) for key, val in data.items()])
+    if hasattr(data, "value"):
+        return (VALUE, encode(data.value))
+    # Addresses, ports, subnets and enums are only ever read through str()
+    return str(data)
+
+
+def decode(data):
+    if isinstance(data, list):
+        return tuple(decode(item) for item in data)
+    if isinstance(data, tuple):
+        tag, val = data
+        if tag == TIME:
+            return EPOCH + datetime.timedelta(microseconds=val)
+        if tag == INTERVAL:
+            return datetime.timedelta(microseconds=val)
+        if tag == SET:
+            return set(decode(item) for item in val)
+        if tag == TABLE:
+            return dict((decode(key), decode(item)) for key, item in val)
+        return Value(decode(val))
+    return data
+
+
+class EventRecorder():
+    def __init__(self, path):
+        self.log = open(path, "wb")
+        self.count = 0
+
+
+    def record(self, topic, args):
+        payload = marshal.dumps(encode(args))
+        self.log.write(HEADER.pack(TOPIC_CODES[topic], len(payload)))
+        self.log.write(payload)
+        self.count += 1
+
+
+    def close(self):
+        self.log.close()
+
+
+def read_events(path, topics=TOPICS):
+    # Events of the given topics; the others are skipped without decoding
+    codes = set(TOPIC_CODES[topic] for topic in topics)
+    with open(path, "rb") as log:
+        while True:
+            header = log.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            code, length = HEADER.unpack(header)
+            payload = log.read(length)
+            if len(payload) < length:
+                return
+            if code in codes:
+                yield (TOPICS[code], decode(marshal.loads(payload)))
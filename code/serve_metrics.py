@@ -0,0 +1,85 @@
+import collections
+import json
+import time
+from gevent.pywsgi import WSGIServer
+from pymongo import monitoring
+from latency_histogram import get_all_stats
+
+# Commands counted as Mongo writes
+WRITE_COMMANDS = set(["insert", "update", "delete", "findAndModify"])
+
+
+class MongoWriteCounter(monitoring.CommandListener):
+    # Counts the write commands of every client created after it is
+    # registered, without touching the code that issues them
+    def __init__(self):
+        self.counts = collections.defaultdict(int)
+        self.start_time = time.time()
+
+
+    def started(self, event):
+        if event.command_name in WRITE_COMMANDS:
+            self.counts[event.command_name] += 1
+
+
+    def succeeded(self, event):
+        pass
+
+
+    def failed(self, event):
+        pass
+
+
+    def getStats(self):
+        total = sum(self.counts.values())
+        elapsed = time.time() - self.start_time
+        stats = dict(self.counts)
+        stats["total"] = total
+        stats["rate"] = total / elapsed if elapsed > 0 else 0.0
+        return stats
+
+
+class MetricsServer():
+    # Serves the stage histograms and the registered sources as JSON on
+    # http://127.0.0.1:<port>/metrics. Nothing is computed until a request
+    # comes in, and a source is a function returning a JSON-friendly dict.
+    def __init__(self, port):
+        self.port = port
+        self.sources = collections.OrderedDict()
+        self.start_time = time.time()
+        self.mongo_writes = MongoWriteCounter()
+        monitoring.register(self.mongo_writes)
+        self.server = WSGIServer(("127.0.0.1", port), self.handle, log=None)
+
+
+    def addSource(self, name, source):
+        self.sources[name] = source
+
+
+    def getMetrics(self):
+        metrics = collections.OrderedDict()
+        metrics["uptime"] = time.time() - self.start_time
+        metrics["stages"] = get_all_stats()
+        for name, source in self.sources.items():
+            metrics[name] = source()
+        metrics["mongo_writes"] = self.mongo_writes.getStats()
+        return metrics
+
+
+    def handle(self, environ, start_response):
+        if environ["PATH_INFO"] not in ("/", "/metrics"):
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b"Not Found"]
+        body = json.dumps(self.getMetrics(), indent=1).encode("utf-8")
+        start_response("200 OK", [("Content-Type", "application/json"),
+                                  ("Content-Length", str(len(body)))])
+        return [body]
+
+
+    def start(self):
+        self.server.start()
+        print("Metrics on http://127.0.0.1:{}/metrics".format(self.port))
+
+
+    def stop(self):
+        self.server.stop()
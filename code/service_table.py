@@ -0,0 +1,207 @@
+import numpy as np
+import math
+from inc_mean_std import UPDATE_TH, sigmoid, anomaly_score
+
+# Direction column of the columns kept per direction
+AB = 0
+BA = 1
+
+# One histogram slot per TCP flag byte, and a last one for the packets
+# without a TCP header, whose tcp_flag is -1
+TCP_FLAG_SLOTS = 257
+NO_TCP_FLAG = 256
+
+INITIAL_ROWS = 64
+
+# Name, type, width and initial value of each column. The flow columns are
+# the count, mean and sum of squared differences of IncMeanSTD. Packet
+# lengths are integers, and the bytes columns keep the integer arithmetic
+# IncMeanSTD did on them.
+COLUMNS = [("total", np.int64, 2, 0),
+           ("last_seen", np.float64, 2, np.nan),
+           ("iat_count", np.int64, 2, 0),
+           ("iat_mean", np.float64, 2, 0),
+           ("iat_m2", np.float64, 2, 0),
+           ("bytes_count", np.int64, 2, 0),
+           ("bytes_mean", np.int64, 2, 0),
+           ("bytes_m2", np.int64, 2, 0),
+           ("tcp_flags", np.uint32, TCP_FLAG_SLOTS, 0)]
+
+# Columns cleared when a flow is taken
+FLOW_COLUMNS = ["iat_count", "iat_mean", "iat_m2", "bytes_count", "bytes_mean", "bytes_m2", "tcp_flags"]
+
+# Flow fields of a row without packets
+EMPTY_FLOW = (-1, 0, 0, None, None, None, None, None, None, None, None)
+
+
+class ServiceTable():
+    # State of the ServiceStats of a packet analyzer as a struct of arrays,
+    # one row per service of an IP pair and protocol. Rows are handed out by
+    # addRow and the arrays double when full, so a ServiceStats keeps its row
+    # number and not the arrays. takeFlows computes the flows of the rows
+    # with packets at once and clears their flow columns in place, so its
+    # cost follows the active rows rather than every row ever added. Each
+    # row belongs to one of the phases of the caller, and the flows of a
+    # phase are taken on their own.
+    def __init__(self, norm, phases=1, rows=INITIAL_ROWS):
+        self.norm = norm
+        self.size = 0
+        self.free = []
+        self.row_phases = dict()
+        # Rows of each phase with a packet since the last takeFlows, and
+        # rows whose last flow had packets
+        self.active = [set() for phase in range(phases)]
+        self.recent = [set() for phase in range(phases)]
+        for name, dtype, width, fill in COLUMNS:
+            setattr(self, name, np.full((rows, width), fill, dtype))
+
+
+    def getRowCount(self):
+        return self.size - len(self.free)
+
+
+    def addRow(self, phase=0, values=None):
+        if self.free:
+            row = self.free.pop()
+        else:
+            row = self.size
+            if row == len(self.total):
+                self.grow()
+            self.size += 1
+        self.row_phases[row] = phase
+        if values != None:
+            for name, dtype, width, fill in COLUMNS:
+                getattr(self, name)[row] = values[name]
+            if values["tcp_flags"].any():
+                self.active[phase].add(row)
+            if values.get("recent"):
+                self.recent[phase].add(row)
+        return row
+
+
+    def removeRow(self, row):
+        for name, dtype, width, fill in COLUMNS:
+            getattr(self, name)[row] = fill
+        phase = self.row_phases.pop(row)
+        self.active[phase].discard(row)
+        self.recent[phase].discard(row)
+        self.free.append(row)
+
+
+    def getRow(self, row):
+        values = dict((name, getattr(self, name)[row].copy()) for name, dtype, width, fill in COLUMNS)
+        values["recent"] = row in self.recent[self.row_phases[row]]
+        return values
+
+
+    def grow(self):
+        rows = 2 * len(self.total)
+        for name, dtype, width, fill in COLUMNS:
+            column = np.full((rows, width), fill, dtype)
+            column[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, column)
+
+
+    def countFlag(self, row, tcp_flag):
+        slot = tcp_flag if tcp_flag >= 0 else NO_TCP_FLAG
+        self.tcp_flags.itemset(row, slot, self.tcp_flags.item(row, slot) + 1)
+        self.active[self.row_phases[row]].add(row)
+
+
+    def countFlags(self, rows, tcp_flags):
+        slots = np.where(tcp_flags >= 0, tcp_flags, NO_TCP_FLAG)
+        np.add.at(self.tcp_flags, (rows, slots), 1)
+        row_phases = self.row_phases
+        active = self.active
+        for row in np.unique(rows).tolist():
+            active[row_phases[row]].add(row)
+
+
+    def updateFlow(self, count, mean, m2, row, direction, x):
+        n, mu, s = update_flow(count.item(row, direction),
+                               mean.item(row, direction),
+                               m2.item(row, direction),
+                               x,
+                               self.norm)
+        count.itemset(row, direction, n)
+        mean.itemset(row, direction, mu)
+        m2.itemset(row, direction, s)
+
+
+    def updateIAT(self, row, direction, iat):
+        self.updateFlow(self.iat_count, self.iat_mean, self.iat_m2, row, direction, iat)
+
+
+    def updateBytes(self, row, direction, packet_len):
+        self.updateFlow(self.bytes_count, self.bytes_mean, self.bytes_m2, row, direction, packet_len)
+
+
+    def takeFlows(self, phase=0):
+        # Returns the rows of the phase that saw a packet since the last
+        # call, or before it, with the Flow fields from tcp_flag_most to
+        # std_iat_ba of each, then starts new flows. A row that went idle
+        # gives one empty flow and is left out from then on, until it sees a
+        # packet again.
+        rows = sorted(self.active[phase] | self.recent[phase])
+        index = np.array(rows, np.int64)
+        tcp_flags = self.tcp_flags[index]
+        most = tcp_flags.argmax(axis=1)
+        has_packets = tcp_flags[np.arange(len(rows)), most] > 0
+        tcp_flag_most = np.where(has_packets & (most != NO_TCP_FLAG), most, -1)
+
+        iat_count = self.iat_count[index]
+        bytes_count = self.bytes_count[index]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            iat_std = np.sqrt(self.iat_m2[index] / (iat_count - 1))
+            bytes_std = np.sqrt(self.bytes_m2[index] // np.maximum(bytes_count - 1, 1))
+
+        columns = [tcp_flag_most.tolist(),
+                   bytes_count[:, AB].tolist(),
+                   bytes_count[:, BA].tolist()]
+        bytes_mean = self.bytes_mean[index]
+        iat_mean = self.iat_mean[index]
+        for direction in (AB, BA):
+            columns.append(mean_or_none(bytes_mean[:, direction], bytes_count[:, direction]))
+            columns.append(std_or_none(bytes_std[:, direction], bytes_count[:, direction]))
+        for direction in (AB, BA):
+            columns.append(mean_or_none(iat_mean[:, direction], iat_count[:, direction]))
+            columns.append(std_or_none(iat_std[:, direction], iat_count[:, direction]))
+        flows = zip(*columns)
+
+        for name in FLOW_COLUMNS:
+            getattr(self, name)[index] = 0
+        self.recent[phase] = self.active[phase]
+        self.active[phase] = set()
+        return rows, flows
+
+
+    def takeIdle(self, phase=0):
+        # Rows of the phase whose last flow had packets, for an empty flow
+        # over a gap without traffic; they are left out of the flows that
+        # follow
+        rows = sorted(self.recent[phase])
+        self.recent[phase] = set()
+        return rows
+
+
+def update_flow(n, mean, m2, x, norm):
+    # IncMeanSTD.update on the count, mean and sum of squared differences of
+    # a flow: a value further than a deviation from the mean that would be
+    # reported with a high confidence is left out
+    if n >= 2:
+        std = math.sqrt(m2/(n-1))
+        if abs(x-mean) > std and sigmoid(n/norm) * anomaly_score(x, mean, std) >= UPDATE_TH:
+            return n, mean, m2
+    n += 1
+    if n == 1:
+        return n, x, 0
+    new_mean = mean+(x-mean)/n
+    return n, new_mean, m2 + (x-mean)*(x-new_mean)
+
+
+def mean_or_none(mean, count):
+    return [value if n > 0 else None for value, n in zip(mean.tolist(), count.tolist())]
+
+
+def std_or_none(std, count):
+    return [value if n > 1 else None for value, n in zip(std.tolist(), count.tolist())]
@@ -0,0 +1,173 @@
+import collections
+import multiprocessing
+from analyze_packet import PacketAnalyzer, NoveltyTracker, PHASE_LEN, period_start
+from analyze_flow import FlowAnalyzer
+from analyze_operation import OperationAnalyzer, PERIODIC_CHECK_TIME
+from analyze_data import DataAnalyzer
+from index_key import packet_index
+
+# Message kinds sent to a shard worker
+PACKET = 0
+START = 1
+TICK = 2
+OPERATION = 3
+CHECK = 4
+DATA_VALUE = 5
+
+# Number of messages buffered per shard before they are sent as one batch
+BATCH_SIZE = 256
+
+
+# Keys are only hashed in the routing process, so the hash of the key tuple
+# is stable for the whole run
+def hash_key(key, num_shards):
+    return hash(key) % num_shards
+
+
+def packet_key(packet):
+    # Both directions of an IP pair share the same statistics
+    orig = packet.conn[0]
+    resp = packet.conn[2]
+    if orig < resp:
+        return (orig, resp)
+    return (resp, orig)
+
+
+def operation_key(operation):
+    return (operation.orig_ip, operation.resp_ip, operation.service, operation.uid)
+
+
+def data_value_key(data_value):
+    return (data_value.holder_ip, data_value.protocol, data_value.uid, data_value.data_type, data_value.index)
+
+
+class LocalQueue(collections.deque):
+    def put_nowait(self, item):
+        self.append(item)
+
+
+def shard_worker(in_queue, out_queue, analyze_flows=True):
+    anomaly_buffer = LocalQueue()
+    flow_buffer = LocalQueue()
+    packet_anl = PacketAnalyzer(anomaly_buffer, flow_buffer, False)
+    flow_anl = FlowAnalyzer(anomaly_buffer)
+    operation_anl = OperationAnalyzer(anomaly_buffer)
+    data_value_anl = DataAnalyzer(anomaly_buffer)
+
+    while True:
+        batch = in_queue.get()
+        if batch is None:
+            break
+        for kind, item in batch:
+            if kind == PACKET:
+                packet_anl.analyze(item)
+            elif kind == START:
+                packet_anl.start(item)
+            elif kind == TICK:
+                packet_anl.advance(item)
+            elif kind == OPERATION:
+                operation_anl.update(item)
+            elif kind == CHECK:
+                operation_anl.check(item)
+            else:
+                data_value_anl.analyze(item)
+            if analyze_flows:
+                while flow_buffer:
+                    flow_anl.analyze(flow_buffer.popleft())
+            else:
+                flow_buffer.clear()
+        if anomaly_buffer:
+            out_queue.put(list(anomaly_buffer))
+            anomaly_buffer.clear()
+    out_queue.put(None)
+
+
+class ShardPool():
+    # Packets are partitioned by IP pair, operations by their model key and
+    # data values by their holder/point key. The pool keeps the state that
+    # must be global (novelty counters and the aggregation and check clocks)
+    # and broadcasts clock events so every shard sees the same boundaries.
+    def __init__(self, num_shards, anomaly_queue, producers=3, analyze_flows=True, novelty_sketch=None):
+        self.num_shards = num_shards
+        self.producers = producers
+        self.novelty = NoveltyTracker(anomaly_queue, novelty_sketch)
+        self.last_aggregate = -1
+        self.last_check = None
+        self.out_queue = multiprocessing.Queue()
+        self.in_queues = []
+        self.pending = []
+        self.workers = []
+        for i in range(num_shards):
+            in_queue = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=shard_worker, args=(in_queue, self.out_queue, analyze_flows))
+            worker.daemon = True
+            worker.start()
+            self.in_queues.append(in_queue)
+            self.pending.append([])
+            self.workers.append(worker)
+
+
+    def getStateSize(self):
+        size = self.novelty.getStateSize()
+        size["pending"] = sum(len(pending) for pending in self.pending)
+        return size
+
+
+    def send(self, shard, kind, item):
+        pending = self.pending[shard]
+        pending.append((kind, item))
+        if len(pending) >= BATCH_SIZE:
+            self.in_queues[shard].put(pending)
+            self.pending[shard] = []
+
+
+    def broadcast(self, kind, item):
+        for shard in range(self.num_shards):
+            self.send(shard, kind, item)
+
+
+    def flush(self):
+        for shard in range(self.num_shards):
+            if self.pending[shard]:
+                self.in_queues[shard].put(self.pending[shard])
+                self.pending[shard] = []
+
+
+    def routePacket(self, packet):
+        if self.last_aggregate == -1:
+            self.last_aggregate = packet.ts
+            self.broadcast(START, packet.ts)
+        if packet.ts > self.last_aggregate + PHASE_LEN:
+            self.last_aggregate = period_start(self.last_aggregate, packet.ts, PHASE_LEN)
+            self.broadcast(TICK, packet.ts)
+
+        index = packet_index(packet.conn[0], packet.conn[2], packet.protocol_type, packet.service)
+        self.novelty.update(packet, index)
+        self.send(hash_key(packet_key(packet), self.num_shards), PACKET, packet)
+
+
+    def routeOperation(self, operation):
+        self.send(hash_key(operation_key(operation), self.num_shards), OPERATION, operation)
+        if self.last_check == None:
+            self.last_check = operation.ts
+        elif operation.ts > self.last_check + PERIODIC_CHECK_TIME:
+            self.broadcast(CHECK, operation.ts)
+            self.last_check += PERIODIC_CHECK_TIME
+
+
+    def routeDataValue(self, data_value):
+        self.send(hash_key(data_value_key(data_value), self.num_shards), DATA_VALUE, data_value)
+
+
+    # Called once by each router; the workers are stopped after the last one
+    def close(self):
+        self.flush()
+        self.producers -= 1
+        if self.producers == 0:
+            for in_queue in self.in_queues:
+                in_queue.put(None)
+
+
+    def join(self):
+        for worker in self.workers:
+            worker.join()
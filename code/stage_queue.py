@@ -0,0 +1,198 @@
+from gevent.queue import Queue
+from gevent.event import Event
+
+# What to do with an item put into a queue that is at capacity
+BLOCK = "block"              # wait until the consumer makes room
+DROP_OLDEST = "drop_oldest"  # evict the oldest item of this queue
+PRIORITY = "priority"        # evict from the lowest priority queue of the group
+DISCARD = "discard"          # drop every item; used for the input of a disabled stage
+POLICIES = [BLOCK, DROP_OLDEST, PRIORITY, DISCARD]
+
+# End-of-stream sentinel used by the pipeline. It is never dropped and does
+# not count against the capacity of a queue.
+STOP = StopIteration
+
+
+class QueueGroup():
+    # Shared capacity for a set of PRIORITY queues. When the group is full,
+    # the oldest item of the lowest priority non-empty member is evicted.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.members = []
+        # Set when an item is taken from any member
+        self.room = Event()
+
+
+    def add(self, queue):
+        self.members.append(queue)
+        self.members.sort(key=lambda q: q.priority)
+
+
+    def remove(self, queue):
+        self.members.remove(queue)
+
+
+    def size(self):
+        return sum(queue.qsize() for queue in self.members)
+
+
+    def isFull(self):
+        return self.capacity != None and self.size() >= self.capacity
+
+
+    def evict(self, priority):
+        for queue in self.members:
+            if queue.priority > priority:
+                break
+            if queue.evict():
+                return True
+        return False
+
+
+class StageQueue(Queue):
+    def __init__(self, name, maxsize=None, policy=BLOCK, priority=0, group=None):
+        Queue.__init__(self, None)
+        self.name = name
+        self.group = None
+        # Set when an item is taken, for waitForRoom
+        self.room = Event()
+        self.configure(maxsize, policy, priority, group)
+
+        self.put_count = 0
+        self.drop_count = 0
+        self.high_water = 0
+
+
+    # Change the capacity and policy of the queue; only safe before the
+    # stages that use it are started
+    def configure(self, maxsize=None, policy=BLOCK, priority=0, group=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy {} for queue {}".format(policy, self.name))
+        if policy == BLOCK:
+            self.maxsize = maxsize
+        else:
+            self.maxsize = None
+        self.capacity = maxsize
+        self.policy = policy
+        self.priority = priority
+        if self.group != None:
+            self.group.remove(self)
+            self.group = None
+        if policy == PRIORITY and group != None:
+            self.group = group
+            group.add(self)
+
+
+    def isFull(self):
+        return self.capacity != None and self.qsize() >= self.capacity
+
+
+    # Called by gevent for every item taken by get or get_nowait
+    def _get(self):
+        item = Queue._get(self)
+        self.room.set()
+        if self.group != None:
+            self.group.room.set()
+        return item
+
+
+    # Wait until neither the queue nor its group is at capacity, for a
+    # producer that must not shed load on a PRIORITY queue
+    def waitForRoom(self):
+        while True:
+            if self.isFull():
+                room = self.room
+            elif self.group != None and self.group.isFull():
+                room = self.group.room
+            else:
+                return
+            room.clear()
+            room.wait()
+
+
+    def evict(self):
+        # Drop the oldest item that is not an end-of-stream sentinel
+        for i in range(len(self.queue)):
+            if self.queue[i] is not STOP:
+                del self.queue[i]
+                self.drop_count += 1
+                return True
+        return False
+
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == DISCARD:
+            if item is not STOP:
+                self.drop_count += 1
+            return
+        if item is not STOP:
+            if self.policy == DROP_OLDEST:
+                if self.isFull() and not self.evict():
+                    self.drop_count += 1
+                    return
+            elif self.policy == PRIORITY:
+                if self.isFull():
+                    evicted = self.evict()
+                elif self.group != None and self.group.isFull():
+                    evicted = self.group.evict(self.priority)
+                else:
+                    evicted = True
+                if not evicted:
+                    self.drop_count += 1
+                    return
+            self.put_count += 1
+
+        Queue.put(self, item, block, timeout)
+
+        depth = self.qsize()
+        if depth > self.high_water:
+            self.high_water = depth
+
+
+    # Put a list of items in order. When they all fit, they are appended at
+    # once and the consumer is woken once; otherwise each one goes through
+    # put and the policy of the queue.
+    def putMany(self, items):
+        if len(items) == 0:
+            return
+        if self.policy == DISCARD:
+            self.drop_count += sum(1 for item in items if item is not STOP)
+            return
+        fits = self.capacity == None or self.qsize() + len(items) <= self.capacity
+        if self.group != None and self.group.capacity != None:
+            fits = fits and self.group.size() + len(items) <= self.group.capacity
+        if not fits:
+            for item in items:
+                self.put(item)
+            return
+
+        self.put_count += sum(1 for item in items if item is not STOP)
+        self.queue.extend(items[:-1])
+        Queue.put(self, items[-1])
+
+        depth = self.qsize()
+        if depth > self.high_water:
+            self.high_water = depth
+
+
+    # The analyzers hand their output over with put_nowait. Routing it through
+    # put makes them honor the policy, which for BLOCK means waiting for room.
+    def put_nowait(self, item):
+        self.put(item)
+
+
+    def getStats(self):
+        return {"depth": self.qsize(),
+                "capacity": self.capacity,
+                "policy": self.policy,
+                "high_water": self.high_water,
+                "put": self.put_count,
+                "drop": self.drop_count}
+
+
+    def __str__(self):
+        return "{0}: depth {1}, high water {2}, put {3}, dropped {4}".format(self.name,
+                                                                           self.qsize(),
+                                                                           self.high_water,
+                                                                           self.put_count,
+                                                                           self.drop_count)